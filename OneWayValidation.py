@@ -28,33 +28,63 @@
 # ---------------------------------------------------------------------------
 
 # 0) Import modules, define Google Maps API Key, local variables and input parameters:
-import arcpy
 import csv
+import itertools
 import json
-import urllib2
 import math
+import os
 import sys
-
-# The road network to validate. Must be a polyline feature class.
+import time
+from OneWayValidation_Utils import make_provider, GoogleRoadsProvider
+from OneWayValidation_Utils import RoutingBackend, ResponseArchive
+from OneWayValidation_Utils import SegmentVerdicts, FLIP, ONEWAY, TWOWAY, DRIVABLE, POTENTIAL_FLIP, OK, SKIP, ERROR
+from OneWayValidation_Utils import bearing_difference, flip_confidence, is_uncertain, confidence_verdict, confidence_sweep
+from OneWayValidation_Utils import ResultsTable, results_table_path
+from OneWayValidation_Utils import DuplicateGeometries, duplicate_history
+from OneWayValidation_Utils import spatial_order
+from OneWayValidation_Utils import Reprojector, has_reprojection, source_crs, project_transform, REPROJECT_BATCH, WGS84
+from OneWayValidation_Utils import ProgressReporter
+from OneWayValidation_Utils import make_pipeline
+from OneWayValidation_Utils import read_segments, SegmentChunks, chunk_vertices, MemoryMonitor, resident_memory
+from OneWayValidation_Utils import EndpointIndex, OsmOnewayIndex
+from OneWayValidation_Utils import staged_changes, stage_changes, apply_staged_changes
+from OneWayValidation_Utils import parameter, message, open_csv
+
+# A CSV of (lon,lat) points exported by Step 5 of an earlier run. If given, Steps 1-5 and
+# the edits in Steps 11-12 are skipped and arcpy is never imported, so the segments can
+# be classified again from a plain Python installation. The parameters are given in the
+# same order as the script tool's, e.g.:
+#	python OneWayValidation.py "" "" <working fc> <unique id> ... <output folder> ... <cached csv>
+cached_vertices = parameter(16)
+headless = cached_vertices not in ('', '#')
+if not headless:
+	import arcpy
+
+# The road network to validate. Must be a polyline feature class, or several separated
+# by ';' (e.g. one per State Plane zone or state), which may be in different coordinate 
+# systems. Unique ids must be unique across all of them.
 # Input is used only for road segment selection, geoprocessing is not done on this feature class.
-road_network = arcpy.GetParameterAsText(0)
+road_network = parameter(0)
+road_networks = [road.strip().strip("'") for road in road_network.split(';') if road.strip()]
 
 # The working geodatabase, where feature classes created are saved.
-working_gdb = arcpy.GetParameterAsText(1)
+working_gdb = parameter(1)
 
 # The name of the feature class created in the working geodatabase that geoprocessing is done on. 
 # If the option to flip wrongly digitized routes is set to 'Yes', then this is the feature class 
-# in which FlipLines_Edit is run on.
-working_fc = arcpy.GetParameterAsText(2)
+# in which FlipLines_Edit is run on. With several road networks, the second and later ones 
+# are copied to working_fc_2, working_fc_3, etc.
+working_fc = parameter(2)
+working_fcs = [working_fc] + [working_fc + '_' + str(n + 1) for n in range(1, len(road_networks))]
 
 # The unique identifier for road segments in the Road Network feature class. 
 # Used to select (and, if selected, flip) polylines in the Working Feature Class.
-unique_id = arcpy.GetParameterAsText(3)
+unique_id = parameter(3)
 	
 # SQL Expression used to select specific road segments in the Working Feature Class, 
 # which will be submitted to Google Maps API for the Snap To Roads tool. 
 # This parameter is optional. Leave blank if no selection by attribute is desired.
-street_select_expression = arcpy.GetParameterAsText(4)
+street_select_expression = parameter(4)
 
 # Distance (in meters) at which to Densify polyline segments.
 # It is recommended to use in combination with the SQL Expression, and call
@@ -62,15 +92,15 @@ street_select_expression = arcpy.GetParameterAsText(4)
 #	if Length >= 30: densify_distance = 10 Meters
 #	if Length < 30 and Length >= 10: densify_distance = 5 Meters
 # 	if Length < 10: densify_distance = 1 Meter
-densify_distance = arcpy.GetParameterAsText(5)
+densify_distance = parameter(5)
 
-# File name for the output of Step 4:
-fc_Densify_VertPoints = arcpy.GetParameterAsText(6)
-fc_Densify_VertPoints = working_gdb + '\\' + working_fc + '_Densify_VertPoints'
+# File names for the output of Step 4, one per working feature class:
+fc_Densify_VertPoints = parameter(6)
+fc_Densify_VertPoints = [working_gdb + '\\' + fc + '_Densify_VertPoints' for fc in working_fcs]
 
-# File name for the output of Step 5:
-fc_Densify_VertPoints_Project = arcpy.GetParameterAsText(7)
-fc_Densify_VertPoints_Project = fc_Densify_VertPoints + '_WGS84'
+# No longer used: Step 5 reprojects vertices in memory rather than to a new feature class.
+# Kept so that the parameters of existing script tools keep their order.
+fc_Densify_VertPoints_Project = parameter(7)
 
 # The names of the fields to be exported to a CSV (saved as a .txt file). 
 # The default values provided indicate the fields required for successful 
@@ -79,7 +109,7 @@ fc_Densify_VertPoints_Project = fc_Densify_VertPoints + '_WGS84'
 #		Unique identifier (i.e. ROADINVENTORY_ID)
 #		POINT_X
 #		POINT_Y
-Value_Field = arcpy.GetParameterAsText(8)
+Value_Field = parameter(8)
 if Value_Field == '#' or not Value_Field:
     Value_Field = unique_id + ";POINT_X;POINT_Y"
 
@@ -90,19 +120,30 @@ if Value_Field == '#' or not Value_Field:
 # If you have a premium key, there are no limits on the usage of this tool. 
 # Otherwise, only 2500 requests (i.e. road segments) can be made each day: 
 #	https://developers.google.com/maps/documentation/roads/snap
-key = arcpy.GetParameterAsText(9)
+key = parameter(9)
 
 # The pathname of the folder where CSVs generated from this script, 
 # including a .txt file with the unique ids of road segments to flip, will be saved.
-flip_ids_output = arcpy.GetParameterAsText(10)
+flip_ids_output = parameter(10)
+
+# File name for the TXT output of Step 5:
+csv_output = parameter(11)
+csv_output = os.path.join(flip_ids_output, working_fc + '_WGS84_addXY.txt')
+if headless:
+	csv_output = cached_vertices
+
+# File names for the output of Step 10:
+flip_ids_txt = parameter(12)
+flip_ids_txt = os.path.join(flip_ids_output, working_fc + "_flip_ids.txt")
 
-# File name for the TXT output of Step 6:
-csv_output = arcpy.GetParameterAsText(11)
-csv_output = flip_ids_output + '\\' + working_fc + '_WGS84_addXY.txt'
+# Per-segment results table (verdicts, route distances, snap offsets and timings), 
+# saved next to the flip ids as a Parquet file if pyarrow is installed, or as a GeoPackage
+# table otherwise. Written while the tool runs, so it can be joined back to the road network.
+results_table_output = results_table_path(flip_ids_output, working_fc)
 
-# File names for the output of Step 11:
-flip_ids_txt = arcpy.GetParameterAsText(12)
-flip_ids_txt = flip_ids_output + '\\' + working_fc + "_flip_ids.txt"
+# Table created in the working geodatabase by Step 11, with one row per unique id whose 
+# geometry or Street Operation is changed by Step 12.
+staging_name = working_fc + '_flip_staging'
 
 # Do you wish to flip the directionality of incorrectly digitized road segments automatically?
 # If 'Yes', unique segments identified by the Snap To Roads tool as being digitized 
@@ -110,15 +151,85 @@ flip_ids_txt = flip_ids_output + '\\' + working_fc + "_flip_ids.txt"
 # will be flipped (using FlipLines_Edit: http://desktop.arcgis.com/en/arcmap/10.3/tools/editing-toolbox/flip-line.htm) 
 # in the Working Feature Class.
 # Else, change field to 'No' to skip processes of flipping polylines for now.
-flip_routes = arcpy.GetParameterAsText(13)
+flip_routes = parameter(13)
 if flip_routes == '#' or not flip_routes:
     flip_routes = 'Yes'
 
 # Reclassify road segments as 1-way and 2-way based on OSRM return?
-reclassify = arcpy.GetParameterAsText(14)
+reclassify = parameter(14)
 if reclassify == '#' or not reclassify:
     reclassify = 'Yes'
 
+# Classify road segments with a single OSRM request where possible? If 'Yes', only the
+# route along the digitized direction is requested (with its OSM node ids), and segments
+# whose route clearly detours or doubles back are flipped without the reverse route. The
+# reverse route is still requested when that is inconclusive, or when segments need to be
+# reclassified as one-way or two-way. Use with Reclassify set to 'No' for the biggest savings.
+single_call = parameter(15)
+if single_call == '#' or not single_call:
+    single_call = 'No'
+
+# Report memory use (see MemoryMonitor in OneWayValidation_Utils.py) alongside the timings?
+# Tracing Python allocations slows the run down a little, so it is off by default.
+profile_memory = parameter(17)
+if profile_memory == '#' or not profile_memory:
+    profile_memory = 'No'
+memory = MemoryMonitor(trace = True) if profile_memory.lower() == 'yes' else None
+
+# Memory budget in MB. Optional. If set, segments are read from the CSV and sent to OSRM 
+# and Snap To Roads in chunks sized to the budget rather than all at once, the points 
+# of each segment are dropped as soon as its results are written, and only a bounded
+# number of geometries are kept to spot duplicates (see duplicate_history() in
+# OneWayValidation_Utils.py). Chunks get smaller if the memory the process has taken on
+# since it started still goes over the budget. Some state grows with the network whatever
+# the budget, since the outputs need it: the verdicts of every id (about 140 bytes per 
+# segment) and the bearings at every segment end used to trim intersections (up to about
+# 550 bytes per segment).
+max_memory = parameter(18)
+max_memory = float(max_memory) if max_memory not in ('', '#') else None
+memory_baseline = resident_memory() or 0
+
+# An OSM extract (.osm, .osm.gz or .osm.bz2) covering the road network. Optional. If given,
+# segments its oneway tags show to be clearly two-way are classified as two-way without
+# OSRM requests, and only the rest are sent to OSRM (see OsmOnewayIndex in OneWayValidation_Utils.py).
+osm_extract = parameter(19)
+
+# The routing engine that classifies direction in place of OSRM: 'OSRM' (the default),
+# or 'Valhalla' or 'GraphHopper' for a locally hosted server. Its route service URL is
+# optional; each engine has a default (see RoutingProvider in OneWayValidation_Utils.py).
+# Verdicts are reported as OSRM's whichever engine is used. Single-call mode is OSRM only.
+routing_provider = parameter(20)
+if routing_provider == '#' or not routing_provider:
+    routing_provider = 'OSRM'
+routing_url = parameter(21)
+if routing_url == '#' or not routing_url:
+    routing_url = None
+
+# A file (.jsonl.gz) that every OSRM and Snap To Roads response of this run is recorded
+# to. Optional. If Replay is 'Yes', the responses are read back from it instead and no
+# request is made (see ResponseArchive in OneWayValidation_Utils.py), and Step 10 reports
+# how many segments would be flipped or flagged for review with other confidence thresholds.
+response_archive = parameter(22)
+replay = parameter(23)
+if replay == '#' or not replay:
+    replay = 'No'
+archive = None
+if response_archive not in ('', '#'):
+	archive = ResponseArchive(response_archive, replay.lower() == 'yes')
+
+# File name for the threshold sweep of a replayed run:
+threshold_sweep_txt = os.path.join(flip_ids_output, working_fc + "_threshold_sweep.txt")
+
+# Every OSRM and Snap To Roads request is retried with backoff when it fails for a 
+# transient reason, and a backend that keeps failing is paused by a circuit breaker
+# (see OneWayValidation_Utils.py). OSRM requests still waiting after 'hedge_after' 
+# seconds are sent a second time. Snap To Roads is not hedged, since every duplicate
+# request counts against the Google Maps API quota.
+osrm_backend = RoutingBackend(routing_provider, hedge_after = 2.0, archive = archive)
+google_backend = RoutingBackend('Snap To Roads', archive = archive)
+direction_provider = make_provider(routing_provider, osrm_backend, routing_url, single_call.lower() == 'yes', reclassify.lower() == 'yes')
+snap_provider = GoogleRoadsProvider(google_backend, key)
+
 # Function from https://gist.github.com/jeromer/2005586 that is used to calculate
 # the orientation of the sent and returned lines to verify if it was snapped to the
 # correct road:
@@ -143,343 +254,469 @@ def timeit(method):
         ts = time.time()
         result = method(*args, **kw)
         te = time.time()
-        arcpy.AddMessage('%r %2.2f sec' % \
+        message('%r %2.2f sec' % \
               (method.__name__, te-ts))
+        if memory is not None:
+            message(memory.status(method.__name__))
         return result
     return timed
 
+# Progress of the OSRM and Snap To Roads stages: drives the progressor in ArcGIS, and 
+# rewrites a single status line when run from a console (see ProgressReporter in
+# OneWayValidation_Utils.py).
+def show_progress(status, percent):
+	if not headless:
+		arcpy.SetProgressorLabel(status)
+		arcpy.SetProgressorPosition(percent)
+	if sys.stdout.isatty():
+		sys.stdout.write('\r' + status.ljust(79))
+		sys.stdout.flush()
+
+def start_progress(label, total):
+	if not headless:
+		arcpy.SetProgressor("step", label, 0, 100, 1)
+	return ProgressReporter(label, total, show_progress)
+
+def end_progress(progress):
+	progress.finish()
+	if not headless:
+		arcpy.ResetProgressor()
+	if sys.stdout.isatty():
+		sys.stdout.write('\n')
+	message(progress.status(time.time()))
+
 # ---------------------------------------------------------------------------
 
-# 1) Feature Class to Feature Class
-arcpy.FeatureClassToFeatureClass_conversion(
-	in_features = road_network, 
-	out_path = working_gdb, 
-	out_name = working_fc
-)
-arcpy.AddMessage("Working feature class created: " + working_gdb + '\\' + working_fc)
-
-# 2) Make Feature Layer from Selection
-arcpy.MakeFeatureLayer_management(
-	in_features = working_gdb + '\\' + working_fc,
-	out_layer = 'road_seg_working',
-	where_clause = street_select_expression
-)
-
-# 3) Densify
-arcpy.Densify_edit(
-	in_features = 'road_seg_working', 
-	densification_method = "DISTANCE", 
-	distance = densify_distance
-)
-arcpy.AddMessage("Polylines densified by distance every " + str(densify_distance))
-
-# 4) Feature Vertices To Points
-arcpy.FeatureVerticesToPoints_management(
-	in_features = 'road_seg_working', 
-	out_feature_class = fc_Densify_VertPoints,
-	point_location = "ALL"
-)
-arcpy.AddMessage("Polyline vertices saved as Points: " + fc_Densify_VertPoints)
-
-# 5) Project
-arcpy.Project_management(
-	in_dataset = fc_Densify_VertPoints,
-	out_dataset = fc_Densify_VertPoints_Project,
-	out_coor_system = "GEOGCS['GCS_WGS_1984',DATUM['D_WGS_1984',SPHEROID['WGS_1984',6378137.0,298.257223563]],PRIMEM['Greenwich',0.0],UNIT['Degree',0.0174532925199433]]",
-	transform_method = "WGS_1984_(ITRF00)_To_NAD_1983",
-	in_coor_system = "PROJCS['NAD_1983_StatePlane_Massachusetts_Mainland_FIPS_2001',GEOGCS['GCS_North_American_1983',DATUM['D_North_American_1983',SPHEROID['GRS_1980',6378137.0,298.257222101]],PRIMEM['Greenwich',0.0],UNIT['Degree',0.0174532925199433]],PROJECTION['Lambert_Conformal_Conic'],PARAMETER['False_Easting',200000.0],PARAMETER['False_Northing',750000.0],PARAMETER['Central_Meridian',-71.5],PARAMETER['Standard_Parallel_1',41.71666666666667],PARAMETER['Standard_Parallel_2',42.68333333333333],PARAMETER['Latitude_Of_Origin',41.0],UNIT['Meter',1.0]]"
-)
-arcpy.AddMessage("Points projected to WGS84: " + fc_Densify_VertPoints_Project)
-
-# 6) Add XY Coordinates
-arcpy.AddXY_management(
-	in_features = fc_Densify_VertPoints_Project
-)
-
-# 7) Export Attribute Table to CSV
-arcpy.ExportXYv_stats(
-	Input_Feature_Class = fc_Densify_VertPoints_Project, 
-	Value_Field = Value_Field, 
-	Delimiter = "COMMA", 
-	Output_ASCII_File = csv_output, 
-	Add_Field_Names_to_Output = "ADD_FIELD_NAMES"
-)
-arcpy.AddMessage("(lon,lat) points added to field, exported as csv: " + csv_output)
+if not headless:
+	# 1) Feature Class to Feature Class
+	for road, fc in zip(road_networks, working_fcs):
+		arcpy.FeatureClassToFeatureClass_conversion(
+			in_features = road, 
+			out_path = working_gdb, 
+			out_name = fc
+		)
+		message("Working feature class created: " + working_gdb + '\\' + fc)
+
+	# 2) Make Feature Layer from Selection
+	working_layers = ['road_seg_working'] + ['road_seg_working_' + str(n + 1) for n in range(1, len(working_fcs))]
+	for fc, layer in zip(working_fcs, working_layers):
+		arcpy.MakeFeatureLayer_management(
+			in_features = working_gdb + '\\' + fc,
+			out_layer = layer,
+			where_clause = street_select_expression
+		)
+
+	# 3) Densify
+	for layer in working_layers:
+		arcpy.Densify_edit(
+			in_features = layer, 
+			densification_method = "DISTANCE", 
+			distance = densify_distance
+		)
+	message("Polylines densified by distance every " + str(densify_distance))
+
+	# 4) Feature Vertices To Points
+	for layer, vertices in zip(working_layers, fc_Densify_VertPoints):
+		arcpy.FeatureVerticesToPoints_management(
+			in_features = layer, 
+			out_feature_class = vertices,
+			point_location = "ALL"
+		)
+		message("Polyline vertices saved as Points: " + vertices)
+
+	# 5) Reproject to WGS84 and export to CSV
+	#	 Each set of vertices is read in the coordinate system of its road network, which is
+	#	 detected from the feature class, and reprojected REPROJECT_BATCH points at a time 
+	#	 with one cached transformer per coordinate system (see Reprojector in 
+	#	 OneWayValidation_Utils.py). Without pyproj, arcpy projects the points as they are read.
+	#	 Either way, NAD 1983 is taken to WGS 84 with the WGS_1984_(ITRF00)_To_NAD_1983
+	#	 transformation (see project_transform() in OneWayValidation_Utils.py).
+	#	 The (lon,lat) of each point are written as POINT_X and POINT_Y, alongside the other
+	#	 fields in Value_Field.
+	reprojector = Reprojector() if has_reprojection() else None
+	wgs84 = arcpy.SpatialReference(WGS84)
+	csv_fields = Value_Field.split(';')
+	cursor_fields = [field for field in csv_fields if field not in ('POINT_X', 'POINT_Y')] + ['SHAPE@XY']
+	with open_csv(csv_output, 'w') as outfile:
+		writer = csv.writer(outfile)
+		writer.writerow(csv_fields)
+		for vertices in fc_Densify_VertPoints:
+			spatial_reference = arcpy.Describe(vertices).spatialReference
+			crs = source_crs(spatial_reference)
+			transform = project_transform(spatial_reference)
+			in_cursor = crs == WGS84 or reprojector is None
+			if in_cursor:
+				arcpy.env.geographicTransformations = transform
+				cursor = arcpy.da.SearchCursor(vertices, cursor_fields, spatial_reference = wgs84)
+			else:
+				cursor = arcpy.da.SearchCursor(vertices, cursor_fields)
+			with cursor:
+				while True:
+					rows = list(itertools.islice(cursor, REPROJECT_BATCH))
+					if not rows:
+						break
+					if in_cursor:
+						latlng = [[row[-1][1], row[-1][0]] for row in rows]
+					else:
+						latlng = reprojector.to_latlng([row[-1] for row in rows], crs, transform)
+					for row, (lat, lng) in zip(rows, latlng):
+						values = dict(zip(cursor_fields, row))
+						values['POINT_X'] = lng
+						values['POINT_Y'] = lat
+						writer.writerow([values[field] for field in csv_fields])
+			message("Points in " + spatial_reference.name + " projected to WGS84 (" + (transform or "no datum transformation") + ", " +
+				("arcpy" if in_cursor else "pyproj") + "): " + vertices)
+	message("(lon,lat) points added to field, exported as csv: " + csv_output)
 
 # ---------------------------------------------------------------------------
 
-# 8) Parse CSV to collect (lat,lng) pairs for each unique ID
-snap_list = []
-with open (csv_output, 'rb') as infile:
-	snap_list_num = -1
-	id = ''
-	prev_id = ''
-	unique_id = str(unique_id)
-	reader = csv.DictReader(infile)
-	for row in reader:
-		id_val = row[unique_id]
-		if id != id_val and id_val != unique_id:
-			snap_list.append({
-				'id':int(id_val),
-				'latlng':[],
-				#'url_google':'',
-				#'url_osrm':'',
-				#'url_osrm_reverse':'',
-				#'snapped_points': {},
-				#'osrm_route': {},
-				#'osrm_route_reverse': {}
-			})
-			id = id_val
-			prev_id = id_val
-			#arcpy.AddMessage("now saving (lat,lng) from id segment " + str(id_val))
-			snap_list_num += 1
-			snap_list[snap_list_num]['latlng'].append([row['POINT_Y'],row['POINT_X']])
-		elif id == id_val and id_val != unique_id:
-			snap_list[snap_list_num]['latlng'].append([row['POINT_Y'],row['POINT_X']])
-	
+# 8) Parse CSV to collect (lat,lng) pairs for each unique ID (see read_segments() in
+#	 OneWayValidation_Utils.py). Under a memory budget, the segments are only read as 
+#	 each chunk is needed.
+#	 The ends of each segment that lie in an intersection are cut off the points sent,
+#	 based on the segments that meet there (see EndpointIndex in OneWayValidation_Utils.py),
+#	 which takes a first pass over the CSV.
+unique_id = str(unique_id)
+with open_csv(csv_output) as infile:
+	endpoints = EndpointIndex(read_segments(csv.DictReader(infile), unique_id))
+infile = open_csv(csv_output)
+segments = endpoints.trimmed(read_segments(csv.DictReader(infile), unique_id))
+if max_memory:
+	chunks = SegmentChunks(segments, chunk_vertices(max_memory))
+	message("Memory budget of " + str(max_memory) + " MB: (lat,lng) pairs are read and sent in chunks of up to " + str(chunks.max_vertices) + " points")
+else:
+	# Order segments along a Hilbert curve of their midpoints, so that consecutive requests
+	# go to nearby parts of the road network (see spatial_order() in OneWayValidation_Utils.py).
+	# Under a memory budget, each chunk is ordered on its own.
+	snap_list = spatial_order(list(segments))
+	infile.close()
+	chunks = [snap_list]
+	message("(lat,lng) pairs collected for " + str(len(snap_list)) + " unique IDs, ordered spatially")
+	if memory is not None:
+		message(memory.status("reading segments"))
+
 # 9) For each unique ID, call the Open Source Route Mapping API, then submit 
 #	  the returned one-way streets to Snap To Roads via the Google Maps Roads API.
 #
 #	  OSRM 	-->	If the length of the route returned != the length of the route in 
-#				the reverse direction, then the road segment is a one-way street. 
-#				The segment that is the shortest length represents the correct direction.
-#			--> One-way road segments are saved to the "oneway_streets" list and two-way 
-#				road segments are saved to the "twoway_streets" list.
-#			--> One-way streets that need to be flipped are saved to the "flip_ids" list.
-#			--> Segments with sys errors or are too short in length are appended to the
-#				"skipped_ids" list.
-
-osrm_flip = []
-osrm_oneway = []
-osrm_twoway = []
-osrm_skip = []
-osrm_error = []
+#				the reverse direction (beyond a small tolerance), then the road segment 
+#				is a one-way street. The segment that is the shortest length represents 
+#				the correct direction.
+#			--> The ratio of the two lengths gives each segment a first confidence 
+#				that it needs to be flipped (see flip_confidence() in OneWayValidation_Utils.py).
+#			--> Each segment gets one OSRM verdict in "verdicts": ONEWAY, TWOWAY, or
+#				FLIP for one-way streets that need to be flipped. In single-call mode,
+#				segments drivable as digitized that were not reclassified are DRIVABLE.
+#			--> Segments that are too short in length are marked SKIP, and segments
+#				whose requests failed are marked ERROR.
+#			--> With an OSM extract, segments on clearly two-way OSM ways are marked 
+#				TWOWAY before any request, and the results table records the OSM way.
+
+verdicts = SegmentVerdicts()
+
+osm_oneway = None
+if osm_extract not in ('', '#'):
+	osm_oneway = OsmOnewayIndex(osm_extract)
+	message(str(osm_oneway.n_ways) + " drivable ways read from " + osm_extract + ", " + str(osm_oneway.n_oneway) + " of them one-way")
+
+# Each segment's row in the results table is written as soon as its verdict is final:
+# by osrm_classified() for everything not sent to Snap To Roads, and by google_checked()
+# for the one-way streets it checks.
+results_table = ResultsTable(results_table_output, unique_id)
+
+# Segments with the same vertices as an earlier segment, or the same vertices in
+# reverse, reuse its requests instead of sending their own (see DuplicateGeometries
+# in OneWayValidation_Utils.py). The results table records which segment they copied.
+duplicates = DuplicateGeometries(duplicate_history(max_memory) if max_memory else None)
+
+def osrm_segment(i):
+	id = int(i['id'])
+	if osm_oneway is not None:
+		i['osm_way'] = osm_oneway.twoway_way(i['path'])
+		if i['osm_way'] is not None:
+			verdicts.set('osrm', id, TWOWAY)
+			return
+	
+	# Along and against Road Network Direction (see RoutingProvider in OneWayValidation_Utils.py).
+	# Segments with too few points (<=1) are SKIP, and failed requests ERROR.
+	verdicts.set('osrm', id, direction_provider.classify_direction([i])[0])
+
+#	  Snap to Roads --> Only segments OSRM identified as one-way, and whose OSRM confidence
+#						is neither clearly high nor clearly low, are submitted. The others
+#						keep their OSRM verdict.
+#					--> If the number of points returned != the number of points sent,
+#	  					then the road segment likely needs to be flipped. Or, if the 
+#						geometry of the route is too dissimilar from the snapped path 
+#						then the segment was snapped to the wrong road and can be 
+#						flagged as one-way because of improper routing. These signals
+#						are added to the OSRM confidence: segments that end up confident
+#						are marked FLIP, and segments that may need to be flipped are
+#						marked POTENTIAL_FLIP and should be manually reviewed in ArcGIS by the user.
+#	  				--> Some records are skipped because they are either too short or 
+#						are not present in Google Maps. Segments too short to send 
+#						are marked SKIP.
 
-@timeit
-def osrm(snap_list):
-	for i in snap_list:
-		id = int(i['id'])
-		if len(i['latlng'][1:-1]) <= 1:
-			#arcpy.AddMessage(str(id) + " skipped because too few points (<=1)")
-			osrm_skip.append(id)
-			continue
-		else: 
-			# Create URL request for Snap To Roads tool for each id.
-			snap_param = ''
-			for j in i['latlng'][1:-1]:
-				snap_param += str(j[1]) + "," + str(j[0])+ ";"
-			url = "http://router.project-osrm.org/route/v1/car/" + snap_param[:-1]
-			
-			snap_param = ''
-			for j in reversed(i['latlng'][1:-1]):
-				snap_param += str(j[1]) + "," + str(j[0])+ ";"
-			url_reverse = "http://router.project-osrm.org/route/v1/car/" + snap_param[:-1]
-			#arcpy.AddMessage("OSRM url request created")
+def snaptoroads_segment(i):
+	id = int(i['id'])
+	path = i['path']
+	
+	# In order to make sure the Snap to Roads request properly runs, no more than 
+	# 100 points can be submitted at the same time, so only the first 100 are sent
+	# (see GoogleRoadsProvider in OneWayValidation_Utils.py).
+	snapped_points = snap_provider.snap([i])[0]
+	if snapped_points in (SKIP, ERROR):
+		#message("id " + str(id) + " skipped because too few points (<=1), or failed")
+		verdicts.set('google', id, snapped_points)
+		return
+	if snapped_points is None:
+		#message("id " + str(id) + " skipped because segment not in Google Maps")
+		return
+	
+	n_sent, n_returned, snap_start, snap_end = snapped_points
+	#message("# of points recieved = " + str(n_returned))
+	i['point_mismatch'] = max(0, n_sent - n_returned) / float(n_sent)
+	if n_sent == n_returned:
+		# n_sent === n_returned, but need to verify that the path was snapped to the proper
+		# road, which is done by comparing geometries
+		lat_start = float(path[0][0])
+		lat_end = float(path[-1][0])
+		lng_start = float(path[0][1])
+		lng_end = float(path[-1][1])
+		
+		snap_lat_start, snap_lng_start = snap_start
+		snap_lat_end, snap_lng_end = snap_end
 		
-			# Along Road Network Direction:
-			try:
-				handle = urllib2.urlopen(url)
-				url_return = handle.read()
-				osm_route = json.loads(url_return)
-			except:
-				#arcpy.AddMessage("urllib2 error for " + str(id) +  " --> " + str(sys.exc_info()[0]))
-				osrm_error.append(id)
-				continue
-			
-			# Against Road Network Direction:
-			try:
-				handle = urllib2.urlopen(url_reverse)
-				url_return = handle.read()
-				osm_route_reverse = json.loads(url_return)
-			except:
-				#arcpy.AddMessage("urllib2 error for " + str(id) +  " --> " + str(sys.exc_info()[0]))
-				osrm_error.append(id)
-				continue
-			
-			if osm_route['routes'][0]['distance'] == osm_route_reverse['routes'][0]['distance']:
-				#arcpy.AddMessage(str(id) + " is Two-Way")
-				osrm_twoway.append(id)
-			elif osm_route['routes'][0]['distance'] > osm_route_reverse['routes'][0]['distance']:
-				arcpy.AddMessage(str(id) + " is One-Way, needs to be flipped")
-				osrm_oneway.append(id)
-				osrm_flip.append(id)
-			elif osm_route['routes'][0]['distance'] < osm_route_reverse['routes'][0]['distance']:
-				#arcpy.AddMessage(str(id) + " is One-Way, does not need to be flipped")
-				osrm_oneway.append(id)
-					
-	arcpy.AddMessage("OSRM API called for each unique ID")
-	arcpy.AddMessage("OSRM identified " + str(len(osrm_flip)) + " ids to flip")
-	arcpy.AddMessage("OSRM identified " + str(len(osrm_oneway)) + " one-way streets")
-	arcpy.AddMessage("OSRM identified " + str(len(osrm_twoway)) + " two-way streets")
-	arcpy.AddMessage("OSRM skipped " + str(len(osrm_skip) + len(osrm_error)) + " ids")
+		orig_distance = math.sqrt(math.pow(lat_end - lat_start, 2) + math.pow(lng_end - lng_start, 2))
+		snap_distance = math.sqrt(math.pow(snap_lat_end - lat_start, 2) + math.pow(snap_lng_end - lng_start, 2))
+		i['snap_distance_delta'] = abs(snap_distance - orig_distance)*100000
+						
+		dir_orig = calculate_initial_compass_bearing((lat_start, lng_start),(lat_end, lng_end))
+		dir_snap = calculate_initial_compass_bearing((snap_lat_start, snap_lng_start),(snap_lat_end, snap_lng_end))
+		i['bearing_delta'] = bearing_difference(dir_orig, dir_snap)
 	
-osrm(snap_list)
-
-#	  Snap to Roads --> If the number of points returned != the number of points sent,
-#	  					then the road segment needs to be flipped and the id is saved 
-#						in the "flip_ids" list. Or, if the geometry of the route is too
-#						dissimilar from the snapped path then the segment was snapped to
-#						the wrong road and can be flagged as one-way because of improper
-#						routing.
-#	  				--> Some records are skipped because they are either too short or 
-#						are not present in Google Maps. These ids are saved in the 
-#						"skipped_ids" list.
-#	  				--> Other road segments that may need to be flipped but were still 
-#						returned as snapped by the Snap To Roads service are saved in 
-#						the "potential_flip_ids" list and should be manually reviewed 
-#						in ArcGIS by the user.
-
-google_flip = []
-google_potential_flip = []
-google_skip = []
-google_error = []
+	i['confidence'] = flip_confidence(i)
+	verdicts.set('google', id, confidence_verdict(i['confidence']))
+
+#	  Pipeline -->	OSRM and Snap To Roads run at the same time: each segment queued for
+#					Snap To Roads goes to its workers as soon as OSRM has classified it,
+#					while OSRM carries on with the rest (see make_pipeline() in 
+#					OneWayValidation_Utils.py). osrm_segment() and snaptoroads_segment()
+#					run in worker threads; the functions below run one at a time, as
+#					each segment comes out of a stage, and write its results.
+#				-->	A segment with the same geometry as an earlier one waits for it
+#					and copies its results (see DuplicateGeometries).
+#				-->	No more than 2500 segments are sent to Snap To Roads, the daily 
+#					limit without a premium key. Any others keep their OSRM verdict.
+
+waiting_osrm = {}		# id --> [(duplicate, reversed)] waiting for its OSRM verdict
+waiting_google = {}		# id --> [identical duplicate] waiting for its Snap To Roads verdict
+checking = set()		# ids sent to Snap To Roads and not answered yet
+candidates = set()		# ids queued for Snap To Roads
+over_limit = []			# ids that would have been queued past the limit
+n_single = [0]			# ids classified with a single OSRM request
+n_prefiltered = [0]		# ids classified two-way from OSM tags
+# id --> [OSRM confidence, OSRM FLIP, sent to Snap To Roads, combined confidence] of every
+# one-way street, kept for the threshold sweep of a replayed run (see confidence_sweep()).
+sweep_measurements = {} if archive is not None and archive.replay else None
+
+# Writes the segment's row in the results table. Under a memory budget, its points are
+# dropped once that is done, and only a small record of what later segments may copy
+# from it is kept (see DuplicateGeometries.compact()).
+def finish(i, osrm_verdict, google_verdict = None):
+	results_table.add_segment(i, osrm_verdict, google_verdict)
+	if max_memory:
+		i.pop('latlng', None)
+		i.pop('path', None)
+		duplicates.compact(i)
+
+def osrm_classified(i):
+	id = int(i['id'])
+	verdict = verdicts.get('osrm', id)
+	osrm_progress.step(verdict == ERROR)
+	if verdict == FLIP:
+		message(str(id) + " is One-Way, needs to be flipped")
+	#elif verdict == TWOWAY:
+		#message(str(id) + " is Two-Way")
+	#elif verdict == ONEWAY:
+		#message(str(id) + " is One-Way, does not need to be flipped")
+	if i.get('distance') is not None and i.get('distance_reverse') is None:
+		n_single[0] += 1
+	if i.get('osm_way') is not None:
+		n_prefiltered[0] += 1
+	if sweep_measurements is not None and verdicts.is_oneway(id):
+		sweep_measurements[id] = [i['confidence'], verdict == FLIP, False, None]
+	
+	# Snap To Roads is only asked about one-way streets OSRM is unsure of.
+	if not verdicts.is_oneway(id) or not is_uncertain(i['confidence']):
+		finish(i, verdict)
+	elif len(candidates) >= 2500:
+		over_limit.append(id)
+		finish(i, verdict)
+	else:
+		candidates.add(id)
+		if sweep_measurements is not None:
+			sweep_measurements[id][2] = True
+		google_progress.total += 1
+		send_to_google(i)
+	
+	for duplicate, reversed in waiting_osrm.pop(id, []):
+		resolve_duplicate(i, duplicate, reversed)
+
+def resolve_duplicate(first, duplicate, reversed):
+	copied = duplicates.copy_osrm(first, duplicate, reversed, verdicts.get('osrm', int(first['id'])))
+	if copied is None:
+		pipeline.classify_later(duplicate)
+	else:
+		verdicts.set('osrm', int(duplicate['id']), copied)
+		osrm_classified(duplicate)
+
+def send_to_google(i):
+	id = int(i['id'])
+	first, reversed = duplicates.first_of(id)
+	if not reversed and int(first['id']) in checking:
+		waiting_google.setdefault(int(first['id']), []).append(i)
+		return
+	verdict = duplicates.copy_google(i, lambda id: verdicts.get('google', id))
+	if verdict is None:
+		checking.add(id)
+		pipeline.check_later(i)
+	else:
+		verdicts.set('google', id, verdict)
+		google_checked(i)
+
+def google_checked(i):
+	id = int(i['id'])
+	checking.discard(id)
+	verdict = verdicts.get('google', id)
+	google_progress.step(verdict == ERROR)
+	if verdict == FLIP:
+		message(str(id) + " is One-Way, needs to be flipped")
+	if sweep_measurements is not None and verdict in (FLIP, POTENTIAL_FLIP, OK):
+		sweep_measurements[id][3] = i['confidence']
+	finish(i, verdicts.get('osrm', id), verdict)
+	for duplicate in waiting_google.pop(id, []):
+		send_to_google(duplicate)
+
+pipeline = make_pipeline(osrm_segment, snaptoroads_segment, direction_provider.concurrency, snap_provider.concurrency)
 
 @timeit
-def snaptoroads(snap_list):
-	if len(snap_list) > 2500:
-		arcpy.AddMessage("List is greater than 2500 points. The Snap to Roads call will be skipped, please retry tool with less than 2500 road segments.")
-		return
-	else:	
-		for i in snap_list:
-			id = int(i['id'])
-			if id not in osrm_oneway or osrm_error:
-				#arcpy.AddMessage("id " + str(id) + " is either too short or a two-way street, do not need to submit through Snap to Roads")
-				continue
-			if len(i['latlng'][1:-1]) <= 1:
-				#arcpy.AddMessage("id " + str(id) + " skipped because too few points (<=1)")
-				google_skip.append(id)
-				continue
-			
-			# Create URL request for Snap To Roads tool for each id.
-			# In order to make sure the Snap to Roads request properly runs, no more than 
-			# 100 points can be submitted at the same time, hense the if/else statement and the cutoff.
-			snap_param = ''
-			if len(i['latlng']) > 102:
-				n_sent = 100
-				for j in i['latlng'][1:101]:
-					snap_param += str(j[0]) + "," + str(j[1])+ "|"
-			else: 
-				n_sent = len(i['latlng'][1:-1])
-				for j in i['latlng'][1:-1]:
-					snap_param += str(j[0]) + "," + str(j[1])+ "|"
-			url = "https://roads.googleapis.com/v1/snapToRoads?path=" + snap_param[:-1] + "&interpolate=false&key=" + key
-			#arcpy.AddMessage("Snap To Roads url request created")
-			
-			try:
-				handle = urllib2.urlopen(url)
-				url_return = handle.read()
-				snapped_points = json.loads(url_return)
-			except:
-				#arcpy.AddMessage("urllib2 error for " + str(id) +  " --> " + str(sys.exc_info()[0]))
-				google_error.append(id)
-				continue
-			
-			if len(snapped_points) != 1:
-				#arcpy.AddMessage("id " + str(id) + " skipped because segment not in Google Maps")
-				#skipped_ids.append(id)
-				continue
-			else:
-				n_returned = len(snapped_points['snappedPoints'])
-				#i['snapped_points'] = snapped_points['snappedPoints']
-				#arcpy.AddMessage("# of points recieved = " + str(n_returned))
-				if n_sent != n_returned:
-					arcpy.AddMessage(str(id) + " is One-Way, needs to be flipped")
-					google_flip.append(id)
-				else: 
-					# n_sent === n_returned, but need to verify that the path was snapped to the proper
-					# road, which is done by comparing geometries
-					lat_start = float(i['latlng'][1][0])
-					lat_end = float(i['latlng'][-2][0])
-					lng_start = float(i['latlng'][1][1])
-					lng_end = float(i['latlng'][-2][1])
-					
-					snap_lat_start = snapped_points['snappedPoints'][0]['location']['latitude']
-					snap_lat_end = snapped_points['snappedPoints'][-1]['location']['latitude']
-					snap_lng_start = snapped_points['snappedPoints'][0]['location']['longitude']
-					snap_lng_end = snapped_points['snappedPoints'][-1]['location']['longitude']
-					
-					orig_distance = math.sqrt(math.pow(lat_end - lat_start, 2) + math.pow(lng_end - lng_start, 2))
-					snap_distance = math.sqrt(math.pow(snap_lat_end - lat_start, 2) + math.pow(snap_lng_end - lng_start, 2))
-					if (abs(snap_distance - orig_distance)*100000) > 4:		# empirically derived
-						#arcpy.AddMessage("manually check id " + str(id) + " b/c snap distance is off")
-						google_potential_flip.append(id)	
-									
-					dir_orig = calculate_initial_compass_bearing((lat_start, lng_start),(lat_end, lng_end))
-					dir_snap = calculate_initial_compass_bearing((snap_lat_start, snap_lng_start),(snap_lat_end, snap_lng_end))
-					if (abs(dir_orig - dir_snap)) > 2:		# empirically derived
-						#arcpy.AddMessage("manually check id " + str(id) + " b/c snap orientation off")
-						if id in google_potential_flip:
-							# Both the orientation and direction are off, so the road was not properly snapped 
-							# and is a one-way street in wrong direction
-							google_flip.append(id)
-						else:
-							google_potential_flip.append(id)
+def validate(snap_list):
+	# Only the first segment of each geometry is classified to begin with. Duplicates of
+	# a segment classified in an earlier chunk copy its results straight away.
+	firsts = []
+	for i in snap_list:
+		first, reversed = duplicates.match(i)
+		if first is None:
+			firsts.append(i)
+		elif verdicts.get('osrm', int(first['id'])) is not None:
+			resolve_duplicate(first, i, reversed)
+		else:
+			waiting_osrm.setdefault(int(first['id']), []).append((i, reversed))
+	pipeline.run(firsts, osrm_classified, google_checked)
+
+def report_validation():
+	end_progress(osrm_progress)
+	message(google_progress.status(time.time()))
+	
+	message("OSRM API called for each unique ID")
+	message("OSRM identified " + str(verdicts.count('osrm', FLIP)) + " ids to flip")
+	message("OSRM identified " + str(verdicts.count('osrm', FLIP, ONEWAY)) + " one-way streets")
+	message("OSRM identified " + str(verdicts.count('osrm', TWOWAY)) + " two-way streets")
+	if single_call.lower() == 'yes':
+		message("OSRM identified " + str(verdicts.count('osrm', DRIVABLE)) + " streets drivable as digitized")
+		message("OSRM classified " + str(n_single[0]) + " ids with a single request")
+	if osm_oneway is not None:
+		message("OSM tags identified " + str(n_prefiltered[0]) + " of the two-way streets, which were not sent to OSRM")
+	message("OSRM skipped " + str(verdicts.count('osrm', SKIP, ERROR)) + " ids")
+	message(str(duplicates.n_duplicates) + " ids share an identical or reversed geometry with another id, " + str(duplicates.osrm_saved) + " OSRM requests saved")
+	for line in osrm_backend.report():
+		message(line)
 	
-	arcpy.AddMessage("Snap To Roads called for each unique ID")
-	arcpy.AddMessage("Snap To Roads identified " + str(len(google_flip)) + " ids to flip")
-	arcpy.AddMessage("Snap To Roads identified " + str(len(google_potential_flip)) + " ids to manually check")
-	arcpy.AddMessage("Snap To Roads skipped " + str(len(google_skip)) + " ids")
-
-snaptoroads(snap_list):
-
-# 10) Export lists of ids to JSON, save object as txt file
-results = {
-	'flip' 		: [],
-	'skip' 		: osrm_skip + google_skip,
-	'oneway'	: osrm_oneway,
-	'twoway' 	: osrm_twoway,
-	'error' 	: osrm_skip + google_error,
-}
-
-results['flip'] = google_flip
-for i in osrm_flip:
-	if i not in google_flip:
-		google_flip.append(i)
+	if over_limit:
+		message("More than 2500 segments needed to be checked. " + str(len(over_limit)) + " were not sent to Snap to Roads and keep their OSRM verdict, please retry tool with less than 2500 road segments.")
+	message("Snap To Roads called for " + str(len(candidates)) + " of " + str(verdicts.count('osrm', FLIP, ONEWAY)) + " one-way streets, the rest were decided by OSRM")
+	message("Snap To Roads identified " + str(verdicts.count('google', FLIP)) + " ids to flip")
+	message("Snap To Roads identified " + str(verdicts.count('google', POTENTIAL_FLIP)) + " ids to manually check")
+	message("Snap To Roads skipped " + str(verdicts.count('google', SKIP)) + " ids")
+	message(str(duplicates.google_saved) + " Snap To Roads requests saved by reusing results for identical geometries")
+	for line in google_backend.report():
+		message(line)
+
+# Progress is shown for OSRM, which every segment goes through. Snap To Roads progress
+# is reported when the run ends, since the number of segments it gets is not known before.
+osrm_progress = start_progress("OSRM", 0)
+google_progress = ProgressReporter("Snap To Roads", 0, lambda status, percent: None)
+for chunk in chunks:
+	osrm_progress.total += len(chunk)
+	if not max_memory:
+		validate(chunk)
+		continue
+	validate(spatial_order(chunk))
+	resident = resident_memory()
+	if resident is not None and resident - memory_baseline > max_memory * 2 ** 20 and chunks.max_vertices > 1000:
+		chunks.max_vertices = max(1000, chunks.max_vertices // 2)
+		message("Memory use of %.1f MB since the start is over the budget, chunks reduced to %d points" % ((resident - memory_baseline) / 2.0 ** 20, chunks.max_vertices))
+infile.close()
+if archive is not None:
+	archive.close()
+report_validation()
+
+# 10) Export lists of ids to JSON, save object as txt file. See SegmentVerdicts.merged()
+#	  in OneWayValidation_Utils.py for how the OSRM and Snap To Roads verdicts are combined.
+results = verdicts.merged()
 
 with open(flip_ids_txt, 'w') as outfile:
 	json.dump(results, outfile)
+results_table.close()
 	
-arcpy.AddMessage("Wrongly digitized polyline segments to saved: " + flip_ids_txt)
-arcpy.AddMessage("Total number of routes to flip = " + str(len(results['flip'])))
+message("Wrongly digitized polyline segments to saved: " + flip_ids_txt)
+message(results_table.status())
+message("Total number of routes to flip = " + str(len(results['flip'])))
+
+# 10b) Threshold sweep (replay only): flip and potential flip counts for every combination
+#	   of uncertain band and flip and review confidence, from the one-way streets measured 
+#	   above. One-way streets that neither are left as one-way; those a wider band would
+#	   send to Snap To Roads, but that were not sent in the recorded run, are unrecorded.
+if sweep_measurements is not None:
+	measured = list(sweep_measurements.values())
+	message(str(len(archive)) + " recorded responses replayed from " + response_archive + ", no API calls made")
+	message("Threshold sweep (uncertain band, flip, review --> flip, potential flip, one-way, unrecorded):")
+	with open_csv(threshold_sweep_txt, 'w') as f:
+		w = csv.writer(f, delimiter=',')
+		w.writerow(['uncertain_low', 'uncertain_high', 'flip_confidence', 'review_confidence', 'flip', 'potential_flip', 'oneway', 'unrecorded'])
+		for band, flip_threshold, review_threshold, n_flip, n_potential, n_unrecorded in confidence_sweep(measured):
+			row = [band[0], band[1], flip_threshold, review_threshold, n_flip, n_potential, len(measured) - n_flip - n_potential - n_unrecorded, n_unrecorded]
+			w.writerow(row)
+			message("  " + str(row[0]) + "-" + str(row[1]) + ", >= " + str(row[2]) + ", >= " + str(row[3]) + " --> " + ", ".join(str(n) for n in row[4:]))
+	message("Threshold sweep saved: " + threshold_sweep_txt)
+elif archive is not None:
+	message("OSRM and Snap To Roads responses recorded: " + response_archive)
+if memory is not None:
+	message(memory.status("saving results"))
+	memory.stop()
 		
 # ---------------------------------------------------------------------------
 
-# 12) Select Layer By Attribute, Flip Lines (optional)
-flip_ids_str = ''
-if flip_routes.lower() == 'yes':
-	for i in results['flip']:
-		flip_ids_str += (str(i) + ",")
-	if len(flip_ids_str) > 0:
-		arcpy.SelectLayerByAttribute_management(
-			in_layer_or_view = 'road_seg_working', 
-			selection_type = "NEW_SELECTION", 
-			where_clause = unique_id + " IN (" + flip_ids_str[:-1] + ")"
-		)
-		arcpy.FlipLine_edit(
-			in_features = 'road_seg_working'
-		)
-		arcpy.AddMessage(str(len(results['flip'])) + " wrongly digitized polyline segments flipped to proper direction.")
-
-# 13) Reclassify Street Operation Attribute Field (optional)
-if reclassify.lower() == 'yes':
-	twoway_streets_str = ''
-	for i in results['twoway']:
-		twoway_streets_str += (str(i) + ",")
-	arcpy.SelectLayerByAttribute_management(
-		in_layer_or_view = 'road_seg_working', 
-		selection_type = "NEW_SELECTION", 
-		where_clause = unique_id + " IN (" + twoway_streets_str[:-1] + ")"
-	)
-	arcpy.CalculateField_management("road_seg_working","STREETOPERATION",2,"PYTHON_9.3")
-		
-	oneway_streets_str = ''
-	for i in results['oneway']:
-		oneway_streets_str += (str(i) + ",")
-	arcpy.SelectLayerByAttribute_management(
-		in_layer_or_view = 'road_seg_working', 
-		selection_type = "NEW_SELECTION", 
-		where_clause = unique_id + " IN (" + oneway_streets_str[:-1] + ")"
+if not headless:
+	# 11) Stage changes: one row per unique id with 'flip' (1 if the polyline is reversed) and
+	#	  'streetoperation' (1 = one-way, 2 = two-way, null if left as is). The table stays in
+	#	  the working geodatabase, so the changes can be joined to the road network and reviewed.
+	changes = staged_changes(
+		results['flip'] if flip_routes.lower() == 'yes' else (),
+		results['twoway'] if reclassify.lower() == 'yes' else (),
+		results['oneway'] if reclassify.lower() == 'yes' else ()
 	)
-	arcpy.CalculateField_management("road_seg_working","STREETOPERATION",1,"PYTHON_9.3")
+	staging_table = stage_changes(working_gdb, staging_name, unique_id, changes)
+	message(str(len(changes)) + " changes staged: " + staging_table)
+
+	# 12) Flip Lines and Reclassify Street Operation Attribute Field (optional)
+	#	  Every working feature class is updated from the staging table in one pass, in a 
+	#	  single edit session (see apply_staged_changes() in OneWayValidation_Utils.py).
+	n_flipped, n_reclassified = apply_staged_changes(working_gdb, working_fcs, staging_table, unique_id, reclassify.lower() == 'yes')
+
+	if flip_routes.lower() == 'yes':
+		message(str(n_flipped) + " wrongly digitized polyline segments flipped to proper direction.")
+	if reclassify.lower() == 'yes':
+		message(str(n_reclassified) + " polyline segments reclassified as one-way or two-way.")
 		
 # ---------------------------------------------------------------------------
@@ -0,0 +1,81 @@
+# ---------------------------------------------------------------------------
+#
+# File Name:
+#	OneWayValidation_Benchmark.py
+#
+# Created by:
+#	Ethan Ebinger
+#
+# Description:
+# 	Compares routing engines on the same road segments, to choose which locally
+#	hosted engine to send production load to. Reads the CSV of (lon,lat) points
+#	exported by an earlier run (Step 5 of OneWayValidation.py), classifies the
+#	same segments with every provider given, each with its own batching and
+#	concurrency (see RoutingProvider in OneWayValidation_Utils.py), and reports
+#	throughput, request latency, errors, and how often each engine agrees with
+#	the first one given:
+#
+#		python OneWayValidation_Benchmark.py <points csv> <unique id>
+#			osrm=http://localhost:5000/route/v1/car/ valhalla=http://localhost:8002/ graphhopper=http://localhost:8989/
+#
+# ---------------------------------------------------------------------------
+
+import argparse
+import csv
+import time
+from multiprocessing.pool import ThreadPool
+from OneWayValidation_Utils import make_provider, RoutingBackend, ERROR
+from OneWayValidation_Utils import spatial_order, spatial_batches, read_segments, EndpointIndex
+from OneWayValidation_Utils import message, open_csv
+
+def percentile(values, share):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(share * len(values)))] if values else 0.0
+
+def benchmark(provider, snap_list, concurrency = None):
+	# Classifies copies of the segments in batches of provider.batch_size, with
+	# provider.concurrency batches at a time. Returns {id: verdict} and a summary line.
+	segments = [{'id': segment['id'], 'path': segment['path']} for segment in snap_list]
+	workers = concurrency or provider.concurrency
+	pool = ThreadPool(workers)
+	start = time.time()
+	try:
+		batches = list(spatial_batches(segments, provider.batch_size))
+		verdicts = [verdict for batch in pool.map(provider.classify_direction, batches) for verdict in batch]
+	finally:
+		pool.close()
+		pool.join()
+	elapsed = max(time.time() - start, 1e-6)
+	seconds = [segment.get(provider.seconds_key) or 0.0 for segment in segments]
+	stats = provider.backend.stats
+	line = provider.name + ": %d segments in %.1fs (%.1f/s) with %d workers, %d requests, " % (len(segments), elapsed, len(segments) / elapsed, workers, stats['requests'])
+	line += "%.0f ms median, %.0f ms p95 per segment, %d errors" % (1000 * percentile(seconds, 0.5), 1000 * percentile(seconds, 0.95), verdicts.count(ERROR))
+	return dict((segment['id'], verdict) for segment, verdict in zip(segments, verdicts)), line
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = "Benchmark routing engines on the same road segments.")
+	parser.add_argument('points_csv', help = "CSV of (lon,lat) points exported by Step 5 of OneWayValidation.py")
+	parser.add_argument('unique_id', help = "unique identifier field of the road network")
+	parser.add_argument('providers', nargs = '+', help = "name=url of each engine (osrm, valhalla or graphhopper); the url may be left out")
+	parser.add_argument('--segments', type = int, default = 1000, help = "segments to classify with each engine")
+	parser.add_argument('--concurrency', type = int, help = "workers for every engine instead of its own setting")
+	args = parser.parse_args()
+
+	with open_csv(args.points_csv) as infile:
+		snap_list = spatial_order(list(read_segments(csv.DictReader(infile), args.unique_id)))
+	ends = EndpointIndex(snap_list)
+	snap_list = [ends.trim(segment) for segment in snap_list[:args.segments]]
+	message("Benchmarking " + str(len(snap_list)) + " segments")
+
+	baseline = None
+	for spec in args.providers:
+		name, _, url = spec.partition('=')
+		provider = make_provider(name, RoutingBackend(name), url or None)
+		verdicts, line = benchmark(provider, snap_list, args.concurrency)
+		message(line)
+		if baseline is None:
+			baseline = (provider.name, verdicts)
+			continue
+		compared = [id for id in verdicts if verdicts[id] != ERROR and baseline[1].get(id) != ERROR]
+		agree = sum(1 for id in compared if verdicts[id] == baseline[1][id])
+		message("	agrees with " + baseline[0] + " on %d of %d segments (%.1f%%)" % (agree, len(compared), 100.0 * agree / len(compared) if compared else 0.0))
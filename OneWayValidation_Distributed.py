@@ -0,0 +1,369 @@
+# ---------------------------------------------------------------------------
+#
+# File Name:
+#	OneWayValidation_Distributed.py
+#
+# Created by:
+#	Ethan Ebinger
+#
+# Description:
+# 	Coordinator/worker mode for the OSRM classification of OneWayValidation.py,
+#	for road inventories too large for one host. The coordinator reads the CSV of
+#	(lon,lat) points exported by an earlier run (Step 5), splits the segments into
+#	leases of neighbouring segments and serves them from a lease board. Workers,
+#	on the same host or any other, pull one lease at a time, classify it against
+#	the OSRM server nearest to them and send the results back as each lease is
+#	done. The coordinator writes the same flip ids JSON (Step 10) and per-segment
+#	results table as OneWayValidation.py.
+#
+#	The lease board is served with the multiprocessing.managers module, so there
+#	is no broker to install. On one host, the coordinator starts its own workers:
+#
+#		python OneWayValidation_Distributed.py coordinator <points csv> <unique id> <output folder> <name> --local-workers 4
+#
+#	The board only listens on 127.0.0.1 unless it is given another --address. The
+#	managers exchange pickles, so anyone holding the key can run code on the
+#	coordinator: without --authkey, a random key is made and printed, and workers
+#	on other hosts connect with it:
+#
+#		python OneWayValidation_Distributed.py coordinator ... --address 0.0.0.0:50050
+#		python OneWayValidation_Distributed.py worker <coordinator host>:50050 --authkey <key> --processes 4
+#			--endpoints http://osrm-east:5000/route/v1/car/ http://osrm-west:5000/route/v1/car/
+#
+#	Snap To Roads is not called: its quota belongs to the API key, not to a host,
+#	so spreading its requests over workers does not make them go any faster.
+#
+# ---------------------------------------------------------------------------
+
+import argparse
+import binascii
+import collections
+import csv
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from multiprocessing.managers import BaseManager
+from OneWayValidation_Utils import OsrmProvider, RoutingBackend, OSRM_ROUTE_URL
+from OneWayValidation_Utils import SegmentVerdicts, ERROR, TWOWAY
+from OneWayValidation_Utils import ResultsTable, results_table_path
+from OneWayValidation_Utils import spatial_order, spatial_batches, read_segments, EndpointIndex, OsmOnewayIndex
+from OneWayValidation_Utils import ProgressReporter
+from OneWayValidation_Utils import message, open_csv, Queue, Empty
+
+try:
+	from urlparse import urlsplit
+except ImportError:
+	from urllib.parse import urlsplit
+
+LEASE_SEGMENTS = 200			# segments per lease
+LEASE_SECONDS = 300.0			# a lease not completed in this time is handed out again
+WORKER_POLL = 1.0				# seconds a worker waits while every lease is out
+RESULTS_POLL = 5.0				# seconds the coordinator waits for results before checking its workers
+ENDPOINT_PROBES = 3				# TCP connects timed per OSRM endpoint
+ENDPOINT_TIMEOUT = 2.0			# seconds
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 50050
+
+# ---------------------------------------------------------------------------
+
+# The lease board. Every lease is a list of segments (ids and the points to send only):
+#
+#	pending		--> leases not handed out yet, or handed out and expired
+#				(the worker holding it stopped or lost its connection).
+#	out		--> leases a worker is classifying. Once nothing is pending,
+#				an idle worker is handed the oldest lease still out a
+#				second time, so one slow worker does not hold up the end
+#				of the run.
+#	complete	--> the first results sent back for a lease are kept and
+#				put on 'results'; later copies are dropped.
+
+class LeaseBoard(object):
+	def __init__(self, leases, lease_seconds = LEASE_SECONDS):
+		self.lease_seconds = lease_seconds
+		self.results = Queue()
+		self.reassigned = 0
+		self.stolen = 0
+		self._leases = dict(enumerate(leases))
+		self._pending = collections.deque(sorted(self._leases))
+		self._out = {}			# lease number --> (worker, expiry)
+		self._stolen = set()
+		self._contact = time.time()
+		self._lock = threading.Lock()
+
+	def lease(self, worker):
+		# Returns (lease number, segments), (None, None) while every lease left
+		# is out, or (-1, None) once every lease is complete.
+		with self._lock:
+			now = self._contact = time.time()
+			if not self._leases:
+				return -1, None
+			for number, (holder, expiry) in list(self._out.items()):
+				if expiry <= now:
+					del self._out[number]
+					self._pending.append(number)
+					self.reassigned += 1
+			if self._pending:
+				number = self._pending.popleft()
+			else:
+				others = [n for n in self._out if n not in self._stolen and self._out[n][0] != worker]
+				if not others:
+					return None, None
+				number = min(others, key = lambda n: self._out[n][1])
+				self._stolen.add(number)
+				self.stolen += 1
+			self._out[number] = (worker, now + self.lease_seconds)
+			return number, self._leases[number]
+
+	def complete(self, number, worker, results):
+		# Returns False if another worker completed the lease first.
+		with self._lock:
+			self._contact = time.time()
+			if self._leases.pop(number, None) is None:
+				return False
+			self._out.pop(number, None)
+			if number in self._pending:
+				self._pending.remove(number)
+			self.results.put((number, worker, results))
+		return True
+
+	def remaining(self):
+		with self._lock:
+			return len(self._leases)
+
+	def idle(self):
+		# Seconds since any worker last asked for or completed a lease.
+		with self._lock:
+			return time.time() - self._contact
+
+class LeaseManager(BaseManager):
+	pass
+
+def parse_address(address):
+	host, _, port = address.rpartition(':')
+	return (host or DEFAULT_HOST, int(port) if port else DEFAULT_PORT)
+
+def local_address(address):
+	# Where workers on this host reach a board served on 'address'.
+	host, port = address
+	return ('localhost' if host in ('', '0.0.0.0') else host, port)
+
+# ---------------------------------------------------------------------------
+
+# Workers.
+
+def nearest_endpoint(endpoints):
+	# The OSRM route service with the fastest TCP connect from this host, which
+	# stands in for network distance. Endpoints that cannot be reached are left out.
+	best = None
+	for url in endpoints:
+		parts = urlsplit(url)
+		port = parts.port or (443 if parts.scheme == 'https' else 80)
+		for probe in range(ENDPOINT_PROBES):
+			start = time.time()
+			try:
+				socket.create_connection((parts.hostname, port), ENDPOINT_TIMEOUT).close()
+			except (socket.error, socket.timeout):
+				break
+			elapsed = time.time() - start
+			if best is None or elapsed < best[0]:
+				best = (elapsed, url)
+	return best[1] if best else None
+
+def classify_lease(segments, provider):
+	# The segments arrive as copies, so the provider saves its measurements on them;
+	# their points are dropped before they are sent back.
+	for segment, verdict in zip(segments, provider.classify_direction(segments)):
+		del segment['path']
+		segment['osrm_verdict'] = verdict
+	return segments
+
+def failed_lease(segments):
+	for segment in segments:
+		segment.pop('path', None)
+		segment['osrm_verdict'] = ERROR
+	return segments
+
+def run_worker(address, authkey, endpoints = (), single_call = False, need_oneway = True):
+	manager = LeaseManager(address = address, authkey = authkey.encode())
+	LeaseManager.register('board')
+	manager.connect()
+	board = manager.board()
+	worker = socket.gethostname() + ':' + str(os.getpid())
+	base_url = nearest_endpoint(endpoints) if endpoints else None
+	if endpoints and base_url is None:
+		message(worker + ": no OSRM endpoint could be reached, using " + endpoints[0])
+		base_url = endpoints[0]
+	message(worker + ": classifying against " + (base_url or OSRM_ROUTE_URL))
+	provider = OsrmProvider(RoutingBackend('OSRM', hedge_after = 2.0), base_url, single_call, need_oneway)
+	n_leases = 0
+	while True:
+		try:
+			number, segments = board.lease(worker)
+		except (EOFError, IOError, OSError):
+			message(worker + ": lost the coordinator")
+			break
+		if number == -1:
+			break
+		if number is None:
+			time.sleep(WORKER_POLL)
+			continue
+		# A lease that cannot be classified is sent back as errors, so one bad lease
+		# neither stops the worker nor keeps coming back to the next one.
+		try:
+			segments = classify_lease(segments, provider)
+		except Exception as error:
+			message(worker + ": lease " + str(number) + " failed, its segments are marked as errors: " + repr(error))
+			segments = failed_lease(segments)
+		try:
+			board.complete(number, worker, segments)
+		except (EOFError, IOError, OSError):
+			# The coordinator stopped; any lease held is handed out again if it is still running.
+			message(worker + ": lost the coordinator")
+			break
+		n_leases += 1
+	message(worker + ": " + str(n_leases) + " leases classified")
+
+def start_workers(n_processes, address, authkey, endpoints, single_call, need_oneway):
+	processes = []
+	for n in range(n_processes):
+		process = multiprocessing.Process(target = run_worker, args = (address, authkey, endpoints, single_call, need_oneway))
+		process.daemon = True
+		process.start()
+		processes.append(process)
+	return processes
+
+# ---------------------------------------------------------------------------
+
+# Coordinator.
+
+def show_progress(status, percent):
+	message(status)
+
+def run_coordinator(points_csv, unique_id, output_folder, name, address, authkey,
+		lease_segments = LEASE_SEGMENTS, lease_seconds = LEASE_SECONDS, local_workers = 0,
+		endpoints = (), single_call = False, need_oneway = True, osm_extract = None):
+	# Segments are ordered along a Hilbert curve before they are split, so each lease
+	# covers one neighbourhood of the road network (see spatial_order() in OneWayValidation_Utils.py).
+	# Workers are sent only the points left once intersections are cut off the ends (see
+	# EndpointIndex in OneWayValidation_Utils.py).
+	with open_csv(points_csv) as infile:
+		snap_list = spatial_order(list(read_segments(csv.DictReader(infile), unique_id)))
+	ends = EndpointIndex(snap_list)
+	for segment in snap_list:
+		del ends.trim(segment)['latlng']
+	n_segments = len(snap_list)
+	
+	# With an OSM extract, segments on clearly two-way OSM ways are classified here and
+	# never leased (see OsmOnewayIndex in OneWayValidation_Utils.py).
+	prefiltered = []
+	if osm_extract:
+		osm_oneway = OsmOnewayIndex(osm_extract)
+		message(str(osm_oneway.n_ways) + " drivable ways read from " + osm_extract + ", " + str(osm_oneway.n_oneway) + " of them one-way")
+		candidates = []
+		for segment in snap_list:
+			segment['osm_way'] = osm_oneway.twoway_way(segment['path'])
+			if segment['osm_way'] is None:
+				candidates.append(segment)
+			else:
+				del segment['path']
+				prefiltered.append(segment)
+		snap_list = candidates
+		message("OSM tags identified " + str(len(prefiltered)) + " two-way streets, " + str(len(snap_list)) + " segments left for OSRM")
+	board = LeaseBoard(list(spatial_batches(snap_list, lease_segments)), lease_seconds)
+	del snap_list
+
+	LeaseManager.register('board', callable = lambda: board)
+	if not authkey:
+		authkey = binascii.hexlify(os.urandom(16)).decode()
+		message("Workers connect with --authkey " + authkey)
+	server = LeaseManager(address = address, authkey = authkey.encode()).get_server()
+	thread = threading.Thread(target = server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	message("Serving " + str(board.remaining()) + " leases of up to " + str(lease_segments) + " segments on " + str(server.address[0]) + ":" + str(server.address[1]))
+
+	workers = start_workers(local_workers, local_address(server.address), authkey, endpoints, single_call, need_oneway)
+
+	# Results are written as each lease comes back, in the same form as Steps 9-10 of
+	# OneWayValidation.py with no Snap To Roads verdicts.
+	verdicts = SegmentVerdicts()
+	results_table_output = results_table_path(output_folder, name)
+	results_table = ResultsTable(results_table_output, unique_id)
+	progress = ProgressReporter("OSRM", n_segments, show_progress)
+	for segment in prefiltered:
+		verdicts.set('osrm', segment['id'], TWOWAY)
+		results_table.add_segment(segment, TWOWAY)
+		progress.step()
+	# The run stops with an error once no local worker is running and no worker has
+	# asked for a lease for longer than a lease lasts.
+	by_worker = collections.Counter()
+	while board.remaining() or not board.results.empty():
+		try:
+			number, worker, segments = board.results.get(timeout = RESULTS_POLL)
+		except Empty:
+			if not any(process.is_alive() for process in workers) and board.idle() > lease_seconds:
+				raise RuntimeError("No workers left with " + str(board.remaining()) + " leases to classify")
+			continue
+		by_worker[worker] += len(segments)
+		for segment in segments:
+			verdict = segment.pop('osrm_verdict')
+			verdicts.set('osrm', segment['id'], verdict)
+			results_table.add_segment(segment, verdict)
+			progress.step(verdict == ERROR)
+	progress.finish()
+	for process in workers:
+		process.join()
+
+	results = verdicts.merged()
+	flip_ids_txt = os.path.join(output_folder, name + "_flip_ids.txt")
+	with open(flip_ids_txt, 'w') as outfile:
+		json.dump(results, outfile)
+	results_table.close()
+
+	for worker in sorted(by_worker):
+		message(worker + " classified " + str(by_worker[worker]) + " segments")
+	message(str(board.reassigned) + " expired leases handed out again, " + str(board.stolen) + " handed to a second worker")
+	message("Wrongly digitized polyline segments to saved: " + flip_ids_txt)
+	message(results_table.status())
+	message("Total number of routes to flip = " + str(len(results['flip'])))
+	return results
+
+# ---------------------------------------------------------------------------
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = "Distributed OSRM classification of road segments.")
+	roles = parser.add_subparsers(dest = 'role')
+	coordinator = roles.add_parser('coordinator', help = "split the segments into leases and collect the results")
+	coordinator.add_argument('points_csv', help = "CSV of (lon,lat) points exported by Step 5 of OneWayValidation.py")
+	coordinator.add_argument('unique_id', help = "unique identifier field of the road network")
+	coordinator.add_argument('output_folder', help = "folder where the flip ids and results table are saved")
+	coordinator.add_argument('name', help = "name of the outputs, as the working feature class")
+	coordinator.add_argument('--address', default = DEFAULT_HOST + ':' + str(DEFAULT_PORT), help = "host:port the lease board is served on; 0.0.0.0:port for workers on other hosts")
+	coordinator.add_argument('--authkey', help = "shared with the workers; a random key is made and printed if none is given")
+	coordinator.add_argument('--lease-segments', type = int, default = LEASE_SEGMENTS)
+	coordinator.add_argument('--lease-seconds', type = float, default = LEASE_SECONDS)
+	coordinator.add_argument('--local-workers', type = int, default = 0, help = "worker processes to start on this host")
+	worker = roles.add_parser('worker', help = "classify leases from a coordinator")
+	worker.add_argument('address', help = "host:port of the coordinator")
+	worker.add_argument('--processes', type = int, default = 1, help = "worker processes to start")
+	worker.add_argument('--authkey', required = True, help = "the key printed by the coordinator")
+	for role in (coordinator, worker):
+		role.add_argument('--endpoints', nargs = '*', default = [], help = "OSRM route services; each worker uses the nearest")
+		role.add_argument('--single-call', action = 'store_true', help = "see Single Call in OneWayValidation.py")
+		role.add_argument('--reclassify', action = 'store_true', help = "see Reclassify Street Operation in OneWayValidation.py")
+	coordinator.add_argument('--osm-extract', help = "OSM extract whose oneway tags decide clearly two-way segments")
+	args = parser.parse_args()
+
+	if args.role == 'coordinator':
+		run_coordinator(args.points_csv, args.unique_id, args.output_folder, args.name, parse_address(args.address),
+			args.authkey, args.lease_segments, args.lease_seconds, args.local_workers,
+			args.endpoints, args.single_call, args.reclassify, args.osm_extract)
+	elif args.role == 'worker':
+		for process in start_workers(args.processes, parse_address(args.address), args.authkey,
+				args.endpoints, args.single_call, args.reclassify):
+			process.join()
+	else:
+		parser.print_help()
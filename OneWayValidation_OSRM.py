@@ -24,33 +24,47 @@
 # ---------------------------------------------------------------------------
 
 # 0) Import modules, local variables and input parameters:
-import arcpy
 import csv
-import json
-import urllib2
-import sys
+import os
+from OneWayValidation_Utils import make_provider
+from OneWayValidation_Utils import RoutingBackend
+from OneWayValidation_Utils import ResultsTable, results_table_path, FLIP, ONEWAY, TWOWAY, SKIP, ERROR
+from OneWayValidation_Utils import spatial_order, EndpointIndex, OsmOnewayIndex
+from OneWayValidation_Utils import project_transform
+from OneWayValidation_Utils import staged_changes, stage_changes, apply_staged_changes
+from OneWayValidation_Utils import parameter, message, open_csv
+
+# A CSV of (lon,lat) points exported by Step 7 of an earlier run. If given, Steps 1-7
+# and the edits in Step 12 are skipped and arcpy is never imported, so the segments
+# can be classified again from a plain Python installation. The parameters are given 
+# in the same order as the script tool's, e.g.:
+#	python OneWayValidation_OSRM.py "" "" <working fc> <unique id> ... <output folder> ... <cached csv>
+cached_vertices = parameter(14)
+headless = cached_vertices not in ('', '#')
+if not headless:
+	import arcpy
 
 # The road network to validate. Must be a polyline feature class.
 # Input is used only for road segment selection, geoprocessing is not done on this feature class.
-road_network = arcpy.GetParameterAsText(0)
+road_network = parameter(0)
 
 # The working geodatabase, where feature classes created are saved.
-working_gdb = arcpy.GetParameterAsText(1)
+working_gdb = parameter(1)
 
 # The name of the feature class created in the working geodatabase that geoprocessing is done on. 
 # If the option to flip wrongly digitized routes is set to 'Yes', then this is the feature class 
 # in which FlipLines_Edit is run on.
-working_fc = arcpy.GetParameterAsText(2)
+working_fc = parameter(2)
 
 # The unique identifier for road segments in the Road Network feature class. 
 # Used to select (and, if selected, flip) polylines in the Working Feature Class.
-unique_id = arcpy.GetParameterAsText(3)
+unique_id = parameter(3)
 	
 # SQL Expression used to select specific road segments in the Working Feature Class, 
 # which will be submitted to Open Street Maps . 
 # This parameter is optional. Leave blank if no selection by attribute is desired,
 # as this tool can identify one-way streets and does not need the SQL Expression to run.
-street_select_expression = arcpy.GetParameterAsText(4)
+street_select_expression = parameter(4)
 
 # Distance (in meters) at which to Densify polyline segments.
 # It is recommended to use in combination with the SQL Expression, and call
@@ -58,14 +72,14 @@ street_select_expression = arcpy.GetParameterAsText(4)
 #	if Length >= 30: densify_distance = 10 Meters
 #	if Length < 30 and Length >= 10: densify_distance = 5 Meters
 # 	if Length < 10: densify_distance = 1 Meter
-densify_distance = arcpy.GetParameterAsText(5)
+densify_distance = parameter(5)
 
 # File name for the output of Step 4:
-fc_Densify_VertPoints = arcpy.GetParameterAsText(6)
+fc_Densify_VertPoints = parameter(6)
 fc_Densify_VertPoints = working_gdb + '\\' + working_fc + '_Densify_VertPoints'
 
 # File name for the output of Step 5:
-fc_Densify_VertPoints_Project = arcpy.GetParameterAsText(7)
+fc_Densify_VertPoints_Project = parameter(7)
 fc_Densify_VertPoints_Project = fc_Densify_VertPoints + '_WGS84'
 
 # The names of the fields to be exported to a CSV (saved as a .txt file). 
@@ -75,21 +89,27 @@ fc_Densify_VertPoints_Project = fc_Densify_VertPoints + '_WGS84'
 #		Unique identifier (i.e. ROADINVENTORY_ID)
 #		POINT_X
 #		POINT_Y
-Value_Field = arcpy.GetParameterAsText(8)
+Value_Field = parameter(8)
 if Value_Field == '#' or not Value_Field:
     Value_Field = unique_id + ";POINT_X;POINT_Y"
 
 # The pathname of the folder where CSVs generated from this script, 
 # including a .txt file with the unique ids of road segments to flip, will be saved.
-flip_ids_output = arcpy.GetParameterAsText(9)
+flip_ids_output = parameter(9)
 
 # File name for the TXT output of Step 6:
-csv_output = arcpy.GetParameterAsText(10)
-csv_output = flip_ids_output + '\\' + working_fc + '_WGS84_addXY.txt'
+csv_output = parameter(10)
+csv_output = os.path.join(flip_ids_output, working_fc + '_WGS84_addXY.txt')
+if headless:
+	csv_output = cached_vertices
 
 # File name for the output of Step 11:
-flip_ids_txt = arcpy.GetParameterAsText(11)
-flip_ids_txt = flip_ids_output + '\\' + working_fc + "_flip_ids.txt"
+flip_ids_txt = parameter(11)
+flip_ids_txt = os.path.join(flip_ids_output, working_fc + "_flip_ids.txt")
+
+# Per-segment results table (verdicts, route distances and timings), saved next to 
+# the flip ids as a Parquet file if pyarrow is installed, or as a GeoPackage table otherwise.
+results_table_output = results_table_path(flip_ids_output, working_fc)
 
 # Do you wish to flip the directionality of incorrectly digitized road segments automatically?
 # If 'Yes', unique segments identified by the Snap To Roads tool as being digitized 
@@ -97,73 +117,87 @@ flip_ids_txt = flip_ids_output + '\\' + working_fc + "_flip_ids.txt"
 # will be flipped (using FlipLines_Edit: http://desktop.arcgis.com/en/arcmap/10.3/tools/editing-toolbox/flip-line.htm) 
 # in the Working Feature Class.
 # Else, change field to 'No' to skip processes of flipping polylines for now.
-flip_routes = arcpy.GetParameterAsText(12)
+flip_routes = parameter(12)
 if flip_routes == '#' or not flip_routes:
     flip_routes = 'Yes'
 
 # Reclassify road segments as 1-way and 2-way based on OSRM return?
-reclassify = arcpy.GetParameterAsText(13)
+reclassify = parameter(13)
 if reclassify == '#' or not reclassify:
     reclassify = 'No'
 
+# An OSM extract (.osm, .osm.gz or .osm.bz2) covering the road network. Optional. If given,
+# segments its oneway tags show to be clearly two-way are classified as two-way without
+# OSRM requests, and only the rest are sent to OSRM (see OsmOnewayIndex in OneWayValidation_Utils.py).
+osm_extract = parameter(15)
+
+# Every OSRM request is retried with backoff when it fails for a transient reason,
+# and OSRM is paused by a circuit breaker if it keeps failing (see OneWayValidation_Utils.py).
+# Requests still waiting after 'hedge_after' seconds are sent a second time.
+osrm_backend = RoutingBackend('OSRM', hedge_after = 2.0)
+direction_provider = make_provider('OSRM', osrm_backend)
+
 # ---------------------------------------------------------------------------
 
-# 1) Feature Class to Feature Class
-arcpy.FeatureClassToFeatureClass_conversion(
-	in_features = road_network, 
-	out_path = working_gdb, 
-	out_name = working_fc,
-	# where_clause = street_select_expression
-)
-arcpy.AddMessage("Working feature class created: " + working_gdb + '\\' + working_fc)
-
-# 2) Make Feature Layer from Selection
-arcpy.MakeFeatureLayer_management(
-	in_features = working_gdb + '\\' + working_fc,
-	out_layer = 'road_seg_working',
-	where_clause = street_select_expression
-)
-
-# 3) Densify
-arcpy.Densify_edit(
-	in_features = 'road_seg_working', 
-	densification_method = "DISTANCE", 
-	distance = densify_distance
-)
-arcpy.AddMessage("Polylines densified by distance every " + str(densify_distance))
-
-# 4) Feature Vertices To Points
-arcpy.FeatureVerticesToPoints_management(
-	in_features = 'road_seg_working', 
-	out_feature_class = fc_Densify_VertPoints,
-	point_location = "ALL"
-)
-arcpy.AddMessage("Polyline vertices saved as Points: " + fc_Densify_VertPoints)
-
-# 5) Project
-arcpy.Project_management(
-	in_dataset = fc_Densify_VertPoints,
-	out_dataset = fc_Densify_VertPoints_Project,
-	out_coor_system = "GEOGCS['GCS_WGS_1984',DATUM['D_WGS_1984',SPHEROID['WGS_1984',6378137.0,298.257223563]],PRIMEM['Greenwich',0.0],UNIT['Degree',0.0174532925199433]]",
-	transform_method = "WGS_1984_(ITRF00)_To_NAD_1983",
-	in_coor_system = "PROJCS['NAD_1983_StatePlane_Massachusetts_Mainland_FIPS_2001',GEOGCS['GCS_North_American_1983',DATUM['D_North_American_1983',SPHEROID['GRS_1980',6378137.0,298.257222101]],PRIMEM['Greenwich',0.0],UNIT['Degree',0.0174532925199433]],PROJECTION['Lambert_Conformal_Conic'],PARAMETER['False_Easting',200000.0],PARAMETER['False_Northing',750000.0],PARAMETER['Central_Meridian',-71.5],PARAMETER['Standard_Parallel_1',41.71666666666667],PARAMETER['Standard_Parallel_2',42.68333333333333],PARAMETER['Latitude_Of_Origin',41.0],UNIT['Meter',1.0]]"
-)
-arcpy.AddMessage("Points projected to WGS84: " + fc_Densify_VertPoints_Project)
-
-# 6) Add XY Coordinates
-arcpy.AddXY_management(
-	in_features = fc_Densify_VertPoints_Project
-)
-
-# 7) Export Attribute Table to CSV
-arcpy.ExportXYv_stats(
-	Input_Feature_Class = fc_Densify_VertPoints_Project, 
-	Value_Field = Value_Field, 
-	Delimiter = "COMMA", 
-	Output_ASCII_File = csv_output, 
-	Add_Field_Names_to_Output = "ADD_FIELD_NAMES"
-)
-arcpy.AddMessage("(lon,lat) points added to field, exported as csv: " + csv_output)
+if not headless:
+	# 1) Feature Class to Feature Class
+	arcpy.FeatureClassToFeatureClass_conversion(
+		in_features = road_network, 
+		out_path = working_gdb, 
+		out_name = working_fc,
+		# where_clause = street_select_expression
+	)
+	message("Working feature class created: " + working_gdb + '\\' + working_fc)
+
+	# 2) Make Feature Layer from Selection
+	arcpy.MakeFeatureLayer_management(
+		in_features = working_gdb + '\\' + working_fc,
+		out_layer = 'road_seg_working',
+		where_clause = street_select_expression
+	)
+
+	# 3) Densify
+	arcpy.Densify_edit(
+		in_features = 'road_seg_working', 
+		densification_method = "DISTANCE", 
+		distance = densify_distance
+	)
+	message("Polylines densified by distance every " + str(densify_distance))
+
+	# 4) Feature Vertices To Points
+	arcpy.FeatureVerticesToPoints_management(
+		in_features = 'road_seg_working', 
+		out_feature_class = fc_Densify_VertPoints,
+		point_location = "ALL"
+	)
+	message("Polyline vertices saved as Points: " + fc_Densify_VertPoints)
+
+	# 5) Project
+	#	 The road network's coordinate system is read from its vertices rather than assumed.
+	spatial_reference = arcpy.Describe(fc_Densify_VertPoints).spatialReference
+	arcpy.Project_management(
+		in_dataset = fc_Densify_VertPoints,
+		out_dataset = fc_Densify_VertPoints_Project,
+		out_coor_system = "GEOGCS['GCS_WGS_1984',DATUM['D_WGS_1984',SPHEROID['WGS_1984',6378137.0,298.257223563]],PRIMEM['Greenwich',0.0],UNIT['Degree',0.0174532925199433]]",
+		transform_method = project_transform(spatial_reference),
+		in_coor_system = spatial_reference
+	)
+	message("Points in " + spatial_reference.name + " projected to WGS84: " + fc_Densify_VertPoints_Project)
+
+	# 6) Add XY Coordinates
+	arcpy.AddXY_management(
+		in_features = fc_Densify_VertPoints_Project
+	)
+
+	# 7) Export Attribute Table to CSV
+	arcpy.ExportXYv_stats(
+		Input_Feature_Class = fc_Densify_VertPoints_Project, 
+		Value_Field = Value_Field, 
+		Delimiter = "COMMA", 
+		Output_ASCII_File = csv_output, 
+		Add_Field_Names_to_Output = "ADD_FIELD_NAMES"
+	)
+	message("(lon,lat) points added to field, exported as csv: " + csv_output)
 
 
 # ---------------------------------------------------------------------------
@@ -175,135 +209,125 @@ id = ''
 prev_id = ''
 unique_id = str(unique_id)
 
-with open (csv_output, 'rb') as infile:
+with open_csv(csv_output) as infile:
 	reader = csv.DictReader(infile)
 	for row in reader:
 		id_val = row[unique_id]
 		if id != id_val and id_val != unique_id:
-			snap_list.append({'id':int(id_val), 'latlng':[], 'url':'', 'url_reverse':'', 'osm_route': {}, 'osm_route_reverse': {}})
+			snap_list.append({'id':int(id_val), 'latlng':[], 'distance': None, 'distance_reverse': None})
 			id = id_val
 			prev_id = id_val
-			#arcpy.AddMessage("now saving (lat,lng) from id segment " + str(id_val))
+			#message("now saving (lat,lng) from id segment " + str(id_val))
 			snap_list_num += 1
 			snap_list[snap_list_num]['latlng'].append([row['POINT_Y'],row['POINT_X']])
 		elif id == id_val and id_val != unique_id:
 			snap_list[snap_list_num]['latlng'].append([row['POINT_Y'],row['POINT_X']])
 
-# 9) Create URL request for Open Source Route Mapping with each unique id.
+# Order segments along a Hilbert curve of their midpoints, so that consecutive requests
+# go to nearby parts of the road network (see spatial_order() in OneWayValidation_Utils.py).
+snap_list = spatial_order(snap_list)
+message("(lat,lng) pairs collected for " + str(len(snap_list)) + " unique IDs, ordered spatially")
+
+# 9) Collect the points sent to Open Source Route Mapping for each unique id. The ends of
+#	 each segment that lie in an intersection are cut off the points sent, based on the
+#	 segments that meet there (see EndpointIndex in OneWayValidation_Utils.py).
+endpoints = EndpointIndex(snap_list)
 for i in snap_list:
-	if len(i['latlng'][1:-1]) <= 1:
-		continue
-	else: 
-		snap_param = ''
-		for j in i['latlng'][1:-1]:
-			snap_param += str(j[1]) + "," + str(j[0])+ ";"
-		i['url'] = "http://router.project-osrm.org/route/v1/car/" + snap_param[:-1]
+	endpoints.trim(i)
 		
-		snap_param = ''
-		for j in reversed(i['latlng'][1:-1]):
-			snap_param += str(j[1]) + "," + str(j[0])+ ";"
-		i['url_reverse'] = "http://router.project-osrm.org/route/v1/car/" + snap_param[:-1]
-		
-arcpy.AddMessage("(lat,lng) pairs, Snap To Roads url request collected for each unique ID.")
+message("(lat,lng) pairs to send to OSRM collected for each unique ID.")
 	
 # 10) For each unique ID, call  Open Source Route Mapping API. If the length of the
-#	 route returned != the length of the route in reverse direction, than the road
-#	 segment is a one-way street. The segment that is the shortest length represents
-#	 the correct direction.
+#	 route returned != the length of the route in reverse direction (beyond a small
+#	 tolerance), than the road segment is a one-way street. The segment that is the 
+#	 shortest length represents the correct direction, and the ratio of the two lengths
+#	 is saved as the segment's confidence that it needs to be flipped (see OsrmProvider 
+#	 in OneWayValidation_Utils.py, which the combined script uses too). Each segment's 
+#	 row in the results table is written as soon as it has been classified.
 oneway_streets = []
 twoway_streets = []
 flip_ids = []
 skipped_ids = []
 
-for i in snap_list:
-	if len(i['latlng'][1:-1]) <= 1:
-		arcpy.AddMessage(str(i['id']) + " skipped because too few points (<=1)")
+# With an OSM extract, segments on clearly two-way OSM ways are Two-Way before any request,
+# and the results table records the OSM way.
+osm_oneway = None
+if osm_extract not in ('', '#'):
+	osm_oneway = OsmOnewayIndex(osm_extract)
+	message(str(osm_oneway.n_ways) + " drivable ways read from " + osm_extract + ", " + str(osm_oneway.n_oneway) + " of them one-way")
+
+def osrm_segment(i):
+	if len(i['path']) <= 1:
+		message(str(i['id']) + " skipped because too few points (<=1)")
 		skipped_ids.append(i['id'])
-		continue
+		return SKIP
 	
-	# Along Road Network Direction:
-	try:
-		handle = urllib2.urlopen(i['url'])
-		url_return = handle.read()
-		i['osm_route'] = json.loads(url_return)
-	except:
-		arcpy.AddMessage("urllib2 error for " + str(i['id']) +  " --> " + str(sys.exc_info()[0]))
-		skipped_ids.append(i['id'])
-		continue
+	if osm_oneway is not None:
+		i['osm_way'] = osm_oneway.twoway_way(i['path'])
+		if i['osm_way'] is not None:
+			message(str(i['id']) + " is Two-Way (OSM way " + str(i['osm_way']) + ")")
+			twoway_streets.append(i['id'])
+			return TWOWAY
 	
-	# Against Road Network Direction:
-	try:
-		handle = urllib2.urlopen(i['url_reverse'])
-		url_return = handle.read()
-		i['osm_route_reverse'] = json.loads(url_return)
-	except:
-		arcpy.AddMessage("urllib2 error for " + str(i['id']) +  " --> " + str(sys.exc_info()[0]))
+	# Along and against Road Network Direction:
+	verdict = direction_provider.classify_direction([i])[0]
+	if verdict == ERROR:
+		message(str(i['id']) + " skipped because its OSRM requests failed")
 		skipped_ids.append(i['id'])
-		continue
-	
-	if i['osm_route']['routes'][0]['distance'] == i['osm_route_reverse']['routes'][0]['distance']:
-		arcpy.AddMessage(str(i['id']) + " is Two-Way")
+	elif verdict == TWOWAY:
+		message(str(i['id']) + " is Two-Way")
 		twoway_streets.append(i['id'])
-	elif i['osm_route']['routes'][0]['distance'] > i['osm_route_reverse']['routes'][0]['distance']:
-		arcpy.AddMessage(str(i['id']) + " is One-Way, needs to be flipped")
+	elif verdict == FLIP:
+		message(str(i['id']) + " is One-Way, needs to be flipped")
 		oneway_streets.append(i['id'])
 		flip_ids.append(i['id'])
-	elif i['osm_route']['routes'][0]['distance'] < i['osm_route_reverse']['routes'][0]['distance']:
-		arcpy.AddMessage(str(i['id']) + " is One-Way, does not need to be flipped")
+	else:
+		message(str(i['id']) + " is One-Way, does not need to be flipped")
 		oneway_streets.append(i['id'])
+	return verdict
+
+results_table = ResultsTable(results_table_output, unique_id)
+for i in snap_list:
+	results_table.add_segment(i, osrm_segment(i))
+results_table.close()
 		
-arcpy.AddMessage("IDs to flip: ")
-arcpy.AddMessage(flip_ids)
-arcpy.AddMessage("OSRM API called for each unique ID, segments to be flipped collected.")
+message("IDs to flip: ")
+message(flip_ids)
+message("OSRM API called for each unique ID, segments to be flipped collected.")
+if osm_oneway is not None:
+	message("OSM tags identified " + str(sum(1 for i in snap_list if i.get('osm_way') is not None)) + " of the two-way streets, which were not sent to OSRM")
+for line in osrm_backend.report():
+	message(line)
 
-# 11) Export list of ids to flip (aka "flip_ids") and the whole "snap_list" to CSV
-with open (flip_ids_txt, 'wb') as f:
+# 11) Export list of ids to flip (aka "flip_ids") to CSV. The per-segment details 
+#	  are in the results table written during step 10.
+with open_csv(flip_ids_txt, 'w') as f:
 	w = csv.writer(f, delimiter=',')
 	w.writerow(flip_ids)
 	w.writerow(oneway_streets)
 	w.writerow(twoway_streets)
 	w.writerow(skipped_ids)
-	w.writerow(snap_list)
-arcpy.AddMessage("Wrongly digitized polyline segments to saved: " + flip_ids_txt)
+message("Wrongly digitized polyline segments to saved: " + flip_ids_txt)
+message(results_table.status())
 		
 # ---------------------------------------------------------------------------
 
-# 12) Select Layer By Attribute, Flip Lines (optional)
-flip_ids_str = ''
-if flip_routes.lower() == 'yes':
-	for i in flip_ids:
-		flip_ids_str += (str(i) + ",")
-	if len(flip_ids_str) > 0:
-		arcpy.SelectLayerByAttribute_management(
-			in_layer_or_view = 'road_seg_working', 
-			selection_type = "NEW_SELECTION", 
-			where_clause = unique_id + " IN (" + flip_ids_str[:-1] + ")"
-		)
-		arcpy.FlipLine_edit(
-			in_features = 'road_seg_working'
-		)
-		arcpy.AddMessage(str(len(flip_ids)) + " wrongly digitized polyline segments flipped to proper direction.")
-		
-# 13) Reclassify Streets (optional)
-if reclassify.lower() == 'yes':
-	twoway_streets_str = ''
-	for i in twoway_streets:
-		twoway_streets_str += (str(i) + ",")
-	arcpy.SelectLayerByAttribute_management(
-		in_layer_or_view = 'road_seg_working', 
-		selection_type = "NEW_SELECTION", 
-		where_clause = unique_id + " IN (" + twoway_streets_str[:-1] + ")"
-	)
-	arcpy.CalculateField_management("road_seg_working","STREETOPERATION",2,"PYTHON_9.3")
-		
-	oneway_streets_str = ''
-	for i in oneway_streets:
-		oneway_streets_str += (str(i) + ",")
-	arcpy.SelectLayerByAttribute_management(
-		in_layer_or_view = 'road_seg_working', 
-		selection_type = "NEW_SELECTION", 
-		where_clause = unique_id + " IN (" + oneway_streets_str[:-1] + ")"
+# 12) Flip Lines and Reclassify Street Operation Attribute Field (optional)
+#	  The changes are written to a staging table in the working geodatabase, then the 
+#	  working feature class is updated from it in one pass, in a single edit session 
+#	  (see apply_staged_changes() in OneWayValidation_Utils.py).
+if (flip_routes.lower() == 'yes' or reclassify.lower() == 'yes') and not headless:
+	changes = staged_changes(
+		flip_ids if flip_routes.lower() == 'yes' else (),
+		twoway_streets if reclassify.lower() == 'yes' else (),
+		oneway_streets if reclassify.lower() == 'yes' else ()
 	)
-	arcpy.CalculateField_management("road_seg_working","STREETOPERATION",1,"PYTHON_9.3")
+	staging_table = stage_changes(working_gdb, working_fc + '_flip_staging', unique_id, changes)
+	message(str(len(changes)) + " changes staged: " + staging_table)
+	n_flipped, n_reclassified = apply_staged_changes(working_gdb, [working_fc], staging_table, unique_id, reclassify.lower() == 'yes')
+	if flip_routes.lower() == 'yes':
+		message(str(n_flipped) + " wrongly digitized polyline segments flipped to proper direction.")
+	if reclassify.lower() == 'yes':
+		message(str(n_reclassified) + " polyline segments reclassified as one-way or two-way.")
 
 # ---------------------------------------------------------------------------
@@ -0,0 +1,102 @@
+# ---------------------------------------------------------------------------
+#
+# File Name:
+#	OneWayValidation_Pipeline.py
+#
+# Created by:
+#	Ethan Ebinger
+#
+# Description:
+# 	Streaming two-stage pipeline used by OneWayValidation.py: every segment is
+#	classified by OSRM, and each segment OSRM queues for checking goes to a
+#	Snap To Roads worker as soon as its OSRM verdict is known, instead of after
+#	the whole OSRM stage. The run takes about as long as the slower stage
+#	rather than the sum of both.
+#
+#	Needs Python 3 (asyncio); see make_pipeline() in OneWayValidation_Utils.py,
+#	which falls back to running the stages one after the other on Python 2.
+#
+# ---------------------------------------------------------------------------
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# The stages ('classify' and 'check') are blocking functions of one segment. Each
+# runs in a thread pool, in as many asyncio workers as the stage is allowed 
+# concurrent requests, fed by its own asyncio queue:
+#
+#	segments --> [classify queue] --> classify workers --> classified(segment)
+#	                                                              |
+#	                               check_later(segment) <---------+
+#	                                      |
+#	             [check queue] --> check workers --> checked(segment)
+#
+# The callbacks run on the event loop, one at a time, so they can update shared
+# state (results table, progress, verdict counts) without locks, and can queue
+# more segments for either stage with classify_later() and check_later().
+
+class Pipeline(object):
+	def __init__(self, classify, check, classify_workers, check_workers):
+		self.classify = classify
+		self.check = check
+		self.classify_workers = classify_workers
+		self.check_workers = check_workers
+		self._to_classify = None
+		self._to_check = None
+		self._queued = ([], [])			# segments queued before run()
+		self._error = None
+
+	def classify_later(self, segment):
+		if self._to_classify is None:
+			self._queued[0].append(segment)
+		else:
+			self._to_classify.put_nowait(segment)
+
+	def check_later(self, segment):
+		if self._to_check is None:
+			self._queued[1].append(segment)
+		else:
+			self._to_check.put_nowait(segment)
+
+	def run(self, segments, classified, checked):
+		loop = asyncio.new_event_loop()
+		try:
+			loop.run_until_complete(self._run(loop, segments, classified, checked))
+		finally:
+			self._to_classify = None
+			self._to_check = None
+			loop.close()
+		if self._error is not None:
+			raise self._error
+
+	async def _run(self, loop, segments, classified, checked):
+		self._to_classify = asyncio.Queue()
+		self._to_check = asyncio.Queue()
+		with ThreadPoolExecutor(max_workers = self.classify_workers + self.check_workers) as executor:
+			workers = [loop.create_task(self._work(loop, executor, self._to_classify, self.classify, classified)) for n in range(self.classify_workers)]
+			workers += [loop.create_task(self._work(loop, executor, self._to_check, self.check, checked)) for n in range(self.check_workers)]
+			for segment in list(segments) + self._queued[0]:
+				self._to_classify.put_nowait(segment)
+			for segment in self._queued[1]:
+				self._to_check.put_nowait(segment)
+			self._queued = ([], [])
+			# A segment is only marked done after its callback has queued whatever
+			# follows from it, so once both queues are joined nothing is left.
+			await self._to_classify.join()
+			await self._to_check.join()
+			for worker in workers:
+				worker.cancel()
+			await asyncio.gather(*workers, return_exceptions = True)
+
+	async def _work(self, loop, executor, queue, stage, done):
+		while True:
+			segment = await queue.get()
+			try:
+				await loop.run_in_executor(executor, stage, segment)
+				done(segment)
+			except Exception as error:
+				# Keep draining the queues so the run ends, and raise the first error then.
+				if self._error is None:
+					self._error = error
+			finally:
+				queue.task_done()
@@ -20,32 +20,48 @@
 # ---------------------------------------------------------------------------
 
 # 0) Import modules, define Google Maps API Key, local variables and input parameters:
-import arcpy
 import csv
-import json
-import urllib2
+import os
 import math
+from OneWayValidation_Utils import GoogleRoadsProvider
+from OneWayValidation_Utils import RoutingBackend
+from OneWayValidation_Utils import ResultsTable, results_table_path, FLIP, POTENTIAL_FLIP, SKIP, ERROR
+from OneWayValidation_Utils import spatial_order, EndpointIndex
+from OneWayValidation_Utils import ResponseArchive, snap_verdict, threshold_sweep
+from OneWayValidation_Utils import project_transform
+from OneWayValidation_Utils import staged_changes, stage_changes, apply_staged_changes
+from OneWayValidation_Utils import parameter, message, open_csv
+
+# A CSV of (lon,lat) points exported by Step 7 of an earlier run. If given, Steps 1-7
+# and the edits in Step 12 are skipped and arcpy is never imported, so the segments
+# can be classified again from a plain Python installation. The parameters are given 
+# in the same order as the script tool's, e.g.:
+#	python OneWayValidation_SnapToRoads.py "" "" <working fc> <unique id> ... <output folder> ... <cached csv>
+cached_vertices = parameter(14)
+headless = cached_vertices not in ('', '#')
+if not headless:
+	import arcpy
 
 # The road network to validate. Must be a polyline feature class.
 # Input is used only for road segment selection, geoprocessing is not done on this feature class.
-road_network = arcpy.GetParameterAsText(0)
+road_network = parameter(0)
 
 # The working geodatabase, where feature classes created are saved.
-working_gdb = arcpy.GetParameterAsText(1)
+working_gdb = parameter(1)
 
 # The name of the feature class created in the working geodatabase that geoprocessing is done on. 
 # If the option to flip wrongly digitized routes is set to 'Yes', then this is the feature class 
 # in which FlipLines_Edit is run on.
-working_fc = arcpy.GetParameterAsText(2)
+working_fc = parameter(2)
 
 # The unique identifier for road segments in the Road Network feature class. 
 # Used to select (and, if selected, flip) polylines in the Working Feature Class.
-unique_id = arcpy.GetParameterAsText(3)
+unique_id = parameter(3)
 	
 # SQL Expression used to select specific road segments in the Working Feature Class, 
 # which will be submitted to Google Maps API for the Snap To Roads tool. 
 # This parameter is optional. Leave blank if no selection by attribute is desired.
-street_select_expression = arcpy.GetParameterAsText(4)
+street_select_expression = parameter(4)
 
 # Distance (in meters) at which to Densify polyline segments.
 # It is recommended to use in combination with the SQL Expression, and call
@@ -53,14 +69,14 @@ street_select_expression = arcpy.GetParameterAsText(4)
 #	if Length >= 30: densify_distance = 10 Meters
 #	if Length < 30 and Length >= 10: densify_distance = 5 Meters
 # 	if Length < 10: densify_distance = 1 Meter
-densify_distance = arcpy.GetParameterAsText(5)
+densify_distance = parameter(5)
 
 # File name for the output of Step 4:
-fc_Densify_VertPoints = arcpy.GetParameterAsText(6)
+fc_Densify_VertPoints = parameter(6)
 fc_Densify_VertPoints = working_gdb + '\\' + working_fc + '_Densify_VertPoints'
 
 # File name for the output of Step 5:
-fc_Densify_VertPoints_Project = arcpy.GetParameterAsText(7)
+fc_Densify_VertPoints_Project = parameter(7)
 fc_Densify_VertPoints_Project = fc_Densify_VertPoints + '_WGS84'
 
 # The names of the fields to be exported to a CSV (saved as a .txt file). 
@@ -70,7 +86,7 @@ fc_Densify_VertPoints_Project = fc_Densify_VertPoints + '_WGS84'
 #		Unique identifier (i.e. ROADINVENTORY_ID)
 #		POINT_X
 #		POINT_Y
-Value_Field = arcpy.GetParameterAsText(8)
+Value_Field = parameter(8)
 if Value_Field == '#' or not Value_Field:
     Value_Field = unique_id + ";POINT_X;POINT_Y"
 
@@ -81,7 +97,7 @@ if Value_Field == '#' or not Value_Field:
 # If you have a premium key, there are no limits on the usage of this tool. 
 # Otherwise, only 2500 requests (i.e. road segments) can be made each day: 
 #	https://developers.google.com/maps/documentation/roads/snap
-key = arcpy.GetParameterAsText(9)
+key = parameter(9)
 
 # Do you wish to flip the directionality of incorrectly digitized road segments automatically?
 # If 'Yes', unique segments identified by the Snap To Roads tool as being digitized 
@@ -89,21 +105,49 @@ key = arcpy.GetParameterAsText(9)
 # will be flipped (using FlipLines_Edit: http://desktop.arcgis.com/en/arcmap/10.3/tools/editing-toolbox/flip-line.htm) 
 # in the Working Feature Class.
 # Else, change field to 'No' to skip processes of flipping polylines for now.
-flip_routes = arcpy.GetParameterAsText(10)
+flip_routes = parameter(10)
 if flip_routes == '#' or not flip_routes:
     flip_routes = 'Yes'
 
 # The pathname of the folder where CSVs generated from this script, 
 # including a .txt file with the unique ids of road segments to flip, will be saved.
-flip_ids_output = arcpy.GetParameterAsText(11)
+flip_ids_output = parameter(11)
 
 # File name for the TXT output, from (7):
-csv_output = arcpy.GetParameterAsText(12)
+csv_output = parameter(12)
 csv_output = fc_Densify_VertPoints_Project + '_addXY.txt'
+if headless:
+	csv_output = cached_vertices
 
 # File name for the output of Step 11:
-flip_ids_txt = arcpy.GetParameterAsText(13)
-flip_ids_txt = flip_ids_output + '\\' + working_fc + "_flip_ids.txt"
+flip_ids_txt = parameter(13)
+flip_ids_txt = os.path.join(flip_ids_output, working_fc + "_flip_ids.txt")
+
+# Per-segment results table (verdicts, snap offsets and timings), saved next to the 
+# flip ids as a Parquet file if pyarrow is installed, or as a GeoPackage table otherwise.
+results_table_output = results_table_path(flip_ids_output, working_fc)
+
+# A file (.jsonl.gz) that every Snap To Roads response of this run is recorded to. Optional.
+# If Replay is 'Yes', the responses are read back from it instead and no request is made
+# (see ResponseArchive in OneWayValidation_Utils.py), and Step 11 reports how many segments
+# would be flipped or flagged for review with other distance and bearing thresholds.
+response_archive = parameter(15)
+replay = parameter(16)
+if replay == '#' or not replay:
+    replay = 'No'
+archive = None
+if response_archive not in ('', '#'):
+	archive = ResponseArchive(response_archive, replay.lower() == 'yes')
+
+# File name for the threshold sweep of a replayed run:
+threshold_sweep_txt = os.path.join(flip_ids_output, working_fc + "_threshold_sweep.txt")
+
+# Every Snap To Roads request is retried with backoff when it fails for a transient 
+# reason, and the service is paused by a circuit breaker if it keeps failing 
+# (see OneWayValidation_Utils.py). Requests are not hedged, since every duplicate 
+# request counts against the Google Maps API quota.
+google_backend = RoutingBackend('Snap To Roads', archive = archive)
+snap_provider = GoogleRoadsProvider(google_backend, key)
 
 # Function from https://gist.github.com/jeromer/2005586 that is used to calculate
 # the orientation of the sent and returned lines to verify if it was snapped to the
@@ -123,61 +167,64 @@ def calculate_initial_compass_bearing(pointA, pointB):
 
 # ---------------------------------------------------------------------------
 
-# 1) Feature Class to Feature Class
-arcpy.FeatureClassToFeatureClass_conversion(
-	in_features = road_network, 
-	out_path = working_gdb, 
-	out_name = working_fc
-)
-arcpy.AddMessage("Working feature class created: " + working_gdb + '\\' + working_fc)
-
-# 2) Make Feature Layer from Selection
-arcpy.MakeFeatureLayer_management(
-	in_features = working_gdb + '\\' + working_fc,
-	out_layer = 'road_seg_working',
-	where_clause = street_select_expression
-)
-
-# 3) Densify
-arcpy.Densify_edit(
-	in_features = 'road_seg_working', 
-	densification_method = "DISTANCE", 
-	distance = densify_distance
-)
-arcpy.AddMessage( "Polylines densified by distance every " + str(densify_distance))
-
-# 4) Feature Vertices To Points
-arcpy.FeatureVerticesToPoints_management(
-	in_features = 'road_seg_working', 
-	out_feature_class = fc_Densify_VertPoints,
-	point_location = "ALL"
-)
-arcpy.AddMessage("Polyline vertices saved as Points: " + fc_Densify_VertPoints)
-
-# 5) Project
-arcpy.Project_management(
-	in_dataset = fc_Densify_VertPoints,
-	out_dataset = fc_Densify_VertPoints_Project,
-	out_coor_system = "GEOGCS['GCS_WGS_1984',DATUM['D_WGS_1984',SPHEROID['WGS_1984',6378137.0,298.257223563]],PRIMEM['Greenwich',0.0],UNIT['Degree',0.0174532925199433]]",
-	transform_method = "WGS_1984_(ITRF00)_To_NAD_1983",
-	in_coor_system = "PROJCS['NAD_1983_StatePlane_Massachusetts_Mainland_FIPS_2001',GEOGCS['GCS_North_American_1983',DATUM['D_North_American_1983',SPHEROID['GRS_1980',6378137.0,298.257222101]],PRIMEM['Greenwich',0.0],UNIT['Degree',0.0174532925199433]],PROJECTION['Lambert_Conformal_Conic'],PARAMETER['False_Easting',200000.0],PARAMETER['False_Northing',750000.0],PARAMETER['Central_Meridian',-71.5],PARAMETER['Standard_Parallel_1',41.71666666666667],PARAMETER['Standard_Parallel_2',42.68333333333333],PARAMETER['Latitude_Of_Origin',41.0],UNIT['Meter',1.0]]"
-)
-arcpy.AddMessage("Points projected to WGS84: " + fc_Densify_VertPoints_Project)
-
-# 6) Add XY Coordinates
-arcpy.AddXY_management(
-	in_features = fc_Densify_VertPoints_Project
-)
-
-# 7) Export Attribute Table to CSV
-arcpy.ExportXYv_stats(
-	Input_Feature_Class = fc_Densify_VertPoints_Project, 
-	Value_Field = Value_Field, 
-	Delimiter = "COMMA", 
-	Output_ASCII_File = csv_output, 
-	Add_Field_Names_to_Output = "ADD_FIELD_NAMES"
-)
-arcpy.AddMessage("(lon,lat) points added to field, exported as csv: " + csv_output)
+if not headless:
+	# 1) Feature Class to Feature Class
+	arcpy.FeatureClassToFeatureClass_conversion(
+		in_features = road_network, 
+		out_path = working_gdb, 
+		out_name = working_fc
+	)
+	message("Working feature class created: " + working_gdb + '\\' + working_fc)
+
+	# 2) Make Feature Layer from Selection
+	arcpy.MakeFeatureLayer_management(
+		in_features = working_gdb + '\\' + working_fc,
+		out_layer = 'road_seg_working',
+		where_clause = street_select_expression
+	)
+
+	# 3) Densify
+	arcpy.Densify_edit(
+		in_features = 'road_seg_working', 
+		densification_method = "DISTANCE", 
+		distance = densify_distance
+	)
+	message( "Polylines densified by distance every " + str(densify_distance))
+
+	# 4) Feature Vertices To Points
+	arcpy.FeatureVerticesToPoints_management(
+		in_features = 'road_seg_working', 
+		out_feature_class = fc_Densify_VertPoints,
+		point_location = "ALL"
+	)
+	message("Polyline vertices saved as Points: " + fc_Densify_VertPoints)
+
+	# 5) Project
+	#	 The road network's coordinate system is read from its vertices rather than assumed.
+	spatial_reference = arcpy.Describe(fc_Densify_VertPoints).spatialReference
+	arcpy.Project_management(
+		in_dataset = fc_Densify_VertPoints,
+		out_dataset = fc_Densify_VertPoints_Project,
+		out_coor_system = "GEOGCS['GCS_WGS_1984',DATUM['D_WGS_1984',SPHEROID['WGS_1984',6378137.0,298.257223563]],PRIMEM['Greenwich',0.0],UNIT['Degree',0.0174532925199433]]",
+		transform_method = project_transform(spatial_reference),
+		in_coor_system = spatial_reference
+	)
+	message("Points in " + spatial_reference.name + " projected to WGS84: " + fc_Densify_VertPoints_Project)
+
+	# 6) Add XY Coordinates
+	arcpy.AddXY_management(
+		in_features = fc_Densify_VertPoints_Project
+	)
+
+	# 7) Export Attribute Table to CSV
+	arcpy.ExportXYv_stats(
+		Input_Feature_Class = fc_Densify_VertPoints_Project, 
+		Value_Field = Value_Field, 
+		Delimiter = "COMMA", 
+		Output_ASCII_File = csv_output, 
+		Add_Field_Names_to_Output = "ADD_FIELD_NAMES"
+	)
+	message("(lon,lat) points added to field, exported as csv: " + csv_output)
 
 # ---------------------------------------------------------------------------
 
@@ -190,38 +237,35 @@ id = ''
 prev_id = ''
 unique_id = str(unique_id)
 
-with open (csv_output, 'rb') as infile:
+with open_csv(csv_output) as infile:
 	reader = csv.DictReader(infile)
 	for row in reader:
 		id_val = row[unique_id]
 		if id != id_val and id_val != unique_id:
-			snap_list.append({'id':int(id_val), 'latlng':[], 'url':'', 'snapped_points': {}})
+			snap_list.append({'id':int(id_val), 'latlng':[], 'snapped_points': None})
 			id = id_val
 			prev_id = id_val
 			roadInvIDs.append(id_val)
-			#arcpy.AddMessage("now saving (lat,lng) from id segment " + str(id_val))
+			#message("now saving (lat,lng) from id segment " + str(id_val))
 			snap_list_num += 1
 			snap_list[snap_list_num]['latlng'].append([row['POINT_Y'],row['POINT_X']])
 		elif id == id_val and id_val != unique_id:
 			snap_list[snap_list_num]['latlng'].append([row['POINT_Y'],row['POINT_X']])
 		row_num += 1
 
-# 9) Create URL request for Snap To Roads tool for each id.
-#	 In order to make sure the request properly runs, no more than 100 points can
-#	 be submitted at the same time, hense the if/else statement and the cutoff.
+# Order segments along a Hilbert curve of their midpoints, so that consecutive requests
+# go to nearby parts of the road network (see spatial_order() in OneWayValidation_Utils.py).
+snap_list = spatial_order(snap_list)
+message("(lat,lng) pairs collected for " + str(len(snap_list)) + " unique IDs, ordered spatially")
+
+# 9) Collect the points sent to Snap To Roads for each id. The ends of each segment 
+#	 that lie in an intersection are cut off the points sent, based on the segments 
+#	 that meet there (see EndpointIndex in OneWayValidation_Utils.py).
+endpoints = EndpointIndex(snap_list)
 for i in snap_list:
-	snap_param = ''
-	if len(i['latlng'][1:-1]) <= 1:
-		continue
-	elif len(i['latlng']) > 102:
-		for j in i['latlng'][1:101]:
-			snap_param += str(j[0]) + "," + str(j[1])+ "|"
-	else: 
-		for j in i['latlng'][1:-1]:
-			snap_param += str(j[0]) + "," + str(j[1])+ "|"
-	i['url'] = "https://roads.googleapis.com/v1/snapToRoads?path=" + snap_param[:-1] + "&interpolate=false&key=" + key
-
-arcpy.AddMessage("(lat,lng) pairs, Snap To Roads url request collected for each unique ID.")
+	endpoints.trim(i)
+
+message("(lat,lng) pairs to send to Snap To Roads collected for each unique ID.")
 	
 # 10) For each unique ID, call Snap To Roads via Google Maps Roads API. If the 
 #	  number of points returned != the number of points sent, then the road 
@@ -231,97 +275,125 @@ arcpy.AddMessage("(lat,lng) pairs, Snap To Roads url request collected for each
 #	  Other road segments that may need to be flipped but were still returned as
 #	  snapped by the Snap To Roads service are saved in the "potential_flip_ids" list
 #	  and should be manually reviewed in ArcGIS by the user.
+#	  In order to make sure the request properly runs, no more than 100 points can
+#	  be submitted at the same time, so only the first 100 are sent (see 
+#	  GoogleRoadsProvider in OneWayValidation_Utils.py, which the combined script uses too).
+#	  Each segment's row in the results table is written as soon as it has been checked.
 flip_ids = []
 potential_flip_ids = []
 skipped_ids = []
 
-if len(snap_list) > 2500:
-	arcpy.AddMessage("List is greater than 2500 points. Only the first 2500 values in 'snap_list' were queried.")
-for i in snap_list[:2499]:
-	#arcpy.AddMessage(i['id'])
-	if len(i['latlng'][1:-1]) <= 1:
-		#arcpy.AddMessage("id " + str(i['id']) + " skipped because too few points (<=1)")
+def snaptoroads_segment(i):
+	snapped_points = snap_provider.snap([i])[0]
+	if snapped_points == SKIP:
+		#message("id " + str(i['id']) + " skipped because too few points (<=1)")
 		skipped_ids.append(i['id'])
-		continue
-	#elif len(i['latlng']) > 102:
-		#arcpy.AddMessage("# of points sent = 100")
-	#else:
-		#arcpy.AddMessage("# of points sent = " + str(len(i['latlng'][1:-1])))
-	handle = urllib2.urlopen(i['url'])
-	url_return = handle.read()
-	snapped_points = json.loads(url_return)
-	if len(snapped_points) != 1:
-		#arcpy.AddMessage("id " + str(i['id']) + " skipped because segment not in Google Maps")
+		return SKIP
+	if snapped_points == ERROR:
+		message("id " + str(i['id']) + " skipped because its Snap To Roads request failed")
 		skipped_ids.append(i['id'])
-		continue
-	else:
-		i['snapped_points'] = snapped_points['snappedPoints']
-		#arcpy.AddMessage("# of points recieved = " + str(len(i['snapped_points'])))
-		if len(i['latlng']) > 102:
-			if len(i['snapped_points']) != 100:
-				flip_ids.append(i['id'])
-		else:
-			if len(i['latlng'][1:-1]) != len(i['snapped_points']):
-				flip_ids.append(i['id'])
-			else: 
-				lat_start = float(i['latlng'][1][0])
-				lat_end = float(i['latlng'][-2][0])
-				lng_start = float(i['latlng'][1][1])
-				lng_end = float(i['latlng'][-2][1])
-				
-				snap_lat_start = i['snapped_points'][0]['location']['latitude']
-				snap_lat_end = i['snapped_points'][-1]['location']['latitude']
-				snap_lng_start = i['snapped_points'][0]['location']['longitude']
-				snap_lng_end = i['snapped_points'][-1]['location']['longitude']
-				
-				orig_distance = math.sqrt(math.pow(lat_end - lat_start,2)+math.pow(lng_end - lng_start,2))
-				snap_distance = math.sqrt(math.pow(snap_lat_end - lat_start,2)+math.pow(snap_lng_end - lng_start,2))
-				if (abs(snap_distance - orig_distance)*100000) > 4:		# empirically derived
-					#arcpy.AddMessage("manually check id " + str(i['id']) + " b/c snap distances off")
-					potential_flip_ids.append(i['id'])
-								
-				dir_orig = calculate_initial_compass_bearing((lat_start, lng_start),(lat_end, lng_end))
-				dir_snap = calculate_initial_compass_bearing((snap_lat_start, snap_lng_start),(snap_lat_end, snap_lng_end))
-				if (abs(dir_orig - dir_snap)) > 2:		# empirically derived
-					#arcpy.AddMessage("manually check id " + str(i['id']) + " b/c snap orientation off")
-					if i['id'] in potential_flip_ids:
-						flip_ids.append(i['id'])
-					else:
-						potential_flip_ids.append(i['id'])
-
-arcpy.AddMessage("IDs to flip: ")
-arcpy.AddMessage(flip_ids)
-arcpy.AddMessage("IDs to check manually and potentially flip: ")
-arcpy.AddMessage(potential_flip_ids)
-arcpy.AddMessage("IDs that were skipped: ")
-arcpy.AddMessage(skipped_ids)
-arcpy.AddMessage("Snap To Roads called for each unique ID, segments to be flipped collected.")
-
-# 11) Export list of ids to flip (aka "flip_ids") and the whole "snap_list" to CSV
-with open (flip_ids_txt, 'wb') as f:
+		return ERROR
+	if snapped_points is None:
+		#message("id " + str(i['id']) + " skipped because segment not in Google Maps")
+		skipped_ids.append(i['id'])
+		return SKIP
+	
+	n_sent, n_returned, snap_start, snap_end = snapped_points
+	i['snapped_points'] = snapped_points[1:]
+	#message("# of points sent = " + str(n_sent))
+	#message("# of points recieved = " + str(n_returned))
+	if n_sent != n_returned:
+		flip_ids.append(i['id'])
+		return FLIP
+	if len(i['path']) > 100:
+		return None
+	
+	lat_start = float(i['path'][0][0])
+	lat_end = float(i['path'][-1][0])
+	lng_start = float(i['path'][0][1])
+	lng_end = float(i['path'][-1][1])
+	
+	snap_lat_start, snap_lng_start = snap_start
+	snap_lat_end, snap_lng_end = snap_end
+	
+	orig_distance = math.sqrt(math.pow(lat_end - lat_start,2)+math.pow(lng_end - lng_start,2))
+	snap_distance = math.sqrt(math.pow(snap_lat_end - lat_start,2)+math.pow(snap_lng_end - lng_start,2))
+	i['snap_distance_delta'] = abs(snap_distance - orig_distance)*100000
+					
+	dir_orig = calculate_initial_compass_bearing((lat_start, lng_start),(lat_end, lng_end))
+	dir_snap = calculate_initial_compass_bearing((snap_lat_start, snap_lng_start),(snap_lat_end, snap_lng_end))
+	i['bearing_delta'] = abs(dir_orig - dir_snap)
+	
+	# Both off --> FLIP, either one off --> POTENTIAL_FLIP (see snap_verdict() in OneWayValidation_Utils.py).
+	verdict = snap_verdict(i['snap_distance_delta'], i['bearing_delta'])
+	if verdict == FLIP:
+		#message("flip id " + str(i['id']) + " b/c snap distances and orientation off")
+		flip_ids.append(i['id'])
+	elif verdict == POTENTIAL_FLIP:
+		#message("manually check id " + str(i['id']) + " b/c snap distances or orientation off")
+		potential_flip_ids.append(i['id'])
+	return verdict
+
+if len(snap_list) > 2500:
+	message("List is greater than 2500 points. Only the first 2500 values in 'snap_list' were queried.")
+results_table = ResultsTable(results_table_output, unique_id)
+for i in snap_list[:2499]:
+	#message(i['id'])
+	results_table.add_segment(i, None, snaptoroads_segment(i))
+results_table.close()
+if archive is not None:
+	archive.close()
+
+message("IDs to flip: ")
+message(flip_ids)
+message("IDs to check manually and potentially flip: ")
+message(potential_flip_ids)
+message("IDs that were skipped: ")
+message(skipped_ids)
+message("Snap To Roads called for each unique ID, segments to be flipped collected.")
+for line in google_backend.report():
+	message(line)
+
+# 11) Export list of ids to flip (aka "flip_ids") to CSV. The per-segment details 
+#	  are in the results table written during step 10.
+with open_csv(flip_ids_txt, 'w') as f:
 	w = csv.writer(f, delimiter=',')
 	w.writerow(flip_ids)
 	w.writerow(potential_flip_ids)
 	w.writerow(skipped_ids)
-	w.writerow(snap_list)
-arcpy.AddMessage("Wrongly digitized polyline segments to saved: " + flip_ids_txt)
+message("Wrongly digitized polyline segments to saved: " + flip_ids_txt)
+message(results_table.status())
 		
+# 11b) Threshold sweep (replay only): flip and potential flip counts for every combination
+#	   of distance and bearing thresholds, from the segments measured above. Segments whose
+#	   number of snapped points did not match are flipped whatever the thresholds.
+if archive is not None and archive.replay:
+	measured = [(i['snap_distance_delta'], i['bearing_delta']) for i in snap_list[:2499] if 'bearing_delta' in i]
+	mismatched = set(flip_ids)
+	n_mismatch = sum(1 for i in snap_list[:2499] if i['snapped_points'] is not None and 'bearing_delta' not in i and i['id'] in mismatched)
+	message(str(len(archive)) + " recorded responses replayed from " + response_archive + ", no API calls made")
+	message("Threshold sweep (distance, bearing --> flip, potential flip, ok):")
+	with open_csv(threshold_sweep_txt, 'w') as f:
+		w = csv.writer(f, delimiter=',')
+		w.writerow(['distance_threshold', 'bearing_threshold', 'flip', 'potential_flip', 'ok'])
+		for distance_threshold, bearing_threshold, n_flip, n_potential in threshold_sweep(measured):
+			row = [distance_threshold, bearing_threshold, n_mismatch + n_flip, n_potential, len(measured) - n_flip - n_potential]
+			w.writerow(row)
+			message("  > " + str(row[0]) + ", > " + str(row[1]) + " --> " + ", ".join(str(n) for n in row[2:]))
+	message("Threshold sweep saved: " + threshold_sweep_txt)
+elif archive is not None:
+	message("Snap To Roads responses recorded: " + response_archive)
+
 # ---------------------------------------------------------------------------
 
-# 12) Select Layer By Attribute, Flip Lines (optional)
-flip_ids_str = ''
-if flip_routes.lower() == 'yes':
-	for i in flip_ids:
-		flip_ids_str += (str(i) + ",")
-	if len(flip_ids_str) > 0:
-		arcpy.SelectLayerByAttribute_management(
-			in_layer_or_view = 'road_seg_working', 
-			selection_type = "NEW_SELECTION", 
-			where_clause = unique_id + " IN (" + flip_ids_str[:-1] + ")"
-		)
-		arcpy.FlipLine_edit(
-			in_features = 'road_seg_working'
-		)
-		arcpy.AddMessage(str(len(flip_ids)) + " wrongly digitized polyline segments flipped to proper direction.")
+# 12) Flip Lines (optional)
+#	  The ids to flip are written to a staging table in the working geodatabase, then the
+#	  working feature class is updated from it in one pass, in a single edit session 
+#	  (see apply_staged_changes() in OneWayValidation_Utils.py).
+if flip_routes.lower() == 'yes' and not headless:
+	staging_table = stage_changes(working_gdb, working_fc + '_flip_staging', unique_id, staged_changes(flip_ids))
+	message(str(len(flip_ids)) + " changes staged: " + staging_table)
+	n_flipped, n_reclassified = apply_staged_changes(working_gdb, [working_fc], staging_table, unique_id, False)
+	message(str(n_flipped) + " wrongly digitized polyline segments flipped to proper direction.")
 
 # ---------------------------------------------------------------------------
@@ -0,0 +1,1926 @@
+# ---------------------------------------------------------------------------
+#
+# File Name:
+#	OneWayValidation_Utils.py
+#
+# Created by:
+#	Ethan Ebinger
+#
+# Description:
+# 	Helper functions shared by OneWayValidation.py, OneWayValidation_OSRM.py,
+#	OneWayValidation_SnapToRoads.py, OneWayValidation_Distributed.py and
+#	OneWayValidation_Benchmark.py. Nothing in this file imports arcpy,
+#	so it can be used from a plain Python session as well as from the
+#	ArcGIS script tools; the few helpers that call arcpy use the module
+#	a script has already imported.
+#
+#	See API for more details on OSRM call: http://project-osrm.org/docs/v5.7.0/api/#route-service
+#	See API for more details on Snap To Roads call: https://developers.google.com/maps/documentation/roads/snap
+#
+# ---------------------------------------------------------------------------
+
+import bisect
+import bz2
+import collections
+import gzip
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from xml.etree import ElementTree
+
+try:
+	from urllib2 import urlopen, HTTPError, URLError
+	from urllib import quote
+	from Queue import Queue, Empty
+except ImportError:
+	from urllib.request import urlopen
+	from urllib.error import HTTPError, URLError
+	from urllib.parse import quote
+	from queue import Queue, Empty
+
+OSRM_ROUTE_URL = "http://router.project-osrm.org/route/v1/car/"
+SNAP_TO_ROADS_URL = "https://roads.googleapis.com/v1/snapToRoads"
+VALHALLA_URL = "http://localhost:8002/"
+GRAPHHOPPER_URL = "http://localhost:8989/"
+
+# Valhalla answers HTTP 400 to a route with more locations than its
+# service_limits max_locations, 20 for auto in the default configuration.
+VALHALLA_MAX_LOCATIONS = 20
+
+# Only routes[0].distance is read from an OSRM response, so the route geometry
+# and turn-by-turn steps are not requested at all. In single-call mode the OSM
+# node ids along the route are requested as well (see classify_osrm()).
+OSRM_ROUTE_OPTIONS = "overview=false&steps=false"
+OSRM_NODES_OPTIONS = "overview=false&steps=false&annotations=nodes"
+
+# ---------------------------------------------------------------------------
+
+# Script tool parameters and messages. arcpy takes a long time to import and
+# needs an ArcGIS license, so the scripts only import it for the steps that read
+# or edit a geodatabase. Until then (or in a run that never needs it),
+# parameters are read from the command line in the same order as the script
+# tool's, and messages are printed.
+
+def parameter(index):
+	arcpy = sys.modules.get('arcpy')
+	if arcpy is not None:
+		return arcpy.GetParameterAsText(index)
+	return sys.argv[index + 1] if len(sys.argv) > index + 1 else ''
+
+def message(text):
+	arcpy = sys.modules.get('arcpy')
+	if arcpy is not None:
+		arcpy.AddMessage(text)
+	else:
+		print(text)
+
+def open_csv(path, mode = 'r'):
+	# csv files need binary mode on Python 2 (as ArcGIS Desktop runs) and newline='' on Python 3.
+	if sys.version_info[0] < 3:
+		return open(path, mode + 'b')
+	return open(path, mode, newline = '')
+
+# ---------------------------------------------------------------------------
+
+# URL requests. The 'latlng' lists hold [lat, lng] pairs as strings, read
+# straight from the CSV exported in Step 7.
+
+def osrm_route_url(latlng, options = OSRM_ROUTE_OPTIONS, base_url = None):
+	# 'base_url' is another OSRM server's route service, e.g. a worker's nearest
+	# endpoint (see OneWayValidation_Distributed.py); OSRM_ROUTE_URL by default.
+	snap_param = ''
+	for j in latlng:
+		snap_param += str(j[1]) + "," + str(j[0]) + ";"
+	return (base_url or OSRM_ROUTE_URL) + snap_param[:-1] + "?" + options
+
+def downsample(points, n):
+	# At most n of the points, evenly spaced, always keeping the first and last.
+	if len(points) <= n:
+		return list(points)
+	return [points[int(round(i * (len(points) - 1.0) / (n - 1)))] for i in range(n)]
+
+def valhalla_route_url(latlng, base_url = VALHALLA_URL, max_locations = VALHALLA_MAX_LOCATIONS):
+	# The first and last points are stops; the ones between are passed through
+	# without a stop, so the route cannot turn around at them. Longer paths are
+	# downsampled to 'max_locations' points.
+	locations = [{'lat': float(j[0]), 'lon': float(j[1]), 'type': 'through'} for j in downsample(latlng, max_locations)]
+	locations[0]['type'] = locations[-1]['type'] = 'break'
+	request = {'locations': locations, 'costing': 'auto', 'units': 'kilometers', 'directions_type': 'none'}
+	return base_url + "route?json=" + quote(json.dumps(request, separators = (',', ':')))
+
+def graphhopper_route_url(latlng, base_url = GRAPHHOPPER_URL):
+	points = ''
+	for j in latlng:
+		points += "point=" + str(j[0]) + "," + str(j[1]) + "&"
+	return base_url + "route?" + points + "profile=car&calc_points=false&instructions=false"
+
+def snap_to_roads_url(latlng, key):
+	snap_param = ''
+	for j in latlng:
+		snap_param += str(j[0]) + "," + str(j[1]) + "|"
+	return SNAP_TO_ROADS_URL + "?path=" + snap_param[:-1] + "&interpolate=false&key=" + key
+
+# ---------------------------------------------------------------------------
+
+# Spatial ordering. Segments come out of the CSV export in an arbitrary order,
+# so consecutive requests jump all over the network. Sorting them along a
+# Hilbert curve through their midpoints keeps consecutive requests (and the
+# segments in each batch of spatial_batches()) close together, so a self-hosted
+# OSRM keeps reading the same pages of its .osrm files and any response cache
+# sees repeated neighbourhoods.
+
+HILBERT_ORDER = 16				# bits per axis, a 65536 x 65536 grid over the network
+
+def hilbert_index(x, y, order = HILBERT_ORDER):
+	# Position of grid cell (x, y) along a Hilbert curve filling a 2^order grid.
+	n = 1 << order
+	d = 0
+	s = n >> 1
+	while s > 0:
+		rx = 1 if x & s else 0
+		ry = 1 if y & s else 0
+		d += s * s * ((3 * rx) ^ ry)
+		if ry == 0:
+			if rx == 1:
+				x = n - 1 - x
+				y = n - 1 - y
+			x, y = y, x
+		s >>= 1
+	return d
+
+def segment_midpoint(segment):
+	lat, lng = segment['latlng'][len(segment['latlng']) // 2]
+	return float(lat), float(lng)
+
+def spatial_order(snap_list):
+	# Returns a copy of snap_list sorted along a Hilbert curve of segment midpoints.
+	if len(snap_list) < 2:
+		return list(snap_list)
+	midpoints = [segment_midpoint(i) for i in snap_list]
+	min_lat = min(lat for lat, lng in midpoints)
+	min_lng = min(lng for lat, lng in midpoints)
+	span = max(max(lat for lat, lng in midpoints) - min_lat, max(lng for lat, lng in midpoints) - min_lng) or 1.0
+	scale = ((1 << HILBERT_ORDER) - 1) / span
+	keys = [hilbert_index(int((lng - min_lng) * scale), int((lat - min_lat) * scale)) for lat, lng in midpoints]
+	order = sorted(range(len(snap_list)), key = keys.__getitem__)
+	return [snap_list[k] for k in order]
+
+def spatial_batches(snap_list, size):
+	# Splits a spatially ordered snap_list into batches of neighbouring segments.
+	for start in range(0, len(snap_list), size):
+		yield snap_list[start:start + size]
+
+# ---------------------------------------------------------------------------
+
+# Reading segments. read_segments() turns the rows of the CSV exported by the
+# scripts (one row per vertex, the vertices of a segment one after the other)
+# into snap_list entries, yielding each one as soon as its last vertex is read,
+# so a whole network never has to be held at once.
+#
+# Under a memory budget (see MemoryMonitor), SegmentChunks groups them into
+# chunks of at most 'max_vertices' vertices; each chunk is ordered and sent on
+# its own and dropped once classified. A segment longer than the limit is a
+# chunk by itself. 'max_vertices' may be lowered between chunks.
+
+MEMORY_BYTES_PER_VERTEX = 400		# a [lat, lng] pair of strings in snap_list, with its share of the entry
+MEMORY_CHUNK_SHARE = 0.25		# share of the memory budget the vertices of one chunk may use
+
+def read_segments(rows, unique_id):
+	segment = None
+	for row in rows:
+		id_val = row[unique_id]
+		if id_val == unique_id:
+			continue
+		if segment is None or id_val != current:
+			if segment is not None:
+				yield segment
+			segment = {'id': int(id_val), 'latlng': []}
+			current = id_val
+		segment['latlng'].append([row['POINT_Y'], row['POINT_X']])
+	if segment is not None:
+		yield segment
+
+def chunk_vertices(max_memory):
+	# Vertices per chunk for a budget of 'max_memory' megabytes.
+	return max(1000, int(max_memory * 2 ** 20 * MEMORY_CHUNK_SHARE / MEMORY_BYTES_PER_VERTEX))
+
+class SegmentChunks(object):
+	def __init__(self, segments, max_vertices):
+		self.segments = segments
+		self.max_vertices = max_vertices
+
+	def __iter__(self):
+		chunk = []
+		n_vertices = 0
+		for segment in self.segments:
+			if chunk and n_vertices + len(segment['latlng']) > self.max_vertices:
+				yield chunk
+				chunk = []
+				n_vertices = 0
+			chunk.append(segment)
+			n_vertices += len(segment['latlng'])
+		if chunk:
+			yield chunk
+
+# ---------------------------------------------------------------------------
+
+# Endpoint trimming. The vertices at the ends of a segment lie in the
+# intersections it joins, where OSRM and Snap To Roads may match them to the
+# cross street, so they are not sent. Rather than dropping one vertex at each
+# end (which left many short segments with too few points to send), an
+# EndpointIndex built once over the whole network records the bearing of every
+# segment leaving each node (ends rounded to NODE_DECIMALS), and each end is
+# cut by distance according to what meets there:
+#
+#	straight through	--> exactly two segments, meeting at no more than
+#				    CONTINUATION_ANGLE: the road just carries on, so
+#				    nothing is cut.
+#	anything else	--> an intersection, a corner, or an end whose cross
+#				    streets were not selected: INTERSECTION_TRIM meters
+#				    are cut, at most TRIM_MAX_SHARE of the segment.
+#
+# A vertex is interpolated where each cut falls, so a segment of any length
+# keeps at least two points. The points sent are saved on the snap_list entry
+# as 'path'.
+
+NODE_DECIMALS = 5				# ends within ~1 m share a node
+CONTINUATION_ANGLE = 30.0		# degrees
+INTERSECTION_TRIM = 10.0		# meters
+TRIM_MAX_SHARE = 0.25			# of the segment length, per end
+
+def _node(point):
+	return (round(float(point[0]), NODE_DECIMALS), round(float(point[1]), NODE_DECIMALS))
+
+def _bearing(a, b):
+	# Bearing from [lat, lng] 'a' to 'b', in degrees; flat-earth, for nearby points.
+	lat_a, lat_b = float(a[0]), float(b[0])
+	d_lng = (float(b[1]) - float(a[1])) * math.cos(math.radians((lat_a + lat_b) / 2))
+	return math.degrees(math.atan2(d_lng, lat_b - lat_a)) % 360
+
+def _cut_start(latlng, distance):
+	# Drops the first 'distance' meters of a [lat, lng] path.
+	if distance <= 0:
+		return latlng
+	for k in range(1, len(latlng)):
+		step = path_length(latlng[k - 1:k + 1])
+		if step > distance:
+			share = distance / step
+			a, b = latlng[k - 1], latlng[k]
+			point = [round(float(a[c]) + share * (float(b[c]) - float(a[c])), 7) for c in (0, 1)]
+			return [point] + latlng[k:]
+		distance -= step
+	return latlng[-1:]
+
+class EndpointIndex(object):
+	def __init__(self, segments = ()):
+		self._leaving = collections.defaultdict(list)	# node --> bearings of the segments leaving it
+		for segment in segments:
+			self.add(segment)
+
+	def add(self, segment):
+		latlng = segment['latlng']
+		if len(latlng) < 2:
+			return
+		self._leaving[_node(latlng[0])].append(_bearing(latlng[0], latlng[1]))
+		self._leaving[_node(latlng[-1])].append(_bearing(latlng[-1], latlng[-2]))
+
+	def degree(self, point):
+		return len(self._leaving.get(_node(point), ()))
+
+	def end_trim(self, point):
+		# Meters to cut off a segment at its end 'point'.
+		leaving = self._leaving.get(_node(point), ())
+		if len(leaving) == 2 and 180 - bearing_difference(*leaving) <= CONTINUATION_ANGLE:
+			return 0.0
+		return INTERSECTION_TRIM
+
+	def trim(self, segment):
+		# Saves the points to send as segment['path'] and returns the segment.
+		latlng = segment['latlng']
+		if len(latlng) < 2:
+			segment['path'] = []
+			return segment
+		limit = TRIM_MAX_SHARE * path_length(latlng)
+		path = _cut_start(latlng, min(self.end_trim(latlng[0]), limit))
+		segment['path'] = _cut_start(path[::-1], min(self.end_trim(latlng[-1]), limit))[::-1]
+		return segment
+
+	def trimmed(self, segments):
+		for segment in segments:
+			yield self.trim(segment)
+
+# ---------------------------------------------------------------------------
+
+# Reprojection to WGS84. Road inventories come in whatever coordinate system their
+# state (or State Plane zone) uses, so each set of vertices is reprojected from its
+# own CRS, REPROJECT_BATCH vertices per call. pyproj transforms a whole batch in
+# one call, and the Transformer for each source CRS is built once and reused for
+# every batch and every input in that CRS. Needs the pyproj package; see
+# has_reprojection().
+#
+# NAD 1983 is taken to WGS 84 with the same transformation arcpy is given,
+# WGS_1984_(ITRF00)_To_NAD_1983 (a shift of about 1 m, which matters next to the
+# Snap To Roads thresholds). pyproj's default for NAD 1983 is a zero shift, so
+# the ITRF00 Helmert parameters are applied explicitly, inverted and in
+# position vector convention.
+
+REPROJECT_BATCH = 10000
+WGS84 = 4326
+NAD83 = 4269
+NAD83_TO_WGS84 = "WGS_1984_(ITRF00)_To_NAD_1983"
+NAD83_TO_WGS84_PIPELINE = ("+proj=pipeline +step +proj=unitconvert +xy_in=deg +xy_out=rad +step +proj=cart +ellps=GRS80 "
+	"+step +proj=helmert +x=-0.9956 +y=1.9013 +z=0.5215 +rx=0.025915 +ry=0.009426 +rz=0.011599 +s=-0.00062 "
+	"+convention=position_vector +step +inv +proj=cart +ellps=WGS84 +step +proj=unitconvert +xy_in=rad +xy_out=deg")
+
+def source_crs(spatial_reference):
+	# An arcpy SpatialReference as pyproj reads it: its EPSG code, or else its WKT
+	# without the ';'-separated XY, Z and M domains exportToString() appends.
+	return spatial_reference.factoryCode or spatial_reference.exportToString().split(';')[0]
+
+def project_transform(spatial_reference):
+	# The geographic transformation arcpy.Project_management needs to WGS84: the
+	# ITRF00 one for NAD 1983, as the scripts always used, and arcpy's default otherwise.
+	return NAD83_TO_WGS84 if spatial_reference.GCS.datumName == 'D_North_American_1983' else ""
+
+def has_reprojection():
+	try:
+		import pyproj
+		return True
+	except ImportError:
+		return False
+
+class Reprojector(object):
+	def __init__(self):
+		self._transformers = {}
+		self.vertices = {}			# (source CRS, transformation) --> number of vertices reprojected
+
+	def transformers(self, crs, transform = ""):
+		# 'crs' is an EPSG code or a WKT string (ESRI WKT is accepted), and 'transform'
+		# is project_transform() of it. Returns the transformers to apply in turn.
+		key = (crs, transform)
+		if key not in self._transformers:
+			import pyproj
+			source = pyproj.CRS.from_user_input(crs)
+			if transform == NAD83_TO_WGS84:
+				self._transformers[key] = [
+					pyproj.Transformer.from_crs(source, pyproj.CRS.from_epsg(NAD83), always_xy = True),
+					pyproj.Transformer.from_pipeline(NAD83_TO_WGS84_PIPELINE)]
+			else:
+				self._transformers[key] = [pyproj.Transformer.from_crs(source, pyproj.CRS.from_epsg(WGS84), always_xy = True)]
+			self.vertices[key] = 0
+		return self._transformers[key]
+
+	def to_latlng(self, xy, crs, transform = ""):
+		# Returns [lat, lng] for every (x, y) in 'xy', given in 'crs'.
+		if not xy:
+			return []
+		lng = [j[0] for j in xy]
+		lat = [j[1] for j in xy]
+		for transformer in self.transformers(crs, transform):
+			lng, lat = transformer.transform(lng, lat)
+		self.vertices[(crs, transform)] += len(xy)
+		return [[lat[n], lng[n]] for n in range(len(xy))]
+
+# ---------------------------------------------------------------------------
+
+# Response decoders. With OSRM_ROUTE_OPTIONS the responses are small, so each
+# one is parsed with json.loads (C code in CPython) and only the fields the
+# classifiers use are looked up. Each decoder returns None when the response is
+# not in the expected shape, which callers treat as an error.
+
+_DECODE_ERRORS = (ValueError, KeyError, IndexError, TypeError, AttributeError)
+
+def _as_text(raw):
+	if isinstance(raw, bytes) and not isinstance(raw, str):
+		return raw.decode('utf-8')
+	return raw
+
+def decode_osrm_distance(raw):
+	# Returns routes[0].distance (in meters) from an OSRM /route response.
+	try:
+		return float(json.loads(_as_text(raw))['routes'][0]['distance'])
+	except _DECODE_ERRORS:
+		return None
+
+def decode_osrm_route(raw):
+	# Returns (distance, nodes, seams) from an OSRM /route response requested
+	# with OSRM_NODES_OPTIONS, where nodes are the OSM node ids of the legs of
+	# routes[0] joined by stitch_legs().
+	try:
+		route = json.loads(_as_text(raw))['routes'][0]
+		distance = float(route['distance'])
+		legs = [[int(node) for node in leg['annotation']['nodes']] for leg in route['legs']]
+	except _DECODE_ERRORS:
+		return None
+	nodes, seams = stitch_legs(legs)
+	return distance, nodes, seams
+
+def stitch_legs(legs):
+	# OSRM starts every leg on the edge the previous leg ended on, so leg k ending
+	# '..., u, v' is followed by leg k+1 starting 'u, v, ...' (or is the same 'u, v'
+	# when both waypoints lie on one edge). Each leg is joined on the longest run of
+	# nodes it shares with the end of the route so far. Returns (nodes, seams), where
+	# seams are the indices of the last shared node at each join: the waypoints.
+	nodes = []
+	seams = []
+	for leg in legs:
+		if nodes:
+			overlap = min(len(nodes), len(leg))
+			while overlap and nodes[len(nodes) - overlap:] != leg[:overlap]:
+				overlap -= 1
+			seams.append(len(nodes) - 1)
+			leg = leg[overlap:]
+		nodes.extend(leg)
+	return nodes, seams
+
+def decode_valhalla_length(raw):
+	# Returns trip.summary.length (in kilometers, converted to meters) from a 
+	# Valhalla /route response.
+	try:
+		return float(json.loads(_as_text(raw))['trip']['summary']['length']) * 1000
+	except _DECODE_ERRORS:
+		return None
+
+def decode_graphhopper_distance(raw):
+	# Returns paths[0].distance (in meters) from a GraphHopper /route response.
+	try:
+		return float(json.loads(_as_text(raw))['paths'][0]['distance'])
+	except _DECODE_ERRORS:
+		return None
+
+def decode_snapped_points(raw):
+	# Returns (n_returned, first, last) from a Snap To Roads response, where
+	# first and last are the (lat, lng) of the first and last snapped points.
+	# Responses that contain anything besides 'snappedPoints' (i.e. a
+	# 'warningMessage' when the segment is not in Google Maps) return an empty
+	# tuple, so they can be told apart from unreadable responses.
+	try:
+		response = json.loads(_as_text(raw))
+		if len(response) != 1 or 'snappedPoints' not in response:
+			return ()
+		points = response['snappedPoints']
+		if not points:
+			return 0, None, None
+		return len(points), _location(points[0]), _location(points[-1])
+	except _DECODE_ERRORS:
+		return None
+
+def _location(point):
+	return (float(point['location']['latitude']), float(point['location']['longitude']))
+
+# ---------------------------------------------------------------------------
+
+# Resilient request layer. Every OSRM and Snap To Roads call goes through a
+# RoutingBackend, which classifies failures, retries the transient ones with
+# jittered exponential backoff, can hedge slow requests with a duplicate, and
+# holds every call back for a while once the backend keeps failing (circuit
+# breaker), so the segments wait for the backend instead of failing.
+#
+#	transient	--> timeouts, connection errors, HTTP 429 and 5xx. Retried.
+#	permanent	--> any other HTTP error (bad request, bad key, ...). Not retried.
+#	response	--> a response the decoder could not read. Not retried.
+#	circuit_open	--> the backend is still down after BREAKER_GIVE_UP trials, no request was made.
+
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+RESPONSE = 'response'
+CIRCUIT_OPEN = 'circuit_open'
+
+REQUEST_TIMEOUT = 10			# seconds, per HTTP request
+RETRY_ATTEMPTS = 3				# retries after the first attempt
+RETRY_BASE_DELAY = 0.5			# seconds, doubled on every retry
+RETRY_MAX_DELAY = 8.0			# seconds
+RETRY_MAX_IN_FLIGHT = 4			# retries allowed at the same time, per backend
+HEDGE_MAX_IN_FLIGHT = 2			# hedged duplicates allowed at the same time, per backend
+BREAKER_THRESHOLD = 5			# consecutive transient failures that open the breaker
+BREAKER_RESET = 30.0			# seconds before a trial request is let through
+BREAKER_GIVE_UP = 10			# failed trials in a row before calls fail instead of waiting
+
+class RequestError(Exception):
+	def __init__(self, kind, message):
+		Exception.__init__(self, kind + ": " + message)
+		self.kind = kind
+
+def classify_error(error):
+	if isinstance(error, HTTPError):
+		if error.code == 429 or error.code >= 500:
+			return TRANSIENT
+		return PERMANENT
+	if isinstance(error, (URLError, socket.timeout, socket.error, IOError)):
+		return TRANSIENT
+	return PERMANENT
+
+def _start_thread(target):
+	thread = threading.Thread(target = target)
+	thread.daemon = True
+	thread.start()
+
+class _ThreadReuse(object):
+	# Runs functions on daemon threads that are kept once idle and reused, so a
+	# thread is only started when every earlier one is busy.
+	def __init__(self):
+		self._tasks = Queue()
+		self._idle = 0
+		self._lock = threading.Lock()
+
+	def run(self, function):
+		with self._lock:
+			if self._idle:
+				self._idle -= 1
+			else:
+				_start_thread(self._work)
+		self._tasks.put(function)
+
+	def _work(self):
+		while True:
+			self._tasks.get()()
+			with self._lock:
+				self._idle += 1
+
+class RoutingBackend(object):
+	# 'hedge_after' (seconds) sends a duplicate of any request that has not
+	# answered in that time and uses whichever response arrives first. Leave it
+	# as None for metered APIs, since the duplicate is billed like any request.
+	# No more than 'max_hedges_in_flight' duplicates are out at once, and none
+	# are sent unless the circuit breaker is closed, so a slow, overloaded
+	# backend does not see its traffic doubled.
+	# 'archive' is a ResponseArchive that every raw response is recorded to or,
+	# if it was opened for replay, answered from without any HTTP request.
+	def __init__(self, name, hedge_after = None, retries = RETRY_ATTEMPTS, max_retries_in_flight = RETRY_MAX_IN_FLIGHT, archive = None,
+			max_hedges_in_flight = HEDGE_MAX_IN_FLIGHT):
+		self.name = name
+		self.hedge_after = hedge_after
+		self.retries = retries
+		self.archive = archive
+		self.stats = {
+			'calls'		: 0,
+			'succeeded'	: 0,
+			'failed'	: 0,
+			'requests'	: 0,
+			'retries'	: 0,
+			'hedged'	: 0,
+			'breaker_opened': 0,
+			'held'		: 0,
+			TRANSIENT	: 0,
+			PERMANENT	: 0,
+			RESPONSE	: 0,
+			CIRCUIT_OPEN: 0,
+		}
+		self._lock = threading.Condition()
+		self._retry_slots = threading.Semaphore(max_retries_in_flight)
+		self._max_hedges = max_hedges_in_flight
+		self._hedges = 0
+		self._threads = _ThreadReuse()
+		self._failures = 0
+		self._opened_at = None
+		self._trial_in_flight = False
+		self._failed_trials = 0
+
+	def fetch(self, url, decode):
+		# Returns decode(response body), or raises RequestError once the request
+		# has failed for good.
+		self._count('calls')
+		attempt = 0
+		retry_slot = False
+		try:
+			while True:
+				try:
+					self._allow_request()
+					value = self._request(url, decode)
+				except RequestError as error:
+					self._record_failure(error)
+					if error.kind != TRANSIENT or attempt >= self.retries:
+						raise
+					# The retry slot is held until the retried request finishes, so a
+					# struggling backend never sees more than max_retries_in_flight
+					# retries on top of the regular traffic.
+					if not retry_slot:
+						retry_slot = self._retry_slots.acquire(False)
+						if not retry_slot:
+							raise
+					time.sleep(random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
+					attempt += 1
+					self._count('retries')
+					continue
+				self._record_success()
+				self._count('succeeded')
+				return value
+		except RequestError:
+			self._count('failed')
+			raise
+		finally:
+			if retry_slot:
+				self._retry_slots.release()
+
+	def report(self):
+		# Messages summarizing the run, for arcpy.AddMessage.
+		stats = self.stats
+		error_rate = 100.0 * stats['failed'] / stats['calls'] if stats['calls'] else 0.0
+		return [
+			self.name + ": " + str(stats['calls']) + " calls, " + str(stats['requests']) + " HTTP requests, " +
+				str(stats['retries']) + " retries, " + str(stats['hedged']) + " hedged",
+			self.name + ": " + str(stats['failed']) + " calls failed (" + ('%.1f' % error_rate) + "%) - errors by type: " +
+				"transient " + str(stats[TRANSIENT]) + ", permanent " + str(stats[PERMANENT]) +
+				", bad response " + str(stats[RESPONSE]) + ", circuit open " + str(stats[CIRCUIT_OPEN]),
+			self.name + ": circuit breaker opened " + str(stats['breaker_opened']) + " times, held back " + str(stats['held']) + " calls",
+		]
+
+	def _count(self, stat):
+		with self._lock:
+			self.stats[stat] += 1
+
+	def _attempt(self, url, decode):
+		if self.archive is not None and self.archive.replay:
+			body = self.archive.response(url)
+			if body is None:
+				raise RequestError(PERMANENT, "no recorded " + self.name + " response for this request")
+		else:
+			self._count('requests')
+			try:
+				handle = urlopen(url, timeout = REQUEST_TIMEOUT)
+				body = handle.read()
+			except Exception as error:
+				raise RequestError(classify_error(error), str(error))
+			if self.archive is not None:
+				self.archive.record(url, body)
+		value = decode(body)
+		if value is None:
+			raise RequestError(RESPONSE, "could not decode response from " + self.name)
+		return value
+
+	def _request(self, url, decode):
+		# A request that could be hedged is sent from a reused thread while this one
+		# waits for the first answer; any other request is sent from this thread.
+		if self.hedge_after is None or (self.archive is not None and self.archive.replay) or not self._may_hedge(False):
+			return self._attempt(url, decode)
+		answers = Queue()
+		def attempt(hedge = False):
+			try:
+				answers.put((None, self._attempt(url, decode)))
+			except RequestError as error:
+				answers.put((error, None))
+			finally:
+				if hedge:
+					with self._lock:
+						self._hedges -= 1
+		self._threads.run(attempt)
+		launched = 1
+		received = 0
+		timeout = self.hedge_after
+		while True:
+			try:
+				error, value = answers.get(timeout = timeout)
+			except Empty:
+				timeout = None
+				if self._may_hedge(True):
+					self._count('hedged')
+					self._threads.run(lambda: attempt(True))
+					launched = 2
+				continue
+			received += 1
+			if error is None:
+				return value
+			if received == launched:
+				raise error
+
+	def _may_hedge(self, take):
+		# True if the breaker is closed and a hedge is free, which is taken if 'take'.
+		with self._lock:
+			if self._opened_at is not None or self._trial_in_flight or self._hedges >= self._max_hedges:
+				return False
+			if take:
+				self._hedges += 1
+			return True
+
+	# Circuit breaker: closed until BREAKER_THRESHOLD transient failures in a row,
+	# then open for BREAKER_RESET seconds, then one trial request is let through,
+	# which either closes or re-opens it. Calls made while it is open wait until
+	# it closes; only once BREAKER_GIVE_UP trials in a row have failed do they
+	# fail straight away, so a backend that is down for good does not hang the run.
+	def _allow_request(self):
+		with self._lock:
+			held = False
+			while self._opened_at is not None:
+				if self._failed_trials >= BREAKER_GIVE_UP:
+					self.stats[CIRCUIT_OPEN] += 1
+					raise RequestError(CIRCUIT_OPEN, self.name + " is still down after " + str(self._failed_trials) + " trial requests")
+				wait = self._opened_at + BREAKER_RESET - time.time()
+				if not self._trial_in_flight and wait <= 0:
+					self._trial_in_flight = True
+					return
+				if not held:
+					self.stats['held'] += 1
+					held = True
+				# Woken when the trial request closes or re-opens the breaker.
+				self._lock.wait(None if self._trial_in_flight else wait)
+
+	def _record_success(self):
+		with self._lock:
+			self._failures = 0
+			self._opened_at = None
+			self._trial_in_flight = False
+			self._failed_trials = 0
+			self._lock.notify_all()
+
+	def _record_failure(self, error):
+		if error.kind == CIRCUIT_OPEN:
+			return
+		with self._lock:
+			self.stats[error.kind] += 1
+			if error.kind != TRANSIENT:
+				# The backend answered, so as far as the breaker is concerned it is up.
+				self._failures = 0
+				self._opened_at = None
+				self._trial_in_flight = False
+				self._failed_trials = 0
+				self._lock.notify_all()
+				return
+			self._failures += 1
+			if self._trial_in_flight:
+				self._failed_trials += 1
+			if self._trial_in_flight or (self._opened_at is None and self._failures >= BREAKER_THRESHOLD):
+				self._opened_at = time.time()
+				self._trial_in_flight = False
+				self.stats['breaker_opened'] += 1
+				self._lock.notify_all()
+
+# ---------------------------------------------------------------------------
+
+# Response archive. With an archive, a RoutingBackend records the raw body of
+# every response it receives, so a run can later be replayed without calling
+# the API again (and without using any quota), e.g. to tune thresholds. The
+# archive is a gzip-compressed file of JSON lines, one per request URL:
+#
+#	{"url": "https://roads.googleapis.com/v1/snapToRoads?path=...&key=", "response": "{...}"}
+#
+# API keys are removed from the URLs, so an archive can be shared and replayed
+# with any key (or none). Requests that failed are not recorded, and fail with a
+# permanent error when replayed.
+
+_API_KEY = re.compile(r'([?&]key=)[^&]*')
+
+def _archive_key(url):
+	return _API_KEY.sub(r'\1', url)
+
+class ResponseArchive(object):
+	def __init__(self, path, replay = False):
+		self.path = path
+		self.replay = replay
+		self._lock = threading.Lock()
+		self._responses = {}
+		self._file = None
+		if replay:
+			with gzip.open(path, 'rb') as infile:
+				for line in infile:
+					record = json.loads(_as_text(line))
+					self._responses[record['url']] = record['response']
+		else:
+			self._file = gzip.open(path, 'wb')
+
+	def __len__(self):
+		return len(self._responses)
+
+	def record(self, url, body):
+		url = _archive_key(url)
+		body = _as_text(body)
+		with self._lock:
+			# A hedged request can be answered twice; only the first answer is kept.
+			if url in self._responses:
+				return
+			self._responses[url] = True
+			self._file.write((json.dumps({'url': url, 'response': body}) + '\n').encode('utf-8'))
+
+	def response(self, url):
+		return self._responses.get(_archive_key(url))
+
+	def close(self):
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+
+# ---------------------------------------------------------------------------
+
+# Result aggregation. Each backend gives every segment id it looks at exactly
+# one verdict, kept in a dict per backend so that membership checks and lookups
+# are O(1) however large the network is.
+#
+#	OSRM		--> FLIP (one-way, digitized backwards), ONEWAY, TWOWAY, DRIVABLE, SKIP, ERROR
+#	Snap To Roads	--> FLIP, POTENTIAL_FLIP, OK (snapped cleanly), SKIP, ERROR
+
+FLIP = 'flip'
+ONEWAY = 'oneway'
+TWOWAY = 'twoway'
+POTENTIAL_FLIP = 'potential_flip'
+OK = 'ok'
+DRIVABLE = 'drivable'		# single-call mode: drivable as digitized, one-way/two-way not checked
+SKIP = 'skip'
+ERROR = 'error'
+
+class SegmentVerdicts(object):
+	def __init__(self, backends = ('osrm', 'google')):
+		self._verdicts = dict((backend, {}) for backend in backends)
+
+	def set(self, backend, id, verdict):
+		# A later verdict replaces an earlier one, i.e. POTENTIAL_FLIP --> FLIP.
+		self._verdicts[backend][id] = verdict
+
+	def get(self, backend, id):
+		return self._verdicts[backend].get(id)
+
+	def ids(self, backend, *verdicts):
+		return [id for id, verdict in self._verdicts[backend].items() if verdict in verdicts]
+
+	def count(self, backend, *verdicts):
+		return sum(1 for verdict in self._verdicts[backend].values() if verdict in verdicts)
+
+	def is_oneway(self, id):
+		return self.get('osrm', id) in (FLIP, ONEWAY)
+
+	def merged(self):
+		# Merge policy between the two backends, used for the output of Step 10:
+		#	flip		--> every segment Snap To Roads flagged to flip, then every
+		#				segment OSRM flagged to flip that Snap To Roads did not 
+		#				overrule (it found it OK or only a POTENTIAL_FLIP).
+		#	potential_flip	--> flagged for manual review by Snap To Roads.
+		#	oneway, twoway	--> OSRM verdicts, where OSRM FLIP segments count as one-way.
+		#	skip		--> too few points to be sent to either backend.
+		#	error		--> a request to either backend failed for good.
+		osrm = self._verdicts['osrm']
+		google = self._verdicts['google']
+		flip = self.ids('google', FLIP)
+		flip += [id for id, verdict in osrm.items() if verdict == FLIP and google.get(id) not in (FLIP, OK, POTENTIAL_FLIP)]
+		return {
+			'flip'		: flip,
+			'potential_flip': self.ids('google', POTENTIAL_FLIP),
+			'skip'		: self.ids('osrm', SKIP) + self.ids('google', SKIP),
+			'oneway'	: self.ids('osrm', FLIP, ONEWAY),
+			'twoway'	: self.ids('osrm', TWOWAY),
+			'error'		: self.ids('osrm', ERROR) + self.ids('google', ERROR),
+		}
+
+# ---------------------------------------------------------------------------
+
+# Confidence scoring. Every signal a segment has is turned into evidence that it
+# is digitized against the direction of traffic (positive) or along it
+# (negative), and the weighted sum is squashed into a confidence between 0 and 1,
+# where 0.5 means no evidence either way:
+#
+#	distance ratio	--> OSRM forward / reverse route length. Driving a one-way 
+#				street the wrong way forces a detour, so the ratio grows
+#				well past 1; log2 of the ratio, capped at +/-1. Without a
+#				reverse route (single-call mode), the forward route length
+#				over the length of the path sent is used instead, and a 
+#				route that doubles back on itself counts as full evidence.
+#	point mismatch	--> share of the points sent to Snap To Roads that were not
+#				returned (points on a one-way street snapped against traffic).
+#	bearing delta	--> degrees between the sent and snapped paths.
+#	snap offset	--> start-to-end length difference after snapping (~meters).
+#
+# The OSRM part alone decides which segments are worth a Snap To Roads request:
+# only one-way streets with a confidence inside UNCERTAIN_BAND are sent, the
+# rest are decided from OSRM. With Snap To Roads evidence added, a confidence of
+# at least FLIP_CONFIDENCE is a flip and REVIEW_CONFIDENCE a potential flip.
+
+TWOWAY_TOLERANCE = 0.001		# relative forward/reverse difference still counted as two-way
+OSRM_WEIGHT = 4.0
+POINTS_WEIGHT = 4.0
+POINTS_SCALE = 0.1				# share of points missing that counts as full evidence
+BEARING_WEIGHT = 1.5
+BEARING_SCALE = 4.0				# degrees; the old cutoff of 2 scores half
+OFFSET_WEIGHT = 1.5
+OFFSET_SCALE = 8.0				# ~meters; the old cutoff of 4 scores half
+UNCERTAIN_BAND = (0.2, 0.9)
+FLIP_CONFIDENCE = 0.9
+REVIEW_CONFIDENCE = 0.75
+
+def is_twoway(distance, distance_reverse):
+	return abs(distance - distance_reverse) <= TWOWAY_TOLERANCE * max(distance, distance_reverse)
+
+def bearing_difference(bearing_a, bearing_b):
+	difference = abs(bearing_a - bearing_b) % 360
+	return min(difference, 360 - difference)
+
+def flip_confidence(segment):
+	# 'segment' is a snap_list entry; signals it does not have add no evidence.
+	evidence = 0.0
+	distance = segment.get('distance')
+	distance_reverse = segment.get('distance_reverse')
+	if distance and distance_reverse:
+		ratio = math.log(distance / distance_reverse, 2)
+		evidence += OSRM_WEIGHT * max(-1.0, min(1.0, ratio))
+	elif segment.get('node_reversal'):
+		evidence += OSRM_WEIGHT
+	elif segment.get('detour_ratio'):
+		ratio = math.log(segment['detour_ratio'], 2)
+		evidence += OSRM_WEIGHT * max(-1.0, min(1.0, ratio))
+	if segment.get('point_mismatch') is not None:
+		evidence += POINTS_WEIGHT * min(1.0, segment['point_mismatch'] / POINTS_SCALE)
+	if segment.get('bearing_delta') is not None:
+		evidence += BEARING_WEIGHT * min(1.0, segment['bearing_delta'] / BEARING_SCALE)
+	if segment.get('snap_distance_delta') is not None:
+		evidence += OFFSET_WEIGHT * min(1.0, segment['snap_distance_delta'] / OFFSET_SCALE)
+	return 1.0 / (1.0 + math.exp(-evidence))
+
+def is_uncertain(confidence):
+	return UNCERTAIN_BAND[0] < confidence < UNCERTAIN_BAND[1]
+
+def confidence_verdict(confidence):
+	if confidence >= FLIP_CONFIDENCE:
+		return FLIP
+	if confidence >= REVIEW_CONFIDENCE:
+		return POTENTIAL_FLIP
+	return OK
+
+# ---------------------------------------------------------------------------
+
+# Fixed Snap To Roads thresholds (OneWayValidation_SnapToRoads.py). A segment that
+# snapped with as many points as were sent is compared with its snapped path: if
+# the end points are further apart than SNAP_DISTANCE_THRESHOLD (in 1e-5 degrees)
+# and the bearings differ by more than SNAP_BEARING_THRESHOLD degrees it is a FLIP,
+# if only one of them is off a POTENTIAL_FLIP.
+#
+# threshold_sweep() counts the verdicts every combination of thresholds would
+# give, for replayed runs (see ResponseArchive). Rather than classifying every
+# segment again for every combination, both measurements are sorted once and
+# each count is a bisection, so a sweep of a whole state takes well under a second.
+
+SNAP_DISTANCE_THRESHOLD = 4			# empirically derived
+SNAP_BEARING_THRESHOLD = 2			# empirically derived
+SWEEP_DISTANCE_THRESHOLDS = (1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30)
+SWEEP_BEARING_THRESHOLDS = (0.5, 1, 2, 3, 4, 5, 10, 15, 20, 45)
+
+def snap_verdict(snap_distance_delta, bearing_delta, distance_threshold = SNAP_DISTANCE_THRESHOLD, bearing_threshold = SNAP_BEARING_THRESHOLD):
+	distance_off = snap_distance_delta > distance_threshold
+	bearing_off = bearing_delta > bearing_threshold
+	if distance_off and bearing_off:
+		return FLIP
+	if distance_off or bearing_off:
+		return POTENTIAL_FLIP
+	return None
+
+def threshold_sweep(measurements, distance_thresholds = SWEEP_DISTANCE_THRESHOLDS, bearing_thresholds = SWEEP_BEARING_THRESHOLDS):
+	# 'measurements' holds (snap_distance_delta, bearing_delta) per segment. Returns
+	# (distance threshold, bearing threshold, n FLIP, n POTENTIAL_FLIP) for every combination,
+	# the same counts snap_verdict() would give.
+	n = len(measurements)
+	bearings = sorted(b for d, b in measurements)
+	by_distance = sorted(measurements)
+	distances = [d for d, b in by_distance]
+	sweep = []
+	for distance_threshold in distance_thresholds:
+		# Bearings of the segments whose distance is off.
+		off = sorted(b for d, b in by_distance[bisect.bisect_right(distances, distance_threshold):])
+		for bearing_threshold in bearing_thresholds:
+			both = len(off) - bisect.bisect_right(off, bearing_threshold)
+			bearing_off = n - bisect.bisect_right(bearings, bearing_threshold)
+			sweep.append((distance_threshold, bearing_threshold, both, len(off) + bearing_off - 2 * both))
+	return sweep
+
+# confidence_sweep() does the same for the confidence thresholds of the combined
+# script (OneWayValidation.py). Only the one-way streets OSRM found can change 
+# verdict, so each is measured once from the run replayed: its OSRM confidence, 
+# whether OSRM flipped it, and its confidence with the Snap To Roads evidence added.
+# For every UNCERTAIN_BAND, the streets outside it keep their OSRM verdict, and 
+# the combined confidences of the rest are sorted once, so that each pair of
+# FLIP_CONFIDENCE and REVIEW_CONFIDENCE is again two bisections. A band wider than
+# the one replayed takes in streets Snap To Roads was never asked about; they are
+# counted as unrecorded rather than guessed at.
+
+SWEEP_UNCERTAIN_BANDS = ((0.1, 0.95), (0.2, 0.9), (0.3, 0.9), (0.2, 0.8), (0.3, 0.8))
+SWEEP_FLIP_CONFIDENCES = (0.8, 0.85, 0.9, 0.95)
+SWEEP_REVIEW_CONFIDENCES = (0.6, 0.65, 0.7, 0.75, 0.8)
+
+def confidence_sweep(measurements, bands = SWEEP_UNCERTAIN_BANDS, flip_confidences = SWEEP_FLIP_CONFIDENCES, review_confidences = SWEEP_REVIEW_CONFIDENCES):
+	# 'measurements' holds (OSRM confidence, OSRM verdict is FLIP, sent to Snap To Roads,
+	# combined confidence) per one-way street, the last None if Snap To Roads gave no
+	# verdict. Returns (band, flip threshold, review threshold, n FLIP, n POTENTIAL_FLIP,
+	# n unrecorded) for every combination with review threshold <= flip threshold, the
+	# counts SegmentVerdicts.merged() would give.
+	sweep = []
+	for band in bands:
+		n_flip = 0
+		n_unrecorded = 0
+		confidences = []
+		for osrm_confidence, osrm_flip, sent, confidence in measurements:
+			if not band[0] < osrm_confidence < band[1]:
+				n_flip += osrm_flip
+			elif not sent:
+				n_unrecorded += 1
+			elif confidence is None:
+				n_flip += osrm_flip
+			else:
+				confidences.append(confidence)
+		confidences.sort()
+		n = len(confidences)
+		for flip_threshold in flip_confidences:
+			not_flip = bisect.bisect_left(confidences, flip_threshold)
+			for review_threshold in review_confidences:
+				if review_threshold > flip_threshold:
+					continue
+				not_review = bisect.bisect_left(confidences, review_threshold)
+				sweep.append((band, flip_threshold, review_threshold, n_flip + n - not_flip, not_flip - not_review, n_unrecorded))
+	return sweep
+
+# ---------------------------------------------------------------------------
+
+# OSRM classification of one snap_list entry. Only its 'path' is sent, so the
+# route is not snapped to a cross street (see EndpointIndex).
+#
+# Two requests are normally made: the route along the digitized direction and
+# the route against it, compared in Step 9. In single-call mode the route along
+# the digitized direction is requested with its OSM node ids and compared with
+# the length of the path sent:
+#
+#	--> a route DETOUR_FLIP_RATIO times longer than the path, or one that 
+#		travels a pair of nodes and later the same pair backwards (a u-turn 
+#		around the block), is a one-way street digitized backwards: FLIP.
+#	--> a route no more than DETOUR_CLEAN_RATIO times longer than the path, 
+#		with no u-turn, is drivable as digitized: DRIVABLE, unless the segment
+#		needs to be classified as one-way or two-way.
+#	--> anything else is inconclusive, and the reverse route is requested.
+
+DETOUR_FLIP_RATIO = 1.5
+DETOUR_CLEAN_RATIO = 1.1
+EARTH_RADIUS = 6371008.8		# meters
+
+def path_length(latlng):
+	# Great-circle length of a [lat, lng] path, in meters.
+	length = 0.0
+	for a, b in zip(latlng, latlng[1:]):
+		lat_a, lng_a = math.radians(float(a[0])), math.radians(float(a[1]))
+		lat_b, lng_b = math.radians(float(b[0])), math.radians(float(b[1]))
+		h = math.sin((lat_b - lat_a) / 2) ** 2 + math.cos(lat_a) * math.cos(lat_b) * math.sin((lng_b - lng_a) / 2) ** 2
+		length += 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(h)))
+	return length
+
+def has_node_reversal(nodes, seams = ()):
+	# True if the route travels a pair of nodes and later the same pair backwards.
+	# A plain out-and-back around a waypoint (the nodes between the two traversals
+	# read the same both ways, with a seam among them) is how OSRM turns on the
+	# edge a waypoint snapped to, and is not counted.
+	travelled = {}
+	for k, (a, b) in enumerate(zip(nodes, nodes[1:])):
+		if a == b:
+			continue
+		first = travelled.get((b, a))
+		if first is not None:
+			between = nodes[first:k + 2]
+			if between != between[::-1] or not any(first < seam <= k for seam in seams):
+				return True
+		travelled.setdefault((a, b), k)
+	return False
+
+def classify_osrm(segment, backend, single_call = False, need_oneway = True, base_url = None):
+	# Returns the OSRM verdict for 'segment' and saves the measurements behind it
+	# on the entry. Raises RequestError if a request fails for good.
+	latlng = segment['path']
+	if len(latlng) <= 1:
+		return SKIP
+	
+	if single_call:
+		distance, nodes, seams = backend.fetch(osrm_route_url(latlng, OSRM_NODES_OPTIONS, base_url), decode_osrm_route)
+		segment['distance'] = distance
+		length = path_length(latlng)
+		segment['detour_ratio'] = distance / length if length > 0 else None
+		segment['node_reversal'] = has_node_reversal(nodes, seams)
+		if segment['node_reversal'] or (segment['detour_ratio'] or 0) >= DETOUR_FLIP_RATIO:
+			segment['confidence'] = flip_confidence(segment)
+			return FLIP
+		if not need_oneway and segment['detour_ratio'] is not None and segment['detour_ratio'] <= DETOUR_CLEAN_RATIO:
+			segment['confidence'] = flip_confidence(segment)
+			return DRIVABLE
+	else:
+		segment['distance'] = backend.fetch(osrm_route_url(latlng, base_url = base_url), decode_osrm_distance)
+	segment['distance_reverse'] = backend.fetch(osrm_route_url(latlng[::-1], base_url = base_url), decode_osrm_distance)
+	return direction_verdict(segment)
+
+def direction_verdict(segment):
+	# The verdict for a segment with both route lengths: the shorter route is the
+	# direction of traffic.
+	segment['confidence'] = flip_confidence(segment)
+	if is_twoway(segment['distance'], segment['distance_reverse']):
+		return TWOWAY
+	elif segment['distance'] > segment['distance_reverse']:
+		return FLIP
+	else:
+		return ONEWAY
+
+# ---------------------------------------------------------------------------
+
+# OSM tag prefilter. Most segments of a road network are two-way, and OSRM needs
+# two routes to say so. An OsmOnewayIndex reads the drivable ways of an OSM
+# extract (.osm XML, or .osm.gz / .osm.bz2) and their oneway tags into a grid of
+# OSM_CELL degree cells, and twoway_way() checks a segment's path against it.
+# A segment is clearly two-way if:
+#
+#	--> at least OSM_TWOWAY_SHARE of its points lie within OSM_MATCH_DISTANCE
+#		of an OSM way running the same way (within OSM_MATCH_ANGLE), and
+#	--> none of its points lies near a one-way way (oneway=yes/1/-1/reversible,
+#		roundabouts, motorways), so dual carriageways and one-way pairs next to
+#		a two-way street are still sent to OSRM.
+#
+# Such segments are TWOWAY without any request, and the results table records
+# the OSM way that decided it; every other segment is classified by OSRM.
+
+OSM_CELL = 0.001				# degrees, ~100 m
+OSM_MATCH_DISTANCE = 12.0		# meters
+OSM_MATCH_ANGLE = 30.0			# degrees
+OSM_TWOWAY_SHARE = 0.9
+OSM_SAMPLE_POINTS = 20			# points of a segment checked, at most
+METERS_PER_DEGREE = 111320.0
+
+OSM_DRIVABLE = set([
+	'motorway', 'trunk', 'primary', 'secondary', 'tertiary', 'unclassified', 'residential',
+	'motorway_link', 'trunk_link', 'primary_link', 'secondary_link', 'tertiary_link',
+	'living_street', 'service', 'road',
+])
+OSM_ONEWAY_VALUES = set(['yes', 'true', '1', '-1', 'reversible', 'alternating'])
+
+def _open_extract(path):
+	if path.lower().endswith('.gz'):
+		return gzip.open(path, 'rb')
+	if path.lower().endswith('.bz2'):
+		return bz2.BZ2File(path, 'rb')
+	return open(path, 'rb')
+
+def _osm_elements(path, tag):
+	# Yields the <tag> elements of an OSM XML file one at a time. Every element read
+	# is dropped from the tree once the next one is needed.
+	root = None
+	with _open_extract(path) as extract:
+		for event, element in ElementTree.iterparse(extract, events = ('start', 'end')):
+			if root is None:
+				root = element
+			if event == 'end' and element.tag in ('node', 'way', 'relation'):
+				if element.tag == tag:
+					yield element
+				root.clear()
+
+def is_oneway_way(tags):
+	if tags.get('oneway') in OSM_ONEWAY_VALUES:
+		return True
+	if tags.get('oneway') == 'no':
+		return False
+	return tags.get('junction') in ('roundabout', 'circular') or tags.get('highway') == 'motorway'
+
+def _flat(point, lat0):
+	# [lat, lng] --> (x, y) in meters around latitude 'lat0'.
+	return (float(point[1]) * METERS_PER_DEGREE * math.cos(math.radians(lat0)), float(point[0]) * METERS_PER_DEGREE)
+
+def _distance_to_edge(p, a, b):
+	dx, dy = b[0] - a[0], b[1] - a[1]
+	length = dx * dx + dy * dy
+	t = 0.0 if length == 0 else max(0.0, min(1.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / length))
+	return math.hypot(p[0] - a[0] - t * dx, p[1] - a[1] - t * dy)
+
+class OsmOnewayIndex(object):
+	def __init__(self, path):
+		self.n_ways = 0
+		self.n_oneway = 0
+		self._cells = collections.defaultdict(list)		# (row, column) --> edges (a, b, way id, oneway)
+		
+		# Ways come after the nodes in an OSM file, so the drivable ways are read first
+		# and only the nodes they use are kept on a second pass.
+		ways = []
+		needed = set()
+		for way in _osm_elements(path, 'way'):
+			tags = dict((tag.get('k'), tag.get('v')) for tag in way.iter('tag'))
+			if tags.get('highway') not in OSM_DRIVABLE:
+				continue
+			refs = [nd.get('ref') for nd in way.iter('nd')]
+			ways.append((int(way.get('id')), refs, is_oneway_way(tags)))
+			needed.update(refs)
+		nodes = {}
+		for node in _osm_elements(path, 'node'):
+			if node.get('id') in needed:
+				nodes[node.get('id')] = (float(node.get('lat')), float(node.get('lon')))
+		
+		for way_id, refs, oneway in ways:
+			points = [nodes[ref] for ref in refs if ref in nodes]
+			for a, b in zip(points, points[1:]):
+				self._add_edge(a, b, way_id, oneway)
+			self.n_ways += 1
+			self.n_oneway += oneway
+
+	def _add_edge(self, a, b, way_id, oneway):
+		# Every cell within OSM_MATCH_DISTANCE of the edge's bounding box holds the edge,
+		# so a point only has to look in its own cell.
+		pad_lat = OSM_MATCH_DISTANCE / METERS_PER_DEGREE
+		pad_lng = pad_lat / max(math.cos(math.radians(a[0])), 0.01)
+		rows = range(int(math.floor((min(a[0], b[0]) - pad_lat) / OSM_CELL)), int(math.floor((max(a[0], b[0]) + pad_lat) / OSM_CELL)) + 1)
+		columns = range(int(math.floor((min(a[1], b[1]) - pad_lng) / OSM_CELL)), int(math.floor((max(a[1], b[1]) + pad_lng) / OSM_CELL)) + 1)
+		edge = (a, b, way_id, oneway)
+		for row in rows:
+			for column in columns:
+				self._cells[(row, column)].append(edge)
+
+	def _nearby_ways(self, point, bearing):
+		# (way id, oneway) of every OSM way near 'point' that runs along 'bearing'.
+		lat = float(point[0])
+		cell = (int(math.floor(lat / OSM_CELL)), int(math.floor(float(point[1]) / OSM_CELL)))
+		p = _flat(point, lat)
+		found = []
+		for a, b, way_id, oneway in self._cells.get(cell, ()):
+			if _distance_to_edge(p, _flat(a, lat), _flat(b, lat)) > OSM_MATCH_DISTANCE:
+				continue
+			difference = bearing_difference(_bearing(a, b), bearing)
+			if min(difference, 180 - difference) <= OSM_MATCH_ANGLE:
+				found.append((way_id, oneway))
+		return found
+
+	def twoway_way(self, path):
+		# Returns the id of the OSM way most of 'path' matched if the segment is clearly
+		# two-way, or None if it has to be classified by OSRM.
+		if len(path) < 2:
+			return None
+		step = max(1, len(path) // OSM_SAMPLE_POINTS)
+		samples = list(range(0, len(path), step))
+		matched = collections.Counter()
+		n_twoway = 0
+		for k in samples:
+			ahead = path[min(k + 1, len(path) - 1)]
+			behind = path[max(k - 1, 0)]
+			ways = self._nearby_ways(path[k], _bearing(behind, ahead))
+			if any(oneway for way_id, oneway in ways):
+				return None
+			if ways:
+				n_twoway += 1
+				matched.update(set(way_id for way_id, oneway in ways))
+		if n_twoway < OSM_TWOWAY_SHARE * len(samples):
+			return None
+		return matched.most_common(1)[0][0]
+
+# ---------------------------------------------------------------------------
+
+# Duplicate geometries. Road inventories often hold the same vertex sequence
+# more than once (overlapping route designations) or exactly reversed (the
+# same centerline digitized in both directions). Each coordinate sequence and
+# its reverse are hashed, only the first segment with a given geometry is sent
+# to the backends, and its results are copied to the later ones:
+#
+#	identical	--> every measurement and verdict is copied as is.
+#	reversed	--> the forward and reverse OSRM distances are swapped, the
+#				confidence is inverted and FLIP <--> ONEWAY. Snap To Roads
+#				results are not copied, since snapping the reversed path
+#				gives different points; neither are DRIVABLE verdicts,
+#				which say nothing about the opposite direction.
+#
+# Segments whose first copy SKIPped or hit an ERROR are classified on their own.
+#
+# Under a memory budget, compact() is called on every segment once its results
+# are final: a first segment is replaced by a _FirstRecord tuple of what its
+# duplicates copy, a duplicate is forgotten, and once more than 'max_history'
+# geometries are kept the oldest ones are dropped, so a later duplicate of them
+# is classified on its own.
+
+OSRM_MEASUREMENTS = ('distance', 'distance_reverse', 'detour_ratio', 'node_reversal', 'confidence')
+GOOGLE_MEASUREMENTS = ('point_mismatch', 'bearing_delta', 'snap_distance_delta', 'confidence')
+RECORD_KEYS = ('id', 'osm_way') + OSRM_MEASUREMENTS + tuple(key for key in GOOGLE_MEASUREMENTS if key not in OSRM_MEASUREMENTS)
+DUPLICATE_RECORD_BYTES = 450	# a geometry kept by DuplicateGeometries once compacted
+DUPLICATE_HISTORY_SHARE = 0.25	# share of the memory budget those may use
+
+_RECORD_INDEX = dict((key, n) for n, key in enumerate(RECORD_KEYS))
+
+class _FirstRecord(tuple):
+	# The values of RECORD_KEYS, read like the segment they were taken from.
+	__slots__ = ()
+
+	def __getitem__(self, key):
+		return tuple.__getitem__(self, _RECORD_INDEX[key])
+
+	def get(self, key, default = None):
+		value = tuple.__getitem__(self, _RECORD_INDEX[key])
+		return default if value is None else value
+
+def duplicate_history(max_memory):
+	# Geometries DuplicateGeometries keeps for a budget of 'max_memory' megabytes.
+	return max(1000, int(max_memory * 2 ** 20 * DUPLICATE_HISTORY_SHARE / DUPLICATE_RECORD_BYTES))
+
+_REVERSED_VERDICT = {FLIP: ONEWAY, ONEWAY: FLIP}
+
+def _geometry_digest(latlng):
+	return hashlib.sha1(';'.join(str(j[0]) + ',' + str(j[1]) for j in latlng).encode('utf-8')).digest()
+
+class DuplicateGeometries(object):
+	def __init__(self, max_history = None):
+		self.max_history = max_history
+		self._first = collections.OrderedDict()	# geometry digest --> id of the first segment with it
+		self._segments = {}			# id --> first segment, or its record once compacted
+		self.of = {}				# duplicate id --> (id of the first segment, reversed)
+		self.n_duplicates = 0
+		self.osrm_saved = 0
+		self.google_saved = 0
+
+	def match(self, segment):
+		# Returns (first segment, reversed) if an earlier segment has the same vertex
+		# sequence or its exact reverse. Otherwise 'segment' becomes the first of its
+		# geometry and (None, False) is returned.
+		forward = _geometry_digest(segment['latlng'])
+		if forward in self._first:
+			return self._segments[self._first[forward]], False
+		backward = _geometry_digest(segment['latlng'][::-1])
+		if backward in self._first:
+			return self._segments[self._first[backward]], True
+		self._first[forward] = segment['id']
+		self._segments[segment['id']] = segment
+		return None, False
+
+	def first_of(self, id):
+		# (first segment, reversed) for a duplicate id, or (None, True) for any other id
+		# or if the first segment is no longer kept.
+		first, reversed = self.of.get(id, (None, True))
+		first = self._segments.get(first)
+		return (first, reversed) if first is not None else (None, True)
+
+	def compact(self, segment):
+		id = segment['id']
+		self.of.pop(id, None)
+		if id not in self._segments:
+			return
+		self._segments[id] = _FirstRecord(segment.get(key) for key in RECORD_KEYS)
+		while self.max_history is not None and len(self._first) > self.max_history:
+			digest, oldest = self._first.popitem(last = False)
+			self._segments.pop(oldest, None)
+
+	def copy_osrm(self, first, segment, reversed, verdict):
+		# Returns the OSRM verdict for 'segment' taken from 'first' (whose verdict is
+		# 'verdict'), or None if it has to be classified on its own.
+		if verdict in (None, SKIP, ERROR) or (reversed and verdict == DRIVABLE):
+			return None
+		if reversed:
+			segment['distance'] = first.get('distance_reverse')
+			segment['distance_reverse'] = first.get('distance')
+			if first.get('confidence') is not None:
+				segment['confidence'] = 1.0 - first['confidence']
+			verdict = _REVERSED_VERDICT.get(verdict, verdict)
+		else:
+			for key in OSRM_MEASUREMENTS:
+				segment[key] = first.get(key)
+		segment['osm_way'] = first.get('osm_way')
+		segment['duplicate_of'] = first['id']
+		segment['duplicate_reversed'] = reversed
+		self.of[segment['id']] = (first['id'], reversed)
+		self.n_duplicates += 1
+		if first.get('distance') is not None:
+			self.osrm_saved += 2 if first.get('distance_reverse') is not None else 1
+		return verdict
+
+	def copy_google(self, segment, verdict_of):
+		# Returns the Snap To Roads verdict for 'segment' taken from an identical
+		# segment already checked, or None. 'verdict_of(id)' looks up a verdict.
+		first, reversed = self.first_of(segment['id'])
+		if reversed or verdict_of(first['id']) in (None, SKIP, ERROR):
+			return None
+		for key in GOOGLE_MEASUREMENTS:
+			segment[key] = first.get(key)
+		self.google_saved += 1
+		return verdict_of(first['id'])
+
+# ---------------------------------------------------------------------------
+
+# Memory profiling. A MemoryMonitor samples the resident set size (RSS) of the
+# process and, with 'trace', the memory allocated by Python (tracemalloc, which
+# slows allocation down, so it is off unless asked for) at stage boundaries:
+#
+#	memory after validate: RSS 512.3 MB, Python heap 120.1 MB (peak 300.2 MB)
+#
+# RSS is read with psutil if it is installed, or from /proc on Linux.
+
+def resident_memory():
+	# RSS of this process in bytes, or None if it cannot be read.
+	try:
+		import psutil
+		return psutil.Process().memory_info().rss
+	except ImportError:
+		pass
+	try:
+		with open('/proc/self/statm') as statm:
+			return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (IOError, OSError, ValueError, AttributeError):
+		return None
+
+def _megabytes(n_bytes):
+	return '%.1f MB' % (n_bytes / 2.0 ** 20)
+
+class MemoryMonitor(object):
+	def __init__(self, trace = False):
+		self.samples = []			# (stage, RSS, Python heap, Python heap peak), in bytes or None
+		self._tracemalloc = None
+		if trace:
+			try:
+				import tracemalloc
+			except ImportError:
+				return
+			tracemalloc.start()
+			self._tracemalloc = tracemalloc
+
+	def sample(self, stage):
+		current = peak = None
+		if self._tracemalloc is not None:
+			current, peak = self._tracemalloc.get_traced_memory()
+		sample = (stage, resident_memory(), current, peak)
+		self.samples.append(sample)
+		return sample
+
+	def status(self, stage):
+		stage, resident, current, peak = self.sample(stage)
+		parts = []
+		if resident is not None:
+			parts.append('RSS ' + _megabytes(resident))
+		if current is not None:
+			parts.append('Python heap ' + _megabytes(current) + ' (peak ' + _megabytes(peak) + ')')
+		return 'memory after ' + stage + ': ' + (', '.join(parts) if parts else 'not available')
+
+	def stop(self):
+		if self._tracemalloc is not None:
+			self._tracemalloc.stop()
+			self._tracemalloc = None
+
+# ---------------------------------------------------------------------------
+
+# Progress reporting. The per-segment messages are commented out for speed, so a
+# ProgressReporter counts segments as they finish and, at most once every
+# PROGRESS_INTERVAL seconds, hands a status line and the percent done to 'show'
+# (which the scripts point at arcpy.SetProgressor and the console). Counting costs
+# one time.time() per segment, nothing next to an HTTP request.
+#
+#	OSRM: 1200/20000 segments (6%), 35.2/s, ETA 8m 54s, 0.4% errors
+
+PROGRESS_INTERVAL = 2.0			# seconds between updates
+
+def format_duration(seconds):
+	seconds = int(round(seconds))
+	if seconds >= 3600:
+		return str(seconds // 3600) + 'h ' + str(seconds % 3600 // 60) + 'm'
+	if seconds >= 60:
+		return str(seconds // 60) + 'm ' + str(seconds % 60) + 's'
+	return str(seconds) + 's'
+
+class ProgressReporter(object):
+	def __init__(self, label, total, show, interval = PROGRESS_INTERVAL):
+		self.label = label
+		self.total = total
+		self.show = show
+		self.interval = interval
+		self.done = 0
+		self.errors = 0
+		self._start = time.time()
+		self._next = self._start + interval
+
+	def step(self, error = False):
+		self.done += 1
+		if error:
+			self.errors += 1
+		now = time.time()
+		if now >= self._next:
+			self._next = now + self.interval
+			self.show(self.status(now), self.percent())
+
+	def finish(self):
+		self.show(self.status(time.time()), self.percent())
+
+	def percent(self):
+		return int(100 * self.done / self.total) if self.total else 100
+
+	def status(self, now):
+		elapsed = max(now - self._start, 1e-6)
+		rate = self.done / elapsed
+		line = self.label + ': ' + str(self.done) + '/' + str(self.total) + ' segments (' + str(self.percent()) + '%), '
+		line += '%.1f/s' % rate
+		if self.done < self.total:
+			line += ', ETA ' + (format_duration((self.total - self.done) / rate) if rate > 0 else '?')
+		else:
+			line += ', done in ' + format_duration(elapsed)
+		if self.done:
+			line += ', %.1f%% errors' % (100.0 * self.errors / self.done)
+		return line
+
+# ---------------------------------------------------------------------------
+
+# Stage pipeline. OneWayValidation.py classifies segments with OSRM and checks
+# the ones it queues with Snap To Roads through a pipeline with this interface:
+#
+#	pipeline.run(segments, classified, checked)
+#		--> classify(segment) for every segment, then classified(segment);
+#		    check(segment) for every segment queued with check_later(),
+#		    then checked(segment). Callbacks may queue more segments with
+#		    classify_later() and check_later().
+#
+# make_pipeline() returns the asyncio pipeline of OneWayValidation_Pipeline.py
+# (Python 3), in which both stages run at once with their own number of workers.
+# On Python 2 (ArcGIS Desktop) it returns a SequentialPipeline, which classifies
+# every segment before checking any, one request at a time, as the tool always did.
+# Segments can be queued before run() as well, and run() can be called again with
+# more segments (one chunk at a time).
+
+PIPELINE_OSRM_WORKERS = 4			# concurrent OSRM requests
+PIPELINE_GOOGLE_WORKERS = 2			# concurrent Snap To Roads requests
+
+class SequentialPipeline(object):
+	def __init__(self, classify, check):
+		self.classify = classify
+		self.check = check
+		self._to_classify = collections.deque()
+		self._to_check = collections.deque()
+
+	def classify_later(self, segment):
+		self._to_classify.append(segment)
+
+	def check_later(self, segment):
+		self._to_check.append(segment)
+
+	def run(self, segments, classified, checked):
+		self._to_classify.extend(segments)
+		while self._to_classify or self._to_check:
+			if self._to_classify:
+				segment = self._to_classify.popleft()
+				self.classify(segment)
+				classified(segment)
+			else:
+				segment = self._to_check.popleft()
+				self.check(segment)
+				checked(segment)
+
+def make_pipeline(classify, check, classify_workers = PIPELINE_OSRM_WORKERS, check_workers = PIPELINE_GOOGLE_WORKERS):
+	try:
+		from OneWayValidation_Pipeline import Pipeline
+	except (ImportError, SyntaxError):
+		return SequentialPipeline(classify, check)
+	return Pipeline(classify, check, classify_workers, check_workers)
+
+# ---------------------------------------------------------------------------
+
+# Routing providers. The scripts ask a provider for one of two things, a batch
+# of snap_list entries at a time, and only ever send it each entry's 'path':
+#
+#	DirectionProvider.classify_direction(segments)	--> a direction verdict
+#				per segment (FLIP, ONEWAY, TWOWAY, DRIVABLE, SKIP or ERROR),
+#				with the route lengths behind it saved on the entry as
+#				classify_osrm() does. Subclasses define classify_segment().
+#	SnapProvider.snap(segments)	--> per segment, (n_sent, n_returned, first,
+#				last) as in decode_snapped_points(), None if the road was not
+#				found, or SKIP or ERROR. Subclasses define snap_segment().
+#
+# Each provider declares how many segments it takes per call ('batch_size') and
+# how many calls may run at once ('concurrency'), which the stage pipeline and 
+# OneWayValidation_Benchmark.py size their workers from. Every request goes
+# through the provider's RoutingBackend, with its retries and circuit breaker.
+#
+#	OsrmProvider		--> classify_osrm(), including single-call mode.
+#	ValhallaProvider	--> a Valhalla server's /route service, both ways.
+#	GraphHopperProvider	--> a GraphHopper server's /route service, both ways.
+#	GoogleRoadsProvider	--> Snap To Roads, the first 100 points of each path.
+#
+# make_provider() picks a direction provider by name, for the script tools.
+
+class RoutingProvider(object):
+	name = None
+	batch_size = 1
+	concurrency = 1
+	seconds_key = 'osrm_seconds'		# results column for the time spent on each segment
+
+	def __init__(self, backend):
+		self.backend = backend
+
+	def _each(self, segments, method):
+		results = []
+		for segment in segments:
+			if len(segment['path']) <= 1:
+				results.append(SKIP)
+				continue
+			ts = time.time()
+			try:
+				results.append(method(segment))
+			except RequestError:
+				results.append(ERROR)
+			finally:
+				segment[self.seconds_key] = time.time() - ts
+		return results
+
+class DirectionProvider(RoutingProvider):
+	def classify_direction(self, segments):
+		return self._each(segments, self.classify_segment)
+
+class SnapProvider(RoutingProvider):
+	seconds_key = 'google_seconds'
+
+	def snap(self, segments):
+		return self._each(segments, self.snap_segment)
+
+class OsrmProvider(DirectionProvider):
+	name = 'OSRM'
+	concurrency = PIPELINE_OSRM_WORKERS
+
+	def __init__(self, backend, base_url = None, single_call = False, need_oneway = True):
+		RoutingProvider.__init__(self, backend)
+		self.base_url = base_url
+		self.single_call = single_call
+		self.need_oneway = need_oneway
+
+	def classify_segment(self, segment):
+		return classify_osrm(segment, self.backend, self.single_call, self.need_oneway, self.base_url)
+
+class ValhallaProvider(DirectionProvider):
+	# Meant for a locally hosted server, so it is given more concurrent requests
+	# than the public OSRM server. 'max_locations' should match the server's
+	# service_limits.
+	name = 'Valhalla'
+	concurrency = 8
+
+	def __init__(self, backend, base_url = None, max_locations = VALHALLA_MAX_LOCATIONS):
+		RoutingProvider.__init__(self, backend)
+		self.base_url = base_url or VALHALLA_URL
+		self.max_locations = max_locations
+
+	def classify_segment(self, segment):
+		path = segment['path']
+		segment['distance'] = self.backend.fetch(valhalla_route_url(path, self.base_url, self.max_locations), decode_valhalla_length)
+		segment['distance_reverse'] = self.backend.fetch(valhalla_route_url(path[::-1], self.base_url, self.max_locations), decode_valhalla_length)
+		return direction_verdict(segment)
+
+class GraphHopperProvider(DirectionProvider):
+	name = 'GraphHopper'
+	concurrency = 8
+
+	def __init__(self, backend, base_url = None):
+		RoutingProvider.__init__(self, backend)
+		self.base_url = base_url or GRAPHHOPPER_URL
+
+	def classify_segment(self, segment):
+		path = segment['path']
+		segment['distance'] = self.backend.fetch(graphhopper_route_url(path, self.base_url), decode_graphhopper_distance)
+		segment['distance_reverse'] = self.backend.fetch(graphhopper_route_url(path[::-1], self.base_url), decode_graphhopper_distance)
+		return direction_verdict(segment)
+
+class GoogleRoadsProvider(SnapProvider):
+	# Not hedged or given more workers: every request counts against the API key's quota.
+	name = 'Snap To Roads'
+	concurrency = PIPELINE_GOOGLE_WORKERS
+
+	def __init__(self, backend, key):
+		RoutingProvider.__init__(self, backend)
+		self.key = key
+
+	def snap_segment(self, segment):
+		sent = segment['path'][:100]
+		snapped = self.backend.fetch(snap_to_roads_url(sent, self.key), decode_snapped_points)
+		if not snapped:
+			return None
+		return (len(sent),) + snapped
+
+DIRECTION_PROVIDERS = {'osrm': OsrmProvider, 'valhalla': ValhallaProvider, 'graphhopper': GraphHopperProvider}
+
+def make_provider(name, backend, base_url = None, single_call = False, need_oneway = True):
+	# The direction provider called 'name' (OSRM, Valhalla or GraphHopper), sending its
+	# requests to 'base_url', or to its default server. Only OSRM has a single-call mode.
+	provider = DIRECTION_PROVIDERS.get(name.lower())
+	if provider is None:
+		raise ValueError("Unknown routing provider: " + name)
+	if provider is OsrmProvider:
+		return OsrmProvider(backend, base_url, single_call, need_oneway)
+	return provider(backend, base_url)
+
+# ---------------------------------------------------------------------------
+
+# Per-segment results table. One row per segment with both backends' verdicts
+# and the measurements behind them, written in a columnar format so QA and GIS
+# joins can load it without rerunning the tool. Rows are buffered and written
+# RESULTS_ROW_GROUP rows at a time while the run is in progress:
+#
+#	.parquet	--> one Parquet row group per flush. Needs the pyarrow package.
+#	.gpkg		--> an attribute table in a GeoPackage, one transaction per flush.
+#				Written with the sqlite3 module, so it is always available.
+#				The id column is indexed but not a key, so an id that appears
+#				twice in the road network gets two rows.
+#
+# The table is a by-product of the run: if it cannot be written (a full disk, a
+# locked file, a bad value), the error is kept in 'error', the rest of the rows
+# are dropped and counted, and classification carries on. status() reports it.
+
+RESULTS_ROW_GROUP = 5000
+
+# (column, type) in table order; the first column is named after the unique id field,
+# and every column after the two verdicts is read from the snap_list entry key of the same name.
+RESULTS_COLUMNS = [
+	('id', 'int64'),
+	('osrm_verdict', 'string'),
+	('google_verdict', 'string'),
+	('distance', 'double'),				# OSRM route length along the digitized direction, meters
+	('distance_reverse', 'double'),		# OSRM route length against it, meters
+	('bearing_delta', 'double'),		# degrees between the sent and snapped paths
+	('snap_distance_delta', 'double'),	# start-to-end length difference after snapping, ~meters
+	('point_mismatch', 'double'),		# share of points Snap To Roads did not return
+	('detour_ratio', 'double'),			# single-call mode: route length / length of the path sent
+	('confidence', 'double'),			# see flip_confidence()
+	('duplicate_of', 'int64'),			# id of the identical or reversed segment whose requests were reused
+	('duplicate_reversed', 'bool'),
+	('osm_way', 'int64'),				# OSM way whose tags made the segment two-way without OSRM requests
+	('osrm_seconds', 'double'),			# time spent classifying direction, with whichever routing provider
+	('google_seconds', 'double'),
+]
+
+def results_table_path(folder, name):
+	try:
+		import pyarrow
+		extension = '.parquet'
+	except ImportError:
+		extension = '.gpkg'
+	return os.path.join(folder, name + '_results' + extension)
+
+class ResultsTable(object):
+	def __init__(self, path, id_field = 'id'):
+		self.path = path
+		self.columns = [id_field] + [column for column, type in RESULTS_COLUMNS[1:]]
+		self.rows_written = 0
+		self.rows_dropped = 0
+		self.error = None
+		self._rows = []
+		self._parquet = None
+		self._sqlite = None
+		try:
+			if os.path.exists(path):
+				os.remove(path)
+			if path.lower().endswith('.parquet'):
+				import pyarrow
+				import pyarrow.parquet
+				self._pyarrow = pyarrow
+				types = {'int64': pyarrow.int64(), 'string': pyarrow.string(), 'double': pyarrow.float64(), 'bool': pyarrow.bool_()}
+				self._schema = pyarrow.schema([(name, types[type]) for name, (column, type) in zip(self.columns, RESULTS_COLUMNS)])
+				self._parquet = pyarrow.parquet.ParquetWriter(path, self._schema)
+			else:
+				self._sqlite = _create_geopackage_table(path, os.path.splitext(os.path.basename(path))[0], self.columns)
+		except _RESULTS_WRITE_ERRORS as error:
+			self.error = error
+
+	def add_segment(self, segment, osrm_verdict, google_verdict = None):
+		# 'segment' is a snap_list entry; measurements it does not have are left null.
+		row = [int(segment['id']), osrm_verdict, google_verdict]
+		row.extend(segment.get(column) for column, type in RESULTS_COLUMNS[3:])
+		self._rows.append(tuple(row))
+		if len(self._rows) >= RESULTS_ROW_GROUP:
+			self.flush()
+
+	def flush(self):
+		if not self._rows:
+			return
+		rows, self._rows = self._rows, []
+		if self.error is None:
+			try:
+				self._write(rows)
+				self.rows_written += len(rows)
+				return
+			except _RESULTS_WRITE_ERRORS as error:
+				self.error = error
+		self.rows_dropped += len(rows)
+
+	def _write(self, rows):
+		if self._parquet is not None:
+			columns = list(zip(*rows))
+			arrays = [self._pyarrow.array(list(values), type = field.type) for values, field in zip(columns, self._schema)]
+			self._parquet.write_table(self._pyarrow.Table.from_arrays(arrays, schema = self._schema))
+		else:
+			table, connection = self._sqlite
+			try:
+				connection.executemany(
+					'INSERT INTO "' + table + '" VALUES (' + ', '.join(['?'] * len(self.columns)) + ')',
+					rows
+				)
+				connection.commit()
+			except sqlite3.Error:
+				connection.rollback()
+				raise
+
+	def close(self):
+		self.flush()
+		try:
+			if self._parquet is not None:
+				self._parquet.close()
+			elif self._sqlite is not None:
+				self._sqlite[1].close()
+		except _RESULTS_WRITE_ERRORS as error:
+			if self.error is None:
+				self.error = error
+
+	def status(self):
+		if self.error is None:
+			return "Per-segment results saved: " + self.path
+		return "Per-segment results could not be saved to " + self.path + " (" + str(self.error) + "), " + str(self.rows_dropped) + " rows not written"
+
+# pyarrow errors derive from these too (ArrowIOError, ArrowInvalid, ArrowTypeError).
+_RESULTS_WRITE_ERRORS = (sqlite3.Error, EnvironmentError, ValueError, TypeError)
+_SQLITE_TYPES = {'int64': 'INTEGER', 'string': 'TEXT', 'double': 'REAL', 'bool': 'BOOLEAN'}
+
+def _create_geopackage_table(path, table, columns):
+	# Minimal GeoPackage 1.2 holding a single attributes (non-spatial) table:
+	# the required spatial reference and contents tables, plus the data table.
+	connection = sqlite3.connect(path)
+	connection.executescript("""
+		PRAGMA application_id = 1196444487;
+		PRAGMA user_version = 10200;
+		CREATE TABLE gpkg_spatial_ref_sys (
+			srs_name TEXT NOT NULL, srs_id INTEGER PRIMARY KEY, organization TEXT NOT NULL,
+			organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT);
+		INSERT INTO gpkg_spatial_ref_sys VALUES
+			('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', 'undefined cartesian coordinate reference system'),
+			('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', 'undefined geographic coordinate reference system'),
+			('WGS 84 geodetic', 4326, 'EPSG', 4326, 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]]', 'longitude/latitude coordinates in decimal degrees on the WGS 84 spheroid');
+		CREATE TABLE gpkg_contents (
+			table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, identifier TEXT UNIQUE,
+			description TEXT DEFAULT '', last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+			min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER);
+	""")
+	definition = ['"' + columns[0] + '" INTEGER']
+	for name, (column, type) in zip(columns[1:], RESULTS_COLUMNS[1:]):
+		definition.append('"' + name + '" ' + _SQLITE_TYPES[type])
+	connection.execute('CREATE TABLE "' + table + '" (' + ', '.join(definition) + ')')
+	connection.execute('CREATE INDEX "' + table + '_' + columns[0] + '" ON "' + table + '" ("' + columns[0] + '")')
+	connection.execute("INSERT INTO gpkg_contents (table_name, data_type, identifier) VALUES (?, 'attributes', ?)", (table, table))
+	connection.commit()
+	return table, connection
+
+# ---------------------------------------------------------------------------
+
+# Staged edits. The ids to flip or reclassify are written to a staging table in the
+# working geodatabase, one row per unique id with 'flip' (1 if the polyline is
+# reversed) and 'streetoperation' (1 = one-way, 2 = two-way, null if left as is),
+# so the changes can be joined to the road network and reviewed. The working
+# feature classes are then updated from it in one pass, without any
+# 'IN (...)' where clause, which grows with every id and is invalid when empty.
+
+STAGING_FIELDS = ["flip", "streetoperation"]
+
+def staged_changes(flip_ids = (), twoway_ids = (), oneway_ids = ()):
+	# {id: [flip, streetoperation]} for every id with a change.
+	changes = {}
+	for id in flip_ids:
+		changes[id] = [1, None]
+	for id in twoway_ids:
+		changes.setdefault(id, [0, None])[1] = 2
+	for id in oneway_ids:
+		changes.setdefault(id, [0, None])[1] = 1
+	return changes
+
+def stage_changes(workspace, name, unique_id, changes):
+	# Replaces the staging table 'name' in 'workspace' with 'changes' and returns its path.
+	arcpy = sys.modules['arcpy']
+	staging_table = workspace + '\\' + name
+	if arcpy.Exists(staging_table):
+		arcpy.Delete_management(staging_table)
+	arcpy.CreateTable_management(workspace, name)
+	arcpy.AddField_management(staging_table, unique_id, "LONG")
+	arcpy.AddField_management(staging_table, "flip", "SHORT")
+	arcpy.AddField_management(staging_table, "streetoperation", "SHORT")
+	with arcpy.da.InsertCursor(staging_table, [unique_id] + STAGING_FIELDS) as cursor:
+		for id in sorted(changes):
+			cursor.insertRow([id] + changes[id])
+	return staging_table
+
+def _reversed_polyline(arcpy, shape):
+	# Both the points of each part and the order of the parts are reversed, so a
+	# multipart polyline runs from its old last point back to its old first point.
+	parts = arcpy.Array([arcpy.Array([point for point in reversed(list(part))]) for part in reversed(list(shape))])
+	return arcpy.Polyline(parts, shape.spatialReference, shape.hasZ, shape.hasM)
+
+def apply_staged_changes(workspace, feature_classes, staging_table, unique_id, reclassify):
+	# The staging table is read into a dict keyed by unique id, then every feature class
+	# is updated in one pass: polylines marked 'flip' have their vertices reversed (as
+	# FlipLine_edit does), and STREETOPERATION is set where staged if 'reclassify'. Rows
+	# with no geometry are left alone. All edits are made in a single edit session, which
+	# is saved only if every update succeeds. Returns (polylines flipped, polylines reclassified).
+	arcpy = sys.modules['arcpy']
+	staged = {}
+	with arcpy.da.SearchCursor(staging_table, [unique_id] + STAGING_FIELDS) as cursor:
+		for id, flip, streetoperation in cursor:
+			staged[id] = (flip, streetoperation)
+	n_flipped = 0
+	n_reclassified = 0
+	if not staged:
+		return n_flipped, n_reclassified
+	update_fields = [unique_id, "SHAPE@"]
+	if reclassify:
+		update_fields.append("STREETOPERATION")
+	with arcpy.da.Editor(workspace):
+		for fc in feature_classes:
+			with arcpy.da.UpdateCursor(workspace + '\\' + fc, update_fields) as cursor:
+				for row in cursor:
+					if row[0] not in staged or row[1] is None:
+						continue
+					flip, streetoperation = staged[row[0]]
+					if flip:
+						row[1] = _reversed_polyline(arcpy, row[1])
+						n_flipped += 1
+					if reclassify and streetoperation is not None:
+						row[2] = streetoperation
+						n_reclassified += 1
+					cursor.updateRow(row)
+	return n_flipped, n_reclassified
+
+# ---------------------------------------------------------------------------
@@ -0,0 +1,339 @@
+# ---------------------------------------------------------------------------
+#
+# File Name:
+#	test_OneWayValidation_Utils.py
+#
+# Description:
+# 	Unit tests for OneWayValidation_Utils.py. No network access or arcpy is
+#	needed:
+#
+#		python -m pytest test_OneWayValidation_Utils.py
+#		python -m unittest test_OneWayValidation_Utils
+#
+# ---------------------------------------------------------------------------
+
+import gzip
+import json
+import math
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+import OneWayValidation_Utils as utils
+
+try:
+	from urllib import unquote
+except ImportError:
+	from urllib.parse import unquote
+
+def osrm_route(distance, legs):
+	return json.dumps({'code': 'Ok', 'routes': [{'distance': distance, 'legs': [{'annotation': {'nodes': leg}} for leg in legs]}]})
+
+class DecoderTest(unittest.TestCase):
+	def test_snapped_points(self):
+		points = [{'location': {'latitude': 42.0 + k * 1e-4, 'longitude': -71.0}, 'originalIndex': k} for k in range(3)]
+		self.assertEqual(utils.decode_snapped_points(json.dumps({'snappedPoints': points}).encode('utf-8')), (3, (42.0, -71.0), (42.0002, -71.0)))
+		self.assertEqual(utils.decode_snapped_points(json.dumps({'snappedPoints': []})), (0, None, None))
+		self.assertEqual(utils.decode_snapped_points(json.dumps({'snappedPoints': points, 'warningMessage': 'not found'})), ())
+
+	def test_unreadable_responses_decode_to_none(self):
+		for raw in ('', 'not json', '{"routes": []}', '{"code": "NoRoute"}', '[1, 2]'):
+			self.assertIsNone(utils.decode_osrm_distance(raw))
+			self.assertIsNone(utils.decode_osrm_route(raw))
+		self.assertIsNone(utils.decode_snapped_points('not json'))
+
+	def test_route_lengths(self):
+		self.assertEqual(utils.decode_osrm_distance(osrm_route(123.4, [[1, 2]])), 123.4)
+		self.assertEqual(utils.decode_valhalla_length('{"trip": {"summary": {"length": 0.25}}}'), 250.0)
+		self.assertEqual(utils.decode_graphhopper_distance('{"paths": [{"distance": 12.5}]}'), 12.5)
+
+class NodeReversalTest(unittest.TestCase):
+	def reversal(self, legs):
+		distance, nodes, seams = utils.decode_osrm_route(osrm_route(100.0, legs))
+		return utils.has_node_reversal(nodes, seams)
+
+	def test_legs_are_stitched_on_shared_nodes(self):
+		distance, nodes, seams = utils.decode_osrm_route(osrm_route(100.0, [[1, 2, 3], [2, 3, 4], [3, 4, 5]]))
+		self.assertEqual(nodes, [1, 2, 3, 4, 5])
+		self.assertEqual(seams, [2, 3])
+
+	def test_overlapping_legs_are_not_a_reversal(self):
+		# Densified waypoints on one OSM edge give legs [u, v], [u, v], ...
+		self.assertFalse(self.reversal([[1, 2], [1, 2], [1, 2], [1, 2, 3]]))
+		self.assertFalse(self.reversal([[1, 2, 3], [2, 3], [2, 3, 4, 5], [4, 5, 6]]))
+
+	def test_turn_on_a_waypoint_edge_is_not_a_reversal(self):
+		self.assertFalse(self.reversal([[1, 2, 3], [3, 2, 1]]))
+
+	def test_detour_around_the_block_is_a_reversal(self):
+		self.assertTrue(self.reversal([[1, 2, 3], [3, 4, 5, 6, 3, 2, 7]]))
+		self.assertTrue(self.reversal([[1, 2, 3, 4, 5, 6, 3, 2, 7]]))
+
+@unittest.skipUnless(utils.has_reprojection(), "needs pyproj")
+class ReprojectorTest(unittest.TestCase):
+	def test_nad83_is_shifted_with_the_itrf00_transformation(self):
+		# A point in Boston, in NAD 1983 Massachusetts Mainland State Plane (meters).
+		reprojector = utils.Reprojector()
+		xy = [(236000.0, 900000.0)]
+		[[lat, lng]] = reprojector.to_latlng(xy, 26986, utils.NAD83_TO_WGS84)
+		[[lat0, lng0]] = reprojector.to_latlng(xy, 26986)
+		shift = math.hypot((lat - lat0) * 111000, (lng - lng0) * 111000 * math.cos(math.radians(lat)))
+		self.assertTrue(0.5 < shift < 1.5, shift)
+		self.assertEqual(reprojector.vertices, {(26986, utils.NAD83_TO_WGS84): 1, (26986, ''): 1})
+
+class DuplicateGeometriesTest(unittest.TestCase):
+	def test_compacted_first_segment_still_gives_its_results(self):
+		latlng = [['42.0', '-71.0'], ['42.1', '-71.0'], ['42.2', '-71.0']]
+		duplicates = utils.DuplicateGeometries()
+		first = {'id': 1, 'latlng': latlng, 'path': latlng, 'distance': 100.0, 'distance_reverse': 250.0, 'confidence': 0.9, 'point_mismatch': 0.0}
+		self.assertEqual(duplicates.match(first), (None, False))
+		duplicates.compact(first)
+		record, reversed = duplicates.match({'id': 2, 'latlng': latlng[::-1]})
+		self.assertIsInstance(record, tuple)
+		self.assertEqual(len(record), len(utils.RECORD_KEYS))
+		segment = {'id': 2}
+		self.assertEqual(duplicates.copy_osrm(record, segment, reversed, utils.FLIP), utils.ONEWAY)
+		self.assertEqual((segment['distance'], segment['distance_reverse'], segment['duplicate_of']), (250.0, 100.0, 1))
+		identical = {'id': 3, 'latlng': latlng}
+		record, reversed = duplicates.match(identical)
+		duplicates.copy_osrm(record, identical, reversed, utils.FLIP)
+		self.assertEqual(duplicates.copy_google(identical, lambda id: utils.FLIP), utils.FLIP)
+		self.assertEqual(identical['point_mismatch'], 0.0)
+		self.assertEqual(duplicates.n_duplicates, 2)
+
+	def test_history_is_bounded(self):
+		duplicates = utils.DuplicateGeometries(max_history = 2)
+		for id in range(1, 4):
+			segment = {'id': id, 'latlng': [['42.0', str(-71.0 - id)], ['42.1', '-71.0']]}
+			duplicates.match(segment)
+			duplicates.compact(segment)
+		# The first geometry was dropped, so its duplicate is classified on its own.
+		self.assertEqual(duplicates.match({'id': 4, 'latlng': [['42.0', '-72.0'], ['42.1', '-71.0']]}), (None, False))
+		self.assertEqual(duplicates.match({'id': 5, 'latlng': [['42.0', '-74.0'], ['42.1', '-71.0']]})[0]['id'], 3)
+		self.assertEqual(duplicates.first_of(5), (None, True))
+
+class SpatialReference(object):
+	# Stands in for arcpy.SpatialReference.
+	def __init__(self, factory_code, wkt):
+		self.factoryCode = factory_code
+		self.wkt = wkt
+
+	def exportToString(self):
+		return self.wkt
+
+class SourceCrsTest(unittest.TestCase):
+	def test_factory_code_is_used_when_there_is_one(self):
+		self.assertEqual(utils.source_crs(SpatialReference(26986, "PROJCS[...]")), 26986)
+
+	def test_domains_are_cut_off_the_wkt(self):
+		wkt = "PROJCS['Custom',GEOGCS['GCS_North_American_1983']]"
+		crs = utils.source_crs(SpatialReference(0, wkt + ";-36530900 -28803200 10000;-100000 10000;-100000 10000;0.001;0.001;0.001;IsHighPrecision"))
+		self.assertEqual(crs, wkt)
+
+class ValhallaRequestTest(unittest.TestCase):
+	def locations(self, url):
+		return json.loads(unquote(url.split('?json=', 1)[1]))['locations']
+
+	def test_long_paths_are_downsampled_keeping_both_ends(self):
+		path = [[str(42.0 + i * 1e-4), '-71.0'] for i in range(57)]
+		locations = self.locations(utils.valhalla_route_url(path))
+		self.assertEqual(len(locations), utils.VALHALLA_MAX_LOCATIONS)
+		self.assertEqual((locations[0]['lat'], locations[-1]['lat']), (42.0, 42.0056))
+		self.assertEqual([location['type'] for location in (locations[0], locations[1], locations[-1])], ['break', 'through', 'break'])
+
+	def test_short_paths_are_sent_whole(self):
+		path = [['42.0', '-71.0'], ['42.1', '-71.0'], ['42.2', '-71.0']]
+		self.assertEqual(len(self.locations(utils.valhalla_route_url(path))), 3)
+
+class StagedChangesTest(unittest.TestCase):
+	def test_flips_and_street_operations_are_merged_per_id(self):
+		changes = utils.staged_changes(flip_ids = [1, 4], twoway_ids = [2], oneway_ids = [1, 3])
+		self.assertEqual(changes, {1: [1, 1], 2: [0, 2], 3: [0, 1], 4: [1, None]})
+
+	def test_nothing_to_change(self):
+		self.assertEqual(utils.staged_changes(), {})
+
+class FakeArcpy(object):
+	# Just enough of arcpy to build a polyline: arrays are lists, a polyline is its parts.
+	Array = list
+
+	@staticmethod
+	def Polyline(parts, spatial_reference, has_z, has_m):
+		return parts
+
+class FakePolyline(list):
+	spatialReference = None
+	hasZ = False
+	hasM = False
+
+class ReversedPolylineTest(unittest.TestCase):
+	def test_parts_and_their_points_are_reversed(self):
+		shape = FakePolyline([[1, 2, 3], [4, 5]])
+		self.assertEqual(utils._reversed_polyline(FakeArcpy, shape), [[5, 4], [3, 2, 1]])
+
+class FlakyBackend(utils.RoutingBackend):
+	# Fails the first 'failures' requests with a transient error, then answers.
+	def __init__(self, failures):
+		utils.RoutingBackend.__init__(self, 'test', retries = 0)
+		self.failures = failures
+
+	def _attempt(self, url, decode):
+		with self._lock:
+			self.stats['requests'] += 1
+			failed = self.stats['requests'] <= self.failures
+		if failed:
+			raise utils.RequestError(utils.TRANSIENT, "connection refused")
+		return decode(url)
+
+class ReplayTest(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.path = os.path.join(self.folder, 'responses.jsonl.gz')
+		with gzip.open(self.path, 'wb') as outfile:
+			outfile.write((json.dumps({'url': 'snap?key=', 'response': 'not json'}) + '\n').encode('utf-8'))
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def test_unreadable_recorded_response_is_a_response_error(self):
+		backend = utils.RoutingBackend('test', archive = utils.ResponseArchive(self.path, replay = True))
+		with self.assertRaises(utils.RequestError) as raised:
+			backend.fetch('snap?key=KEY', utils.decode_snapped_points)
+		self.assertEqual(raised.exception.kind, utils.RESPONSE)
+		self.assertEqual(backend.stats['requests'], 0)
+
+class ResultsTableTest(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.path = os.path.join(self.folder, 'roads_results.gpkg')
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def test_repeated_ids_get_a_row_each(self):
+		table = utils.ResultsTable(self.path, 'RID')
+		table.add_segment({'id': '7', 'distance': 10.0}, utils.FLIP)
+		table.add_segment({'id': '7', 'distance': 12.0}, utils.ONEWAY)
+		table.close()
+		self.assertIsNone(table.error)
+		connection = sqlite3.connect(self.path)
+		self.assertEqual(connection.execute('SELECT osrm_verdict FROM roads_results WHERE RID = 7').fetchall(), [('flip',), ('oneway',)])
+		connection.close()
+
+	def test_write_failures_do_not_raise(self):
+		table = utils.ResultsTable(self.path)
+		table._sqlite[1].close()
+		table.add_segment({'id': 1}, utils.TWOWAY)
+		table.close()
+		self.assertIsNotNone(table.error)
+		self.assertEqual((table.rows_written, table.rows_dropped), (0, 1))
+		self.assertIn("could not be saved", table.status())
+
+class ConfidenceSweepTest(unittest.TestCase):
+	# (OSRM confidence, OSRM FLIP, sent to Snap To Roads, combined confidence)
+	measured = [(0.95, True, False, None), (0.5, True, True, 0.97), (0.5, False, True, 0.8), (0.5, True, True, None), (0.15, False, False, None)]
+
+	def test_counts_match_the_verdicts(self):
+		sweep = utils.confidence_sweep(self.measured, bands = [(0.2, 0.9)], flip_confidences = [0.9], review_confidences = [0.75])
+		self.assertEqual(sweep, [((0.2, 0.9), 0.9, 0.75, 3, 1, 0)])
+
+	def test_streets_never_sent_are_unrecorded(self):
+		sweep = utils.confidence_sweep(self.measured, bands = [(0.1, 0.99)], flip_confidences = [0.9], review_confidences = [0.75, 0.95])
+		self.assertEqual(sweep, [((0.1, 0.99), 0.9, 0.75, 2, 1, 2)])
+
+class SlowBackend(utils.RoutingBackend):
+	# Answers every request after 'delay' seconds, recording the most requests out at once.
+	def __init__(self, delay, **options):
+		utils.RoutingBackend.__init__(self, 'test', hedge_after = 0.01, **options)
+		self.delay = delay
+		self.out = 0
+		self.most_out = 0
+
+	def _attempt(self, url, decode):
+		with self._lock:
+			self.stats['requests'] += 1
+			self.out += 1
+			self.most_out = max(self.most_out, self.out)
+		time.sleep(self.delay)
+		with self._lock:
+			self.out -= 1
+		return decode(url)
+
+class HedgingTest(unittest.TestCase):
+	def fetch_all(self, backend, calls):
+		threads = [threading.Thread(target = backend.fetch, args = ('ok', lambda body: body)) for i in range(calls)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join(10)
+
+	def test_hedges_are_capped(self):
+		backend = SlowBackend(0.1, max_hedges_in_flight = 2)
+		self.fetch_all(backend, 10)
+		self.assertEqual(backend.stats['succeeded'], 10)
+		self.assertEqual(backend.stats['hedged'], 2)
+		self.assertEqual(backend.most_out, 12)
+
+	def test_half_open_trial_is_not_hedged(self):
+		backend = SlowBackend(0.1)
+		backend._opened_at = time.time() - utils.BREAKER_RESET
+		self.assertEqual(backend.fetch('ok', lambda body: body), 'ok')
+		self.assertEqual(backend.stats['hedged'], 0)
+		self.assertEqual(backend.stats['requests'], 1)
+
+	def test_threads_are_reused(self):
+		backend = SlowBackend(0)
+		backend.fetch('ok', lambda body: body)
+		threads = threading.active_count()
+		for i in range(50):
+			backend.fetch('ok', lambda body: body)
+		self.assertEqual(threading.active_count(), threads)
+
+class CircuitBreakerTest(unittest.TestCase):
+	def setUp(self):
+		self.saved = (utils.BREAKER_RESET, utils.BREAKER_GIVE_UP)
+		utils.BREAKER_RESET = 0.05
+
+	def tearDown(self):
+		utils.BREAKER_RESET, utils.BREAKER_GIVE_UP = self.saved
+
+	def fetch_all(self, backend, calls):
+		results = []
+		def call():
+			try:
+				results.append(backend.fetch('ok', lambda body: body))
+			except utils.RequestError as error:
+				results.append(error.kind)
+		threads = [threading.Thread(target = call) for i in range(calls)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join(10)
+		return results
+
+	def test_calls_wait_for_the_trial_instead_of_failing(self):
+		backend = FlakyBackend(utils.BREAKER_THRESHOLD + 1)
+		self.assertEqual(self.fetch_all(backend, utils.BREAKER_THRESHOLD), [utils.TRANSIENT] * utils.BREAKER_THRESHOLD)
+		start = time.time()
+		results = self.fetch_all(backend, 20)
+		# The first trial fails and re-opens the breaker; the next one closes it.
+		self.assertEqual(results.count('ok'), 19)
+		self.assertEqual(results.count(utils.TRANSIENT), 1)
+		self.assertEqual(backend.stats[utils.CIRCUIT_OPEN], 0)
+		self.assertEqual(backend.stats['breaker_opened'], 2)
+		self.assertEqual(backend.stats['requests'], utils.BREAKER_THRESHOLD + 20)
+		self.assertGreaterEqual(time.time() - start, 2 * utils.BREAKER_RESET)
+
+	def test_calls_fail_once_the_backend_stays_down(self):
+		utils.BREAKER_GIVE_UP = 2
+		backend = FlakyBackend(1000)
+		self.fetch_all(backend, utils.BREAKER_THRESHOLD)
+		results = self.fetch_all(backend, 10)
+		self.assertEqual(results.count(utils.TRANSIENT), 2)
+		self.assertEqual(results.count(utils.CIRCUIT_OPEN), 8)
+
+if __name__ == '__main__':
+	unittest.main()